@@ -3,7 +3,8 @@
 """
 
 from .async_client import AsyncDiscordOAuthClient
+from .cache import TTLCache
 from .old.client import DiscordOAuthClient
-from .exceptions import UserIsUnauthorized, UserIsAlreadyIn
-from .models import User, Guild, ResultResponse
+from .exceptions import UserIsUnauthorized, UserIsAlreadyIn, ChangeCursorExpired
+from .models import User, UserChange, Guild, ResultResponse
 from .utils import parse_datetime
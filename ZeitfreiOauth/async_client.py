@@ -1,18 +1,49 @@
-from typing import AsyncIterable
+import asyncio
+import json
+from collections import OrderedDict
+from typing import Any, AsyncIterable, Dict, Iterable, List, Optional, Tuple
 
 from aiohttp import ClientSession, ClientResponseError
 
-from ZeitfreiOauth.exceptions import UserIsUnauthorized, UserIsAlreadyIn
-from ZeitfreiOauth.models import User, Guild, ResultResponse
+from ZeitfreiOauth.cache import TTLCache
+from ZeitfreiOauth.exceptions import UserIsUnauthorized, UserIsAlreadyIn, ChangeCursorExpired
+from ZeitfreiOauth.models import User, UserChange, Guild, ResultResponse
+
+
+def _chunked(ids: Iterable[int], size: int) -> Iterable[List[str]]:
+    chunk = []
+
+    for item in ids:
+        chunk.append(str(item))
+
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+
+    if chunk:
+        yield chunk
 
 
 class AsyncDiscordOAuthClient:
-    def __init__(self, api_key: str, api_base_url: str = "http://localhost:2094"):
+    def __init__(self,
+                 api_key: str,
+                 api_base_url: str = "http://localhost:2094",
+                 cache_ttl: Optional[Dict[str, float]] = None,
+                 cache_size: int = 1024):
         """
         Initialize the API Client.
+        :param api_key: The API key.
+        :param api_base_url: (Optional) The base URL of the OAuth server.
+        :param cache_ttl: (Optional) Seconds to cache responses for, per method name,
+            e.g. {"get_user": 30, "get_guild_auth_role_data": 300}. Methods not listed are not cached.
+        :param cache_size: (Optional) The maximum number of cached responses.
         """
         self.api_base_url: str = api_base_url
         self.api_key: str = api_key
+        self.cache_ttl: Dict[str, float] = cache_ttl or {}
+        self.cache: TTLCache = TTLCache(max_size=cache_size)
+        self.validator_size: int = cache_size
+        self._validators: "OrderedDict[str, Tuple[str, Any]]" = OrderedDict()
 
         self.session = ClientSession(
             base_url=self.api_base_url,
@@ -21,30 +52,68 @@ class AsyncDiscordOAuthClient:
             }
         )
 
-    async def get_user(self, user_id: int, ensure: bool = False) -> User:
+    async def get_user(self, user_id: int, ensure: bool = False, max_age: Optional[float] = None) -> User:
         """
         Get a authorized user by user ID.
         :param user_id: The user ID to get the user for.
-        :param ensure: (Optional) Querying Discord API for real-time authorization.
+        :param ensure: (Optional) Querying Discord API for real-time authorization. This bypasses the cache.
+        :param max_age: (Optional) With ensure, accept a verification the server made within this many seconds.
         :return: The User object.
         """
-        response = await self.session.get(f"/user/{user_id}?ensure={ensure}")
+        if not ensure:
+            user = self._cache_get("get_user", user_id)
 
-        response.raise_for_status()
+            if user is not None:
+                return user
+
+        params = {"ensure": str(ensure)}
+
+        if ensure and max_age is not None:
+            params["max_age"] = str(max_age)
+
+        user = User.from_dict(await self._get_json(f"/user/{user_id}", params))
+
+        self._cache_set("get_user", user_id, user)
 
-        return User.from_dict(await response.json())
+        return user
 
-    async def get_all_user(self) -> AsyncIterable[User]:
+    async def get_all_user(self, page_size: Optional[int] = None) -> AsyncIterable[User]:
         """
         Get all the authorized user.
-        :return: A dictionary containing all authorized user data
+        Users are streamed from the server line by line, or fetched page by page when page_size is given,
+        so the whole user list is never held in memory.
+        :param page_size: (Optional) Fetch users in pages of this size instead of a single stream.
+        :return: An async iterator of all authorized users
         """
-        response = await self.session.get("/all_user")
+        if page_size is not None:
+            async for user in self._iter_user_pages(page_size):
+                yield user
+            return
 
-        response.raise_for_status()
+        response = await self.session.get("/all_user", params={"format": "ndjson"})
+
+        try:
+            response.raise_for_status()
+
+            async for line in response.content:
+                if line.strip():
+                    yield User.from_dict(json.loads(line))
+        finally:
+            response.release()
+
+    async def _iter_user_pages(self, page_size: int) -> AsyncIterable[User]:
+        after = ""
+
+        while True:
+            page = await self._get_json("/all_user", {"after": after, "limit": str(page_size)})
+
+            for user_data in page["users"]:
+                yield User.from_dict(user_data)
+
+            if page["next"] is None:
+                return
 
-        for user_data in await response.json():
-            yield User.from_dict(user_data)
+            after = page["next"]
 
     async def get_auth_role_data(self, unauthorized_role_id: int, authorized_role_id: int) -> AsyncIterable[Guild]:
         """
@@ -65,11 +134,114 @@ class AsyncDiscordOAuthClient:
         :param guild_id: The guild ID to get the data for.
         :return: The Guild object.
         """
-        response = await self.session.get(f"/get_guild_auth_role_data/{guild_id}")
+        guild = self._cache_get("get_guild_auth_role_data", guild_id)
 
-        response.raise_for_status()
+        if guild is not None:
+            return guild
+
+        guild = Guild.from_dict(await self._get_json(f"/get_guild_auth_role_data/{guild_id}"))
+
+        self._cache_set("get_guild_auth_role_data", guild_id, guild)
+
+        return guild
+
+    async def iter_user_changes(self,
+                                consumer: str,
+                                since: Optional[int] = None,
+                                page_size: int = 500,
+                                poll_interval: Optional[float] = None) -> AsyncIterable[UserChange]:
+        """
+        Iterate over the users inserted, updated or deleted since the consumer's last position.
+        The server stores the cursor of each consumer name, so a new iterator with the same name continues
+        where the previous one stopped. A page is acknowledged when the next one is requested,
+        so changes may be delivered again if the iterator is stopped in between.
+        :param consumer: A name identifying this copy of the user list.
+        :param since: (Optional) Start after this cursor instead of the stored one.
+        :param page_size: (Optional) The number of changes fetched per request, at most 1000.
+        :param poll_interval: (Optional) Keep waiting for new changes, polling every this many seconds.
+            Without it the iterator stops once it has caught up.
+        :return: An async iterator of UserChange objects.
+        :raises ChangeCursorExpired: The changes after the cursor were compacted. Reload all users with get_all_user,
+            then continue with since=error.cursor.
+        """
+        cursor = since
+
+        while True:
+            params = {"consumer": consumer, "limit": str(page_size)}
+
+            if cursor is not None:
+                params["since"] = str(cursor)
+
+            response = await self.session.get("/users/changes", params=params)
+
+            try:
+                if response.status == 410:
+                    raise ChangeCursorExpired((await response.json())["next"])
+
+                response.raise_for_status()
+
+                page = await response.json()
+            finally:
+                response.release()
+
+            for change_data in page["changes"]:
+                change = UserChange.from_dict(change_data)
+
+                self.cache.pop(("get_user", change.user_id))
+
+                yield change
+
+            cursor = page["next"]
+
+            if page["has_more"]:
+                continue
+
+            if poll_interval is None:
+                if page["changes"]:
+                    continue  # One more request acknowledges the last page
 
-        return Guild.from_dict(await response.json())
+                return
+
+            await asyncio.sleep(poll_interval)
+
+    async def get_users(self, user_ids: Iterable[int], chunk_size: int = 100) -> Dict[str, Optional[User]]:
+        """
+        Get many authorized users at once. Large inputs are split into chunks of chunk_size IDs per request.
+        :param user_ids: The user IDs to get.
+        :param chunk_size: (Optional) The number of IDs sent per request, at most 500.
+        :return: A dictionary keyed by user ID, with None for users that are not authorized.
+        """
+        users = {}
+
+        for chunk in _chunked(user_ids, chunk_size):
+            response = await self.session.post("/users/batch", json={"ids": chunk})
+
+            response.raise_for_status()
+
+            for user_id, user_data in (await response.json())["users"].items():
+                users[user_id] = User.from_dict(user_data) if user_data is not None else None
+
+        return users
+
+    async def get_guilds(self, guild_ids: Iterable[int], chunk_size: int = 100) -> Dict[str, List[Guild]]:
+        """
+        Get the unauthorized/authorized role data for many guilds at once.
+        Large inputs are split into chunks of chunk_size IDs per request.
+        :param guild_ids: The guild IDs to get the data for.
+        :param chunk_size: (Optional) The number of IDs sent per request, at most 500.
+        :return: A dictionary keyed by guild ID, containing the Guild objects registered for that guild.
+        """
+        guilds = {}
+
+        for chunk in _chunked(guild_ids, chunk_size):
+            response = await self.session.post("/guilds/batch", json={"guild_ids": chunk})
+
+            response.raise_for_status()
+
+            for guild_id, guild_list in (await response.json())["guilds"].items():
+                guilds[guild_id] = [Guild.from_dict(guild_data) for guild_data in guild_list]
+
+        return guilds
 
     async def delete_user(self, user_id: int) -> ResultResponse:
         """
@@ -77,6 +249,8 @@ class AsyncDiscordOAuthClient:
         :param user_id: The user ID to delete the user for.
         :return: The response from the API.
         """
+        self.cache.pop(("get_user", str(user_id)))
+
         response = await self.session.delete(f"/delete_user/{user_id}")
 
         response.raise_for_status()
@@ -89,6 +263,8 @@ class AsyncDiscordOAuthClient:
         :param guild: The guild to register.
         :return: The response from the API.
         """
+        self.cache.pop(("get_guild_auth_role_data", str(guild.guild_id)))
+
         return await guild.register(self.session)
 
     async def delete_guild_data(self, guild: Guild) -> ResultResponse:
@@ -97,6 +273,8 @@ class AsyncDiscordOAuthClient:
         :param guild: The guild to remove.
         :return: The response from the API.
         """
+        self.cache.pop(("get_guild_auth_role_data", str(guild.guild_id)))
+
         return await guild.remove(self.session)
 
     async def add_user_to_server(self, user_id: int) -> ResultResponse:
@@ -118,3 +296,51 @@ class AsyncDiscordOAuthClient:
                 raise error
 
         return ResultResponse.from_dict(await response.json())
+
+    def cache_stats(self, method: Optional[str] = None) -> Dict[str, float]:
+        """
+        Get the response cache hit/miss counters.
+        :param method: (Optional) Only count lookups of this method.
+        :return: A dictionary with hits, misses and hit_rate.
+        """
+        return self.cache.stats(method)
+
+    async def _get_json(self, path: str, params: Optional[Dict[str, str]] = None) -> Any:
+        """
+        GET a JSON resource, sending the stored ETag as If-None-Match
+        and reusing the stored body when the server answers 304 Not Modified.
+        """
+        key = path + "?" + "&".join(f"{name}={value}" for name, value in sorted((params or {}).items()))
+        validator = self._validators.get(key)
+        headers = {"If-None-Match": validator[0]} if validator is not None else {}
+
+        response = await self.session.get(path, params=params, headers=headers)
+
+        if response.status == 304 and validator is not None:
+            response.release()
+            self._validators.move_to_end(key)
+            return validator[1]
+
+        response.raise_for_status()
+
+        data = await response.json()
+        etag = response.headers.get("ETag")
+
+        if etag is not None:
+            self._validators[key] = (etag, data)
+            self._validators.move_to_end(key)
+
+            while len(self._validators) > self.validator_size:
+                self._validators.popitem(last=False)
+
+        return data
+
+    def _cache_get(self, method: str, key: int):
+        if method not in self.cache_ttl:
+            return None
+
+        return self.cache.get((method, str(key)), None)
+
+    def _cache_set(self, method: str, key: int, value) -> None:
+        if method in self.cache_ttl:
+            self.cache.set((method, str(key)), value, self.cache_ttl[method])
@@ -0,0 +1,96 @@
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Optional, Tuple
+
+_MISSING = object()
+
+
+class TTLCache:
+    """
+    A bounded LRU cache whose entries also expire after a time-to-live.
+    Keys are tuples whose first item is the namespace (e.g. the client method name),
+    which is used to keep per-namespace hit/miss counters.
+    """
+
+    def __init__(self, max_size: int = 1024):
+        """
+        Initialize the cache.
+        :param max_size: The maximum number of entries kept before the least recently used one is evicted.
+        """
+        self.max_size: int = max_size
+        self._entries: "OrderedDict[Tuple[Hashable, ...], Tuple[float, Any]]" = OrderedDict()
+        self._stats: Dict[Hashable, Dict[str, int]] = {}
+
+    def _record(self, key: Tuple[Hashable, ...], outcome: str) -> None:
+        stats = self._stats.setdefault(key[0], {"hits": 0, "misses": 0})
+        stats[outcome] += 1
+
+    def get(self, key: Tuple[Hashable, ...], default: Any = _MISSING) -> Any:
+        """
+        Get a cached value.
+        :param key: The cache key.
+        :param default: The value returned when the key is missing or expired.
+        :return: The cached value, or default.
+        """
+        entry = self._entries.get(key)
+
+        if entry is None or entry[0] <= time.monotonic():
+            if entry is not None:
+                del self._entries[key]
+
+            self._record(key, "misses")
+            return default
+
+        self._entries.move_to_end(key)
+        self._record(key, "hits")
+        return entry[1]
+
+    def set(self, key: Tuple[Hashable, ...], value: Any, ttl: float) -> None:
+        """
+        Store a value.
+        :param key: The cache key.
+        :param value: The value to store.
+        :param ttl: The number of seconds the value stays valid.
+        """
+        self._entries[key] = (time.monotonic() + ttl, value)
+        self._entries.move_to_end(key)
+
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def pop(self, key: Tuple[Hashable, ...]) -> None:
+        """
+        Drop a value from the cache.
+        :param key: The cache key.
+        """
+        self._entries.pop(key, None)
+
+    def clear(self) -> None:
+        """
+        Drop every cached value.
+        """
+        self._entries.clear()
+
+    def stats(self, namespace: Optional[Hashable] = None) -> Dict[str, float]:
+        """
+        Get the hit/miss counters.
+        :param namespace: (Optional) Only count lookups of this namespace.
+        :return: A dictionary with hits, misses and hit_rate.
+        """
+        if namespace is None:
+            hits = sum(stats["hits"] for stats in self._stats.values())
+            misses = sum(stats["misses"] for stats in self._stats.values())
+        else:
+            stats = self._stats.get(namespace, {"hits": 0, "misses": 0})
+            hits, misses = stats["hits"], stats["misses"]
+
+        total = hits + misses
+
+        return {
+            "hits": hits,
+            "misses": misses,
+            "hit_rate": hits / total if total else 0.0
+        }
+
+    def __len__(self) -> int:
+        return len(self._entries)
@@ -4,3 +4,9 @@ class UserIsUnauthorized(Exception):
 
 class UserIsAlreadyIn(Exception):
     pass
+
+
+class ChangeCursorExpired(Exception):
+    def __init__(self, cursor: int):
+        super().__init__("The change feed cursor is no longer available, resync with get_all_user")
+        self.cursor: int = cursor
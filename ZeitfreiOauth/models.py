@@ -193,3 +193,55 @@ class User:
             'refresh_token': self.refresh_token,
             'expires_at': self.expires_at.strftime("%Y-%m-%dT%H:%M:%S.%fZ")
         }
+
+
+class UserChange:
+    """
+    Represents a change of an authorized user in the change feed.
+    """
+
+    def __init__(self,
+                 seq: int,
+                 operation: str,
+                 user_id: str,
+                 user: Optional[User] = None):
+        """
+        Initialize the UserChange object.
+        :param seq: The cursor of the change.
+        :param operation: "insert", "update" or "delete". Inserts and updates both carry the current user data.
+        :param user_id: The user ID.
+        :param user: The current user data, None for deletions.
+        """
+        self.seq: int = seq
+        self.operation: str = operation
+        self.user_id: str = user_id
+        self.user: Optional[User] = user
+
+    def is_deleted(self) -> bool:
+        return self.operation == "delete"
+
+    @classmethod
+    def from_dict(cls, data: dict) -> 'UserChange':
+        """
+        Create a UserChange object from a dictionary
+        :param data: The dictionary to create the UserChange object from
+        :return: The UserChange object
+        """
+        return cls(
+            seq=data['seq'],
+            operation=data['op'],
+            user_id=data['user_id'],
+            user=User.from_dict(data['user']) if data.get('user') is not None else None
+        )
+
+    def to_dict(self) -> dict:
+        """
+        Convert the UserChange object to a dictionary
+        :return: The dictionary representation of the UserChange object
+        """
+        return {
+            'seq': self.seq,
+            'op': self.operation,
+            'user_id': self.user_id,
+            'user': self.user.to_dict() if self.user is not None else None
+        }
@@ -0,0 +1,140 @@
+#模擬Discord API 供壓力測試使用 不需連線到真正的Discord
+#支援 /oauth2/token、/users/@me、伺服器成員與身分組端點、webhook 並可設定延遲與429比例
+import argparse, asyncio, itertools, random
+from aiohttp import web
+
+class FakeDiscord:
+    def __init__(self, latency:float = 0.05, jitter:float = 0.02, rate_limit_ratio:float = 0.0, retry_after:float = 0.2, bucket_limit:int = 50):
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_limit_ratio = rate_limit_ratio
+        self.retry_after = retry_after
+        self.bucket_limit = bucket_limit
+        self.tokens = {} #access_token或refresh_token -> 使用者ID
+        self.members = {} #(guild_id, user_id) -> 成員資料
+        self.ids = itertools.count(1)
+        self.requests = 0
+        self.rate_limited = 0
+
+    async def _delay(self):
+        await asyncio.sleep(max(self.latency + random.uniform(-self.jitter, self.jitter), 0))
+
+    def _rate_limit_headers(self, bucket:str) -> dict:
+        return {
+            "X-RateLimit-Bucket": bucket,
+            "X-RateLimit-Limit": str(self.bucket_limit),
+            "X-RateLimit-Remaining": str(self.bucket_limit - 1),
+            "X-RateLimit-Reset-After": "1.0"
+        }
+
+    @web.middleware
+    async def middleware(self, request:web.Request, handler):
+        self.requests += 1
+        await self._delay()
+        bucket = request.match_info.route.resource.canonical if request.match_info.route.resource else request.path
+        if self.rate_limit_ratio and random.random() < self.rate_limit_ratio:
+            self.rate_limited += 1
+            headers = self._rate_limit_headers(bucket)
+            headers.update({"X-RateLimit-Remaining": "0", "Retry-After": str(self.retry_after), "X-RateLimit-Scope": "user"})
+            return web.json_response({"message": "You are being rate limited.", "retry_after": self.retry_after, "global": False}, status=429, headers=headers)
+        try:
+            response = await handler(request)
+        except ConnectionResetError: #oauthServer.py結束時中斷的請求
+            return web.Response(status=499)
+        response.headers.update(self._rate_limit_headers(bucket))
+        return response
+
+    def _issue(self, user_id:str) -> dict:
+        number = next(self.ids)
+        access_token, refresh_token = f"access{number}", f"refresh{number}"
+        self.tokens[access_token] = self.tokens[refresh_token] = user_id
+        return {"access_token": access_token, "refresh_token": refresh_token, "expires_in": 604800, "token_type": "Bearer", "scope": "identify guilds guilds.join email"}
+
+    async def token(self, request:web.Request):
+        data = await request.post()
+        if data.get("grant_type") == "refresh_token":
+            user_id = self.tokens.pop(data.get("refresh_token"), None)
+            if user_id is None:
+                return web.json_response({"error": "invalid_grant"}, status=400)
+            return web.json_response(self._issue(user_id))
+        code = data.get("code", "")
+        if code.startswith("user-"): #以指定的使用者重新授權
+            return web.json_response(self._issue(code.removeprefix("user-")))
+        return web.json_response(self._issue(str(10 ** 17 + next(self.ids))))
+
+    async def me(self, request:web.Request):
+        token = request.headers.get("Authorization", "").removeprefix("Bearer ")
+        user_id = self.tokens.get(token)
+        if user_id is None:
+            return web.json_response({"message": "401: Unauthorized", "code": 0}, status=401)
+        return web.json_response({
+            "id": user_id,
+            "username": f"user{user_id[-6:]}",
+            "discriminator": "0",
+            "global_name": None,
+            "avatar": None,
+            "banner": None,
+            "email": f"{user_id}@example.com"
+        })
+
+    async def member(self, request:web.Request):
+        key = (request.match_info["guild_id"], request.match_info["user_id"])
+        if request.method == "PUT":
+            if key in self.members:
+                return web.Response(status=204)
+            body = await request.json()
+            self.members[key] = {"user": {"id": key[1]}, "roles": body.get("roles", []), "nick": body.get("nick")}
+            return web.json_response(self.members[key], status=201)
+        member = self.members.get(key)
+        if member is None:
+            return web.json_response({"message": "Unknown Member", "code": 10007}, status=404)
+        if request.method == "PATCH":
+            member.update(await request.json())
+            return web.json_response(member)
+        if request.method == "DELETE":
+            del self.members[key]
+            return web.Response(status=204)
+        return web.json_response(member)
+
+    async def member_role(self, request:web.Request):
+        key = (request.match_info["guild_id"], request.match_info["user_id"])
+        member = self.members.get(key)
+        if member is not None:
+            role_id = request.match_info["role_id"]
+            if request.method == "PUT" and role_id not in member["roles"]:
+                member["roles"].append(role_id)
+            elif request.method == "DELETE" and role_id in member["roles"]:
+                member["roles"].remove(role_id)
+        return web.Response(status=204)
+
+    async def webhook(self, request:web.Request):
+        await request.read()
+        return web.Response(status=204)
+
+    def make_app(self) -> web.Application:
+        app = web.Application(middlewares=[self.middleware])
+        app.router.add_post('/oauth2/token', self.token)
+        app.router.add_get('/users/@me', self.me)
+        app.router.add_route('*', '/guilds/{guild_id}/members/{user_id}', self.member)
+        app.router.add_route('*', '/guilds/{guild_id}/members/{user_id}/roles/{role_id}', self.member_role)
+        app.router.add_post('/webhooks/{webhook_id}/{webhook_token}', self.webhook)
+        return app
+
+    def stats(self) -> dict:
+        return {
+            "requests": self.requests,
+            "rate_limited": self.rate_limited,
+            "members": len(self.members)
+        }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="本機模擬Discord API")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8099)
+    parser.add_argument("--latency", type=float, default=0.05, help="每個請求的平均延遲(秒)")
+    parser.add_argument("--jitter", type=float, default=0.02, help="延遲的隨機變動範圍(秒)")
+    parser.add_argument("--rate-limit-ratio", type=float, default=0.0, help="回傳429的比例(0~1)")
+    parser.add_argument("--retry-after", type=float, default=0.2, help="429回應的Retry-After(秒)")
+    args = parser.parse_args()
+    fake = FakeDiscord(args.latency, args.jitter, args.rate_limit_ratio, args.retry_after)
+    web.run_app(fake.make_app(), host=args.host, port=args.port)
@@ -0,0 +1,246 @@
+#壓力測試 於暫存資料夾啟動oauthServer.py並連線到本機模擬的Discord API
+#依設定的比例送出 /callback、/user/{id}?ensure=True、/all_user、/delete_user 請求
+#結果(p50/p90/p99延遲與每秒請求數)寫入JSON 可跨commit比較
+#用法: python benchmarks/load_test.py --duration 30 --concurrency 32 --output bench.json
+import argparse, asyncio, datetime, json, os, platform, random, signal, socket, sqlite3, subprocess, sys, tempfile, time
+from aiohttp import web, ClientSession, ClientTimeout
+from fake_discord import FakeDiscord
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+API_KEY = "benchmark-key"
+HEADERS = {"X-API-KEY": API_KEY}
+DEFAULT_MIX = "callback=1,user=6,all_user=1,delete_user=1"
+OPERATIONS = ("callback", "user", "all_user", "delete_user")
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def parse_mix(text:str) -> dict:
+    mix = {}
+    for item in text.split(","):
+        name, _, weight = item.partition("=")
+        mix[name.strip()] = float(weight or 1)
+    unknown = set(mix) - set(OPERATIONS)
+    if unknown:
+        raise SystemExit(f"Unknown operations in --mix: {', '.join(sorted(unknown))}")
+    return mix
+
+def percentile(values:list, percent:float) -> float:
+    if not values:
+        return 0.0
+    index = min(int(round(percent / 100 * (len(values) - 1))), len(values) - 1)
+    return values[index]
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=REPO_ROOT, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+class LoadTest:
+    def __init__(self, base_url:str, mix:dict, concurrency:int):
+        self.base_url = base_url
+        self.mix = mix
+        self.concurrency = concurrency
+        self.user_ids = []
+        self.deleted_ids = [] #已刪除 下次/callback時重新授權
+        self.samples = {name: [] for name in mix} #操作名稱 -> [(延遲秒數, 狀態碼)]
+        self.session:ClientSession = None
+
+    async def callback(self):
+        user_id = self.deleted_ids.pop() if self.deleted_ids else None
+        code = f"user-{user_id}" if user_id else f"code{random.random()}"
+        async with self.session.get(f"{self.base_url}/callback", params={"code": code}, allow_redirects=False) as response:
+            await response.read()
+        if user_id:
+            self.user_ids.append(user_id)
+        return response.status
+
+    async def user(self):
+        if not self.user_ids:
+            return await self.callback()
+        async with self.session.get(f"{self.base_url}/user/{random.choice(self.user_ids)}", params={"ensure": "True"}, headers=HEADERS) as response:
+            await response.read()
+            return response.status
+
+    async def all_user(self):
+        async with self.session.get(f"{self.base_url}/all_user", params={"format": "ndjson"}, headers=HEADERS) as response:
+            await response.read()
+            return response.status
+
+    async def delete_user(self):
+        if not self.user_ids:
+            return await self.callback()
+        user_id = self.user_ids.pop(random.randrange(len(self.user_ids)))
+        async with self.session.delete(f"{self.base_url}/delete_user/{user_id}", headers=HEADERS) as response:
+            await response.read()
+        self.deleted_ids.append(user_id)
+        return response.status
+
+    async def load_user_ids(self):
+        async with self.session.get(f"{self.base_url}/all_user", params={"format": "ndjson"}, headers=HEADERS) as response:
+            self.user_ids = [json.loads(line)["id"] for line in (await response.text()).splitlines() if line]
+
+    async def worker(self, deadline:float):
+        names = list(self.mix)
+        weights = [self.mix[name] for name in names]
+        while time.monotonic() < deadline:
+            name = random.choices(names, weights)[0]
+            started = time.perf_counter()
+            try:
+                status = await getattr(self, name)()
+            except Exception:
+                status = 0 #連線錯誤或逾時
+            self.samples[name].append((time.perf_counter() - started, status))
+
+    async def run(self, duration:float) -> float:
+        deadline = time.monotonic() + duration
+        started = time.perf_counter()
+        await asyncio.gather(*(self.worker(deadline) for _ in range(self.concurrency)))
+        return time.perf_counter() - started
+
+def summarize(samples:list, elapsed:float) -> dict:
+    latencies = sorted(latency for latency, _ in samples)
+    statuses = {}
+    for _, status in samples:
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+    return {
+        "requests": len(samples),
+        "requests_per_second": round(len(samples) / elapsed, 2) if elapsed else 0.0,
+        "errors": sum(1 for _, status in samples if status == 0 or status >= 500),
+        "status": statuses,
+        "latency_ms": {
+            "p50": round(percentile(latencies, 50) * 1000, 2),
+            "p90": round(percentile(latencies, 90) * 1000, 2),
+            "p99": round(percentile(latencies, 99) * 1000, 2),
+            "max": round(latencies[-1] * 1000, 2) if latencies else 0.0,
+            "mean": round(sum(latencies) / len(latencies) * 1000, 2) if latencies else 0.0
+        }
+    }
+
+def prepare_workdir(workdir:str):
+    with sqlite3.connect(os.path.join(workdir, "bot.db")) as conn:
+        conn.execute("CREATE TABLE bot (botName TEXT, owner TEXT, botKey TEXT, rate_limit REAL, burst INTEGER, max_concurrency INTEGER)")
+        conn.execute("INSERT INTO bot VALUES (?, ?, ?, 0, 0, 0)", ("benchmark", "benchmark", API_KEY)) #0表示不限制 測量的是伺服器本身的吞吐量
+
+def start_server(workdir:str, port:int, discord_url:str) -> subprocess.Popen:
+    env = dict(os.environ)
+    env.update({
+        "CLIENT_ID": "0",
+        "CLIENT_SECRET": "benchmark",
+        "BOT_TOKEN": "benchmark",
+        "LOG_WEBHOOK_URL": f"{discord_url}/webhooks/0/benchmark",
+        "DISCORD_API_BASE": discord_url,
+        "OAUTH_HOST": "127.0.0.1",
+        "OAUTH_PORT": str(port)
+    })
+    return subprocess.Popen([sys.executable, os.path.join(REPO_ROOT, "oauthServer.py")], cwd=workdir, env=env, stdout=subprocess.DEVNULL)
+
+async def wait_until_ready(session:ClientSession, base_url:str, server:subprocess.Popen, timeout:float = 30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise SystemExit(f"oauthServer.py exited with code {server.returncode}")
+        try:
+            async with session.get(f"{base_url}/metrics", headers=HEADERS) as response:
+                if response.status == 200:
+                    return
+        except OSError:
+            pass
+        await asyncio.sleep(0.2)
+    raise SystemExit("oauthServer.py did not become ready in time")
+
+async def seed(test:LoadTest, users:int, guild_id:int, timeout:float = 60):
+    async with test.session.post(f"{test.base_url}/add_guild", headers=HEADERS, json={
+        "guild_id": guild_id, "unauth_role": 1, "auth_role": 2, "reauth_day": 30
+    }) as response:
+        response.raise_for_status()
+    for start in range(0, users, test.concurrency):
+        await asyncio.gather(*(test.callback() for _ in range(min(test.concurrency, users - start))))
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline: #callback的授權後工作在背景執行 等待使用者寫入資料庫
+        await test.load_user_ids()
+        if len(test.user_ids) >= users:
+            return
+        await asyncio.sleep(0.5)
+    print(f"Only {len(test.user_ids)} of {users} seed users were stored before the timeout", file=sys.stderr)
+
+async def main(args):
+    mix = parse_mix(args.mix)
+    fake = FakeDiscord(args.latency, args.jitter, args.rate_limit_ratio, args.retry_after)
+    fake_runner = web.AppRunner(fake.make_app(), access_log=None)
+    await fake_runner.setup()
+    fake_port = free_port()
+    await web.TCPSite(fake_runner, "127.0.0.1", fake_port).start()
+    server_port = free_port()
+    base_url = f"http://127.0.0.1:{server_port}"
+    with tempfile.TemporaryDirectory(prefix="oauth-bench-") as workdir:
+        prepare_workdir(workdir)
+        server = start_server(workdir, server_port, f"http://127.0.0.1:{fake_port}")
+        try:
+            async with ClientSession(timeout=ClientTimeout(total=args.timeout)) as session:
+                test = LoadTest(base_url, mix, args.concurrency)
+                test.session = session
+                await wait_until_ready(session, base_url, server)
+                await seed(test, args.users, args.guild_id)
+                test.samples = {name: [] for name in mix}
+                fake_before = fake.stats()
+                elapsed = await test.run(args.duration)
+                async with session.get(f"{base_url}/metrics", headers=HEADERS) as response:
+                    server_metrics = await response.text()
+        finally:
+            server.send_signal(signal.SIGINT)
+            try:
+                server.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                server.kill()
+            await fake_runner.cleanup()
+    all_samples = [sample for samples in test.samples.values() for sample in samples]
+    fake_after = fake.stats()
+    report = {
+        "commit": git_commit(),
+        "started_at": datetime.datetime.now().astimezone().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "config": {
+            "duration": args.duration,
+            "concurrency": args.concurrency,
+            "users": args.users,
+            "mix": mix,
+            "discord_latency": args.latency,
+            "discord_jitter": args.jitter,
+            "rate_limit_ratio": args.rate_limit_ratio
+        },
+        "elapsed_seconds": round(elapsed, 3),
+        "total": summarize(all_samples, elapsed),
+        "operations": {name: summarize(samples, elapsed) for name, samples in test.samples.items()},
+        "discord": {
+            "requests": fake_after["requests"] - fake_before["requests"],
+            "rate_limited": fake_after["rate_limited"] - fake_before["rate_limited"]
+        }
+    }
+    if args.metrics_output:
+        with open(args.metrics_output, "w", encoding="utf-8") as file:
+            file.write(server_metrics)
+    with open(args.output, "w", encoding="utf-8") as file:
+        json.dump(report, file, indent=2)
+    total = report["total"]
+    print(f"{total['requests']} requests in {report['elapsed_seconds']} s: {total['requests_per_second']} req/s, "
+          f"p50 {total['latency_ms']['p50']} ms, p99 {total['latency_ms']['p99']} ms, {total['errors']} errors -> {args.output}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="oauthServer.py 壓力測試")
+    parser.add_argument("--duration", type=float, default=30, help="測試秒數")
+    parser.add_argument("--concurrency", type=int, default=32, help="同時進行的請求數")
+    parser.add_argument("--users", type=int, default=200, help="測試前先以/callback建立的使用者數")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help=f"各操作的權重 預設為 {DEFAULT_MIX}")
+    parser.add_argument("--latency", type=float, default=0.05, help="模擬Discord API的平均延遲(秒)")
+    parser.add_argument("--jitter", type=float, default=0.02, help="模擬Discord API延遲的隨機變動範圍(秒)")
+    parser.add_argument("--rate-limit-ratio", type=float, default=0.0, help="模擬Discord API回傳429的比例(0~1)")
+    parser.add_argument("--retry-after", type=float, default=0.2, help="429回應的Retry-After(秒)")
+    parser.add_argument("--guild-id", type=int, default=308120017201922048, help="oauthServer.py的MAIN_GUILD_ID")
+    parser.add_argument("--timeout", type=float, default=60, help="單一請求的逾時秒數")
+    parser.add_argument("--output", default="benchmark_report.json", help="JSON報告的輸出路徑")
+    parser.add_argument("--metrics-output", help="另存測試結束時/metrics的內容")
+    asyncio.run(main(parser.parse_args()))
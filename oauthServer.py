@@ -1,8 +1,8 @@
-import sqlite3, requests, os, hmac, datetime, asyncio, logging, time, zipfile
+import sqlite3, os, json, hmac, hashlib, datetime, asyncio, logging, logging.handlers, queue, time, zipfile, threading, collections, random, signal, socket, multiprocessing, yarl
 from logging import WARN, WARNING, ERROR, DEBUG, INFO
-from aiohttp import web, ClientSession
+from aiohttp import web, ClientSession, ClientTimeout, TCPConnector, ClientError, ClientResponseError
 from dotenv import load_dotenv
-from discord_webhook import DiscordWebhook, DiscordEmbed
+from discord_webhook import DiscordEmbed
 from concurrent.futures import ThreadPoolExecutor
 
 executor = ThreadPoolExecutor()
@@ -14,35 +14,213 @@ LOG_WEBHOOK_URL = os.getenv("LOG_WEBHOOK_URL")
 REDIRECT_URI = 'https://oauth.zeitfrei.tw/callback'
 DATABASE = "users.db"
 AUTH_BOTS_DATABASE = "bot.db"
+DISCORD_API_BASE = os.getenv("DISCORD_API_BASE", "https://discord.com/api")
+OAUTH_HOST = os.getenv("OAUTH_HOST", "localhost")
+OAUTH_PORT = int(os.getenv("OAUTH_PORT", 2094))
+OAUTH_WORKERS = int(os.getenv("OAUTH_WORKERS", 1)) #大於1時以多個worker行程共用同一個連接埠
+WORKER_DRAIN_TIMEOUT = float(os.getenv("WORKER_DRAIN_TIMEOUT", 30)) #停止時等待進行中請求完成的秒數
+DISCORD_GLOBAL_RATE = 50
+LEASE_TTL = 30
+WORKER_RESTART_LIMIT = int(os.getenv("WORKER_RESTART_LIMIT", 5)) #worker連續崩潰超過此次數後不再重新啟動
+ADMISSION_DEFAULT_RATE = float(os.getenv("ADMISSION_DEFAULT_RATE", 20)) #bot資料表未設定rate_limit時 每秒可用的請求額度
+ADMISSION_DEFAULT_BURST = int(os.getenv("ADMISSION_DEFAULT_BURST", 40))
+ADMISSION_DEFAULT_CONCURRENCY = int(os.getenv("ADMISSION_DEFAULT_CONCURRENCY", 8)) #每個機器人在同一路由上同時進行的請求數
+ADMISSION_SHED_LAG = float(os.getenv("ADMISSION_SHED_LAG", 0.25)) #事件迴圈延遲超過此秒數時開始拒絕低優先度路由
+ENSURE_MAX_AGE = float(os.getenv("ENSURE_MAX_AGE", 0)) #ensure=True未指定max_age時 沿用幾秒內的驗證結果 0表示每次都向Discord確認
+ENSURE_MAX_AGE_LIMIT = float(os.getenv("ENSURE_MAX_AGE_LIMIT", 3600)) #max_age的上限 避免撤銷授權後太久才發現
+CHANGE_CONSUMER_TTL = float(os.getenv("CHANGE_CONSUMER_TTL", 7 * 86400)) #超過此秒數未讀取的consumer不再阻擋變更紀錄的壓縮
+CHANGE_RETENTION = float(os.getenv("CHANGE_RETENTION", 30 * 86400)) #變更紀錄最多保留的秒數
+DISCORD_HTTP_LIMIT = int(os.getenv("DISCORD_HTTP_LIMIT", 100))
+DISCORD_HTTP_LIMIT_PER_HOST = int(os.getenv("DISCORD_HTTP_LIMIT_PER_HOST", 50))
+DISCORD_HTTP_TIMEOUT = float(os.getenv("DISCORD_HTTP_TIMEOUT", 15))
+MAIN_GUILD_ID = 308120017201922048
+ALL_USER_CHUNK_SIZE = 500
+ALL_USER_MAX_PAGE_SIZE = 1000
+DELETION_CONCURRENCY = int(os.getenv("DELETION_CONCURRENCY", 10))
+BATCH_MAX_IDS = 500
+LOG_FILE = 'oauth_server.log'
+LOG_DIR = './serverLog'
+LOG_MAX_BYTES = int(os.getenv("LOG_MAX_BYTES", 50 * 1024 * 1024))
 
-logging.basicConfig(filename='oauth_server.log', format='%(asctime)s - %(levelname)s - %(message)s', level=logging.INFO)
-webhook = DiscordWebhook(url=LOG_WEBHOOK_URL)
-
-def logger(request:web.Request, bot_name:str, level:logging = INFO):
-    method = request.method
-    path = request.path
-    log_message = f"[{bot_name}] - {method} {path}"
-    logging.log(level=level, msg=log_message)
-
-async def logger_updater():
-    log_file_path = 'oauth_server.log'
-    server_log_dir = './serverLog'
-    while True:
-        current_time = datetime.datetime.now().astimezone()
-        hour = current_time.hour
-        minute = current_time.minute
-        second = current_time.second
-        set_time = 86400
-        wait_time = (set_time - (hour * 3600 + minute * 60 + second) + 86400) % 86400
-        print(f"換日剩餘時間 : {wait_time}")
-        await asyncio.sleep(wait_time)
-        date_string = datetime.datetime.now().strftime('%Y-%m-%d')
-        with zipfile.ZipFile(f'{server_log_dir}/log_{date_string}.zip', 'w') as zipf:
-            zipf.write(log_file_path, arcname=os.path.join(server_log_dir, 'oauth_server.log'))
-        open(log_file_path, 'w').close()
-        await asyncio.sleep(1)
+#==================紀錄檔==================
+class JsonFormatter(logging.Formatter): #每行一筆JSON 存取紀錄的欄位放在record.access
+    def format(self, record:logging.LogRecord) -> str:
+        entry = {
+            "time": datetime.datetime.fromtimestamp(record.created).astimezone().isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage()
+        }
+        entry.update(getattr(record, "access", {}))
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+class ZipRotatingFileHandler(logging.handlers.TimedRotatingFileHandler): #每日或超過大小時輪替 舊檔壓縮至serverLog
+    def __init__(self, filename:str, archive_dir:str, max_bytes:int = 0):
+        super().__init__(filename, when="midnight", encoding="utf-8", delay=True)
+        self.archive_dir = archive_dir
+        self.max_bytes = max_bytes
+        self.namer = self._archive_name
+        self.rotator = self._archive
+
+    def shouldRollover(self, record:logging.LogRecord) -> bool:
+        if super().shouldRollover(record):
+            return True
+        if self.max_bytes > 0 and os.path.exists(self.baseFilename):
+            return os.path.getsize(self.baseFilename) >= self.max_bytes
+        return False
+
+    def _archive_name(self, default_name:str) -> str:
+        date_string = default_name.rsplit(".", 1)[-1]
+        path = os.path.join(self.archive_dir, f"log_{date_string}.zip")
+        index = 1
+        while os.path.exists(path): #同一天因大小輪替多次時加上序號
+            path = os.path.join(self.archive_dir, f"log_{date_string}.{index}.zip")
+            index += 1
+        return path
+
+    def _archive(self, source:str, dest:str):
+        if not os.path.exists(source):
+            return
+        os.makedirs(self.archive_dir, exist_ok=True)
+        with zipfile.ZipFile(dest, "w", zipfile.ZIP_DEFLATED) as zipf:
+            zipf.write(source, arcname=os.path.basename(source))
+        os.remove(source)
+
+def setup_logging(log_queue = None, writer:bool = True) -> logging.handlers.QueueListener:
+    #請求只把紀錄放進佇列 寫檔與輪替壓縮都在QueueListener的背景執行緒中依序進行 輪替期間不會遺失紀錄
+    #多worker模式下worker只把紀錄送進supervisor的佇列(writer=False) 只有supervisor寫檔與輪替
+    log_queue = log_queue if log_queue is not None else queue.SimpleQueue()
+    root = logging.getLogger()
+    root.setLevel(logging.INFO)
+    root.addHandler(logging.handlers.QueueHandler(log_queue))
+    if not writer:
+        return None
+    file_handler = ZipRotatingFileHandler(LOG_FILE, LOG_DIR, LOG_MAX_BYTES)
+    file_handler.setFormatter(JsonFormatter())
+    listener = logging.handlers.QueueListener(log_queue, file_handler, respect_handler_level=True)
+    listener.start()
+    return listener
+
+log_listener:logging.handlers.QueueListener = None
+access_logger = logging.getLogger("access")
+
+@web.middleware
+async def access_log_middleware(request:web.Request, handler):
+    started = time.perf_counter()
+    status = 500
+    try:
+        response = await handler(request)
+        status = response.status
+        return response
+    except web.HTTPException as e:
+        status = e.status
+        raise
+    finally:
+        level = ERROR if status >= 500 else WARNING if status in (401, 403) or request.get('bot_name') == "Anonymous" else INFO
+        access_logger.log(level, f"[{request.get('bot_name', '-')}] - {request.method} {request.path} {status}", extra={"access": {
+            "bot": request.get('bot_name'),
+            "method": request.method,
+            "path": request.path,
+            "status": status,
+            "latency_ms": round((time.perf_counter() - started) * 1000, 2),
+            "remote": request.remote
+        }})
+
+#==================監控指標==================
+class Metrics: #以Prometheus文字格式輸出的計數器與直方圖 標籤值tuple作為鍵 可由資料庫執行緒寫入
+    LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {} #名稱 -> (說明, 標籤名稱, {標籤值: 數值})
+        self._histograms = {} #名稱 -> (說明, 標籤名稱, buckets, {標籤值: [各bucket次數..., 總和, 次數]})
+        self._collectors = [] #async func() -> [(名稱, 類型, 說明, [(標籤dict, 數值)])]
+
+    def counter(self, name:str, help_text:str, labels:tuple = ()):
+        self._counters[name] = (help_text, labels, {})
+
+    def histogram(self, name:str, help_text:str, labels:tuple = (), buckets:tuple = LATENCY_BUCKETS):
+        self._histograms[name] = (help_text, labels, buckets, {})
+
+    def collector(self, func): #註冊於輸出時才讀取數值的gauge
+        self._collectors.append(func)
+        return func
+
+    def inc(self, name:str, labels:tuple = (), value:float = 1):
+        values = self._counters[name][2]
+        with self._lock:
+            values[labels] = values.get(labels, 0) + value
+
+    def observe(self, name:str, labels:tuple, value:float):
+        _, _, buckets, values = self._histograms[name]
+        with self._lock:
+            counts = values.get(labels)
+            if counts is None:
+                counts = values[labels] = [0] * (len(buckets) + 2)
+            for index, bound in enumerate(buckets):
+                if value <= bound:
+                    counts[index] += 1
+            counts[-2] += value
+            counts[-1] += 1
+
+    @staticmethod
+    def _labels(names:tuple, values:tuple) -> str:
+        pairs = []
+        for name, value in zip(names, values):
+            value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+            pairs.append(f'{name}="{value}"')
+        return "{" + ",".join(pairs) + "}" if pairs else ""
+
+    async def render(self) -> str:
+        lines = []
+        with self._lock:
+            counters = {name: (help_text, labels, dict(values)) for name, (help_text, labels, values) in self._counters.items()}
+            histograms = {name: (help_text, labels, buckets, {key: list(counts) for key, counts in values.items()}) for name, (help_text, labels, buckets, values) in self._histograms.items()}
+        for name, (help_text, labels, values) in counters.items():
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} counter"]
+            lines += [f"{name}{self._labels(labels, key)} {value}" for key, value in values.items()]
+        for name, (help_text, labels, buckets, values) in histograms.items():
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} histogram"]
+            for key, counts in values.items():
+                for bound, count in zip(buckets + ("+Inf",), counts[:-2] + counts[-1:]):
+                    lines.append(f"{name}_bucket{self._labels(labels + ('le',), key + (bound,))} {count}")
+                lines.append(f"{name}_sum{self._labels(labels, key)} {round(counts[-2], 6)}")
+                lines.append(f"{name}_count{self._labels(labels, key)} {counts[-1]}")
+        for collector in self._collectors:
+            for name, metric_type, help_text, samples in await collector():
+                lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {metric_type}"]
+                lines += [f"{name}{self._labels(tuple(sample_labels), tuple(sample_labels.values()))} {value}" for sample_labels, value in samples]
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+metrics.counter("oauth_http_requests_total", "HTTP requests by route, method, status and calling bot", ("route", "method", "status", "bot"))
+metrics.histogram("oauth_http_request_duration_seconds", "HTTP request latency by route and calling bot", ("route", "method", "bot"))
+metrics.histogram("oauth_db_query_duration_seconds", "SQLite query time inside the connection pool", ("operation",))
+metrics.histogram("oauth_discord_request_duration_seconds", "Discord API latency by endpoint, including rate limit waits", ("endpoint",))
+metrics.counter("oauth_discord_responses_total", "Discord API responses by endpoint and status", ("endpoint", "status"))
+
+@web.middleware
+async def metrics_middleware(request:web.Request, handler):
+    started = time.perf_counter()
+    status = 500
+    try:
+        response = await handler(request)
+        status = response.status
+        return response
+    except web.HTTPException as e:
+        status = e.status
+        raise
+    finally:
+        resource = request.match_info.route.resource
+        route = resource.canonical if resource is not None else "unmatched" #使用路由樣板 避免每個user_id各成一組標籤
+        bot_name = request.get('bot_name', '-')
+        metrics.inc("oauth_http_requests_total", (route, request.method, str(status), bot_name))
+        metrics.observe("oauth_http_request_duration_seconds", (route, request.method, bot_name), time.perf_counter() - started)
 
 def set_route():
+    app.middlewares.extend([access_log_middleware, metrics_middleware, admission.middleware])
     app.router.add_get('/', index)
     app.router.add_get('/callback', callback)
     app.router.add_get('/close', close)
@@ -50,27 +228,962 @@ def set_route():
     app.router.add_get('/user/{user_id}', get_user)
     app.router.add_get('/authing', authing)
     app.router.add_get('/all_user', get_all_user)
+    app.router.add_post('/users/batch', get_users_batch)
+    app.router.add_get('/users/changes', get_user_changes)
+    app.router.add_post('/guilds/batch', get_guilds_batch)
     app.router.add_delete('/delete_user/{user_id}', delete_user)
+    app.router.add_get('/delete_user_status/{job_id}', delete_user_status)
     app.router.add_post('/add_guild', add_guild)
     app.router.add_delete('/delete_guild_data', delete_guild_data)
     app.router.add_post('/add_user_to_server/{user_id}', add_user_to_server)
     app.router.add_get('/get_guild_auth_role_data/{guild_id}', get_guild_auth_role_data)
     app.router.add_get('/get_auth_role_data/{role_data}', get_auth_role_data)
+    app.router.add_post('/reverify/{guild_id}', start_reverification)
+    app.router.add_get('/reverify/{guild_id}', get_reverification_status)
+    app.router.add_get('/metrics', get_metrics)
 
-def check_api_key(request): #檢查API_KEY是否符合
-    provided_key = request.headers.get('X-API-KEY')
-    with sqlite3.connect(AUTH_BOTS_DATABASE) as conn:
-        cursor = conn.cursor()
-        bot = cursor.execute("SELECT * FROM bot WHERE botKey = ?", (provided_key,)).fetchone()
-        if bot:
-            bot_name = bot[0]
-            api_key = bot[2]
-            logger(request, bot_name)
-            return hmac.compare_digest(provided_key, api_key)
+#==================資料庫連線池==================
+class Database: #以少量長期連線在背景執行緒執行查詢 避免阻塞事件迴圈
+    def __init__(self, path:str, pool_size:int = 4):
+        self.path = path
+        self.pool_size = pool_size
+        self._executor = ThreadPoolExecutor(max_workers=pool_size, thread_name_prefix="db")
+        self._local = threading.local()
+        self._connections = []
+        self._connections_lock = threading.Lock()
+        self.pending = 0 #已送出但尚未完成的查詢數
+
+    @property
+    def waiting(self) -> int: #連線池執行緒都在忙碌時排隊等待的查詢數
+        return max(self.pending - self.pool_size, 0)
+
+    def _connection(self) -> sqlite3.Connection: #每個連線池執行緒各自持有一條連線
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, cached_statements=256, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA busy_timeout=30000")
+            self._local.conn = conn
+            with self._connections_lock:
+                self._connections.append(conn)
+        return conn
+
+    def _execute(self, sql:str, params:tuple, fetch:str = None):
+        conn = self._connection()
+        started = time.perf_counter()
+        try:
+            cursor = conn.execute(sql, params)
+            if fetch == "one":
+                result = cursor.fetchone()
+            elif fetch == "all":
+                result = cursor.fetchall()
+            else:
+                result = cursor.rowcount
+            conn.commit()
+            return result
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            metrics.observe("oauth_db_query_duration_seconds", (fetch or "execute",), time.perf_counter() - started)
+
+    def _transaction(self, func):
+        conn = self._connection()
+        started = time.perf_counter()
+        try:
+            result = func(conn)
+            conn.commit()
+            return result
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            metrics.observe("oauth_db_query_duration_seconds", ("transaction",), time.perf_counter() - started)
+
+    async def _submit(self, func, *args):
+        loop = asyncio.get_running_loop()
+        self.pending += 1
+        try:
+            return await loop.run_in_executor(self._executor, func, *args)
+        finally:
+            self.pending -= 1
+
+    async def fetchone(self, sql:str, params:tuple = ()):
+        return await self._submit(self._execute, sql, params, "one")
+
+    async def fetchall(self, sql:str, params:tuple = ()):
+        return await self._submit(self._execute, sql, params, "all")
+
+    async def execute(self, sql:str, params:tuple = ()) -> int:
+        return await self._submit(self._execute, sql, params)
+
+    async def transaction(self, func): #func(conn)於同一連線內執行並提交
+        return await self._submit(self._transaction, func)
+
+    def migrate(self): #依PRAGMA user_version執行尚未套用的遷移
+        def apply():
+            conn = self._connection()
+            version = conn.execute("PRAGMA user_version").fetchone()[0]
+            for target, migration in MIGRATIONS:
+                if target <= version:
+                    continue
+                conn.execute("BEGIN IMMEDIATE")
+                try:
+                    migration(conn)
+                    conn.execute(f"PRAGMA user_version = {target}")
+                    conn.commit()
+                except Exception:
+                    conn.rollback()
+                    raise
+                logging.info(f"Applied database migration {target}: {migration.__name__}")
+        self._executor.submit(apply).result()
+
+    def verify_schema(self): #啟動時檢查必要的索引是否存在
+        rows = self._executor.submit(self._execute, "SELECT name FROM sqlite_master WHERE type = 'index'", (), "all").result()
+        missing = set(EXPECTED_INDEXES) - {row[0] for row in rows}
+        if missing:
+            raise RuntimeError(f"Database {self.path} is missing indexes: {', '.join(sorted(missing))}")
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+        with self._connections_lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections.clear()
+
+#==================資料庫遷移==================
+def parse_legacy_timestamp(value) -> int: #將舊版以文字儲存的datetime轉為epoch秒
+    if value is None or isinstance(value, (int, float)):
+        return int(value or 0)
+    for fmt in ("%Y-%m-%d %H:%M:%S.%f", "%Y-%m-%d %H:%M:%S"):
+        try:
+            return int(datetime.datetime.strptime(value, fmt).timestamp())
+        except ValueError:
+            continue
+    return 0
+
+def migration_baseline(conn):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS users (
+            id TEXT PRIMARY KEY,
+            username TEXT,
+            discriminator TEXT,
+            access_token TEXT,
+            refresh_token TEXT,
+            expires_at TIMESTAMP
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS guild (
+            guild_id NUMERIC NOT NULL,
+            unauth_role_id NUMERIC NOT NULL,
+            auth_role_id NUMERIC NOT NULL,
+            reauth_day NUMERIC NOT NULL
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS is_authing (
+            user_id TEXT PRIMARY KEY,
+            guild_id TEXT,
+            guild_name TEXT
+        )
+    """)
+
+def migration_auth_jobs(conn):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS auth_jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id TEXT NOT NULL,
+            payload TEXT NOT NULL,
+            stage TEXT,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            last_error TEXT,
+            created_at REAL NOT NULL,
+            updated_at REAL NOT NULL
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_auth_jobs_status ON auth_jobs (status, id)")
+
+def migration_epoch_expiry(conn): #expires_at改為epoch整數並建立索引
+    conn.execute("""
+        CREATE TABLE users_new (
+            id TEXT PRIMARY KEY,
+            username TEXT,
+            discriminator TEXT,
+            access_token TEXT,
+            refresh_token TEXT,
+            expires_at INTEGER NOT NULL DEFAULT 0
+        )
+    """)
+    rows = conn.execute("SELECT id, username, discriminator, access_token, refresh_token, expires_at FROM users").fetchall()
+    conn.executemany(
+        "INSERT INTO users_new (id, username, discriminator, access_token, refresh_token, expires_at) VALUES (?, ?, ?, ?, ?, ?)",
+        [(*row[:5], parse_legacy_timestamp(row[5])) for row in rows]
+    )
+    conn.execute("DROP TABLE users")
+    conn.execute("ALTER TABLE users_new RENAME TO users")
+    conn.execute("CREATE INDEX idx_users_expires_at ON users (expires_at)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_guild_guild_id ON guild (guild_id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_guild_roles ON guild (unauth_role_id, auth_role_id)")
+
+def migration_reverification(conn): #記錄使用者在各伺服器的驗證時間 供reauth_day重新驗證使用
+    conn.execute("""
+        CREATE TABLE guild_auth (
+            guild_id NUMERIC NOT NULL,
+            user_id TEXT NOT NULL,
+            authorized_at INTEGER NOT NULL,
+            PRIMARY KEY (guild_id, user_id)
+        )
+    """)
+    conn.execute("CREATE INDEX idx_guild_auth_authorized_at ON guild_auth (guild_id, authorized_at)")
+    #既有使用者沒有驗證時間紀錄 以遷移時間作為起點
+    conn.execute("INSERT INTO guild_auth (guild_id, user_id, authorized_at) SELECT ?, id, ? FROM users", (MAIN_GUILD_ID, int(time.time())))
+    conn.execute("""
+        CREATE TABLE reverify_runs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            guild_id NUMERIC NOT NULL,
+            status TEXT NOT NULL,
+            started_at INTEGER NOT NULL,
+            last_user_id TEXT NOT NULL DEFAULT '',
+            total INTEGER NOT NULL DEFAULT 0,
+            processed INTEGER NOT NULL DEFAULT 0,
+            failed INTEGER NOT NULL DEFAULT 0,
+            updated_at INTEGER NOT NULL
+        )
+    """)
+    conn.execute("CREATE INDEX idx_reverify_runs_guild ON reverify_runs (guild_id, id)")
+
+def migration_user_version(conn): #每次寫入使用者時更新updated_at 作為ETag的依據
+    conn.execute("ALTER TABLE users ADD COLUMN updated_at INTEGER NOT NULL DEFAULT 0")
+    conn.execute("UPDATE users SET updated_at = ?", (time.time_ns() // 1000,))
+    conn.execute("CREATE INDEX idx_users_updated_at ON users (updated_at)")
+
+def migration_worker_coordination(conn): #多worker模式共用的租約、快取版本與背景刪除工作狀態
+    conn.execute("""
+        CREATE TABLE leases (
+            name TEXT PRIMARY KEY,
+            owner TEXT NOT NULL,
+            expires_at REAL NOT NULL
+        )
+    """)
+    conn.execute("CREATE INDEX idx_leases_owner ON leases (owner)")
+    conn.execute("""
+        CREATE TABLE shared_versions (
+            name TEXT PRIMARY KEY,
+            version INTEGER NOT NULL
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE deletion_jobs (
+            job_id TEXT PRIMARY KEY,
+            user_id TEXT NOT NULL,
+            status TEXT NOT NULL,
+            started_at REAL NOT NULL,
+            finished_at REAL,
+            result TEXT
+        )
+    """)
+    conn.execute("CREATE INDEX idx_deletion_jobs_started_at ON deletion_jobs (started_at)")
+    conn.execute("ALTER TABLE auth_jobs ADD COLUMN owner TEXT")
+
+def migration_user_changes(conn): #使用者的新增/更新/刪除依序記錄 供/users/changes增量同步
+    conn.execute("""
+        CREATE TABLE user_changes (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id TEXT NOT NULL,
+            op TEXT NOT NULL,
+            changed_at REAL NOT NULL
+        )
+    """)
+    conn.execute("CREATE INDEX idx_user_changes_user_id ON user_changes (user_id)")
+    conn.execute("CREATE INDEX idx_user_changes_changed_at ON user_changes (changed_at)")
+    conn.execute("""
+        CREATE TABLE change_consumers (
+            name TEXT PRIMARY KEY,
+            cursor INTEGER NOT NULL,
+            updated_at REAL NOT NULL
+        )
+    """)
+    conn.execute("INSERT INTO user_changes (user_id, op, changed_at) SELECT id, 'insert', ? FROM users ORDER BY id", (time.time(),)) #既有使用者視為新增 從0開始讀取即可取得完整資料
+
+def migration_guild_auth_backfill(conn): #先前只記錄主伺服器 依is_authing補上使用者授權時登記的伺服器 以遷移時間作為起點
+    conn.execute("""
+        INSERT OR IGNORE INTO guild_auth (guild_id, user_id, authorized_at)
+        SELECT DISTINCT CAST(a.guild_id AS INTEGER), a.user_id, ? FROM is_authing a
+        JOIN users u ON u.id = a.user_id
+        JOIN guild g ON g.guild_id = CAST(a.guild_id AS INTEGER)
+    """, (int(time.time()),))
+
+def migration_deletion_job_owner(conn): #記錄執行背景刪除的worker 行程停止後由leader接手
+    conn.execute("ALTER TABLE deletion_jobs ADD COLUMN owner TEXT")
+
+def migration_token_refresh_failures(conn): #背景刷新連續失敗的使用者 退避期間不列入刷新批次
+    conn.execute("""
+        CREATE TABLE token_refresh_failures (
+            user_id TEXT PRIMARY KEY,
+            failures INTEGER NOT NULL,
+            next_attempt_at REAL NOT NULL,
+            last_error TEXT
+        )
+    """)
+
+def migration_reverify_applied(conn): #同一伺服器有多組reauth_day不同的身分組時 記錄已套用的規則 全部套用後才刪除guild_auth
+    conn.execute("""
+        CREATE TABLE reverify_applied (
+            guild_id NUMERIC NOT NULL,
+            user_id TEXT NOT NULL,
+            unauth_role_id NUMERIC NOT NULL,
+            auth_role_id NUMERIC NOT NULL,
+            authorized_at INTEGER NOT NULL,
+            PRIMARY KEY (guild_id, user_id, unauth_role_id, auth_role_id)
+        )
+    """)
+
+MIGRATIONS = [
+    (1, migration_baseline),
+    (2, migration_auth_jobs),
+    (3, migration_epoch_expiry),
+    (4, migration_reverification),
+    (5, migration_user_version),
+    (6, migration_worker_coordination),
+    (7, migration_user_changes),
+    (8, migration_guild_auth_backfill),
+    (9, migration_deletion_job_owner),
+    (10, migration_token_refresh_failures),
+    (11, migration_reverify_applied)
+]
+
+EXPECTED_INDEXES = [
+    "idx_auth_jobs_status",
+    "idx_users_expires_at",
+    "idx_guild_guild_id",
+    "idx_guild_roles",
+    "idx_guild_auth_authorized_at",
+    "idx_reverify_runs_guild",
+    "idx_users_updated_at",
+    "idx_leases_owner",
+    "idx_deletion_jobs_started_at",
+    "idx_user_changes_user_id",
+    "idx_user_changes_changed_at"
+]
+
+def format_expires_at(expires_at:int) -> str: #API回應維持原本的時間字串格式
+    return datetime.datetime.fromtimestamp(expires_at).strftime("%Y-%m-%d %H:%M:%S.%f")
+
+def row_version() -> int: #微秒時間戳 寫入users時作為updated_at
+    return time.time_ns() // 1000
+
+db = Database(DATABASE)
+
+#==================跨行程租約==================
+class LeaseStore: #以leases資料表在多個worker行程間協調 同一名稱同一時間只有一個持有者 持有者停止續約後於到期時自動釋放
+    def __init__(self, database:Database, owner:str):
+        self.db = database
+        self.owner = owner
+
+    async def acquire(self, name:str, ttl:float = LEASE_TTL) -> bool: #取得或續約 已由其他持有者持有且未到期時回傳False
+        now = time.time()
+        acquired = await self.db.execute(
+            "INSERT INTO leases (name, owner, expires_at) VALUES (?, ?, ?) "
+            "ON CONFLICT(name) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at "
+            "WHERE leases.expires_at <= ? OR leases.owner = excluded.owner",
+            (name, self.owner, now + ttl, now)
+        )
+        return acquired == 1
+
+    async def release(self, name:str):
+        await self.db.execute("DELETE FROM leases WHERE name = ? AND owner = ?", (name, self.owner))
+
+    async def renew_all(self, ttl:float = LEASE_TTL) -> int: #延長此行程持有的所有租約
+        return await self.db.execute("UPDATE leases SET expires_at = ? WHERE owner = ?", (time.time() + ttl, self.owner))
+
+    async def release_all(self):
+        await self.db.execute("DELETE FROM leases WHERE owner = ?", (self.owner,))
+
+    async def held(self, name:str) -> bool:
+        return await self.db.fetchone("SELECT 1 FROM leases WHERE name = ? AND expires_at > ?", (name, time.time())) is not None
+
+    async def block(self, name:str, until:float): #發布到期時間 不屬於任何行程 不會被續約
+        await self.db.execute(
+            "INSERT INTO leases (name, owner, expires_at) VALUES (?, '', ?) "
+            "ON CONFLICT(name) DO UPDATE SET expires_at = MAX(leases.expires_at, excluded.expires_at)",
+            (name, until)
+        )
+
+    async def active(self, prefix:str) -> dict: #{名稱(去除prefix): 到期時間}
+        rows = await self.db.fetchall(
+            "SELECT name, expires_at FROM leases WHERE name >= ? AND name < ? AND expires_at > ?", (prefix, prefix + "\uffff", time.time())
+        )
+        return {name[len(prefix):]: expires_at for name, expires_at in rows}
+
+    async def prune(self, grace:float = 60):
+        await self.db.execute("DELETE FROM leases WHERE expires_at <= ?", (time.time() - grace,))
+
+leases = LeaseStore(db, owner=f"{socket.gethostname()}:{os.getpid()}")
+
+#==================伺服器身分組設定快取==================
+def to_snowflake(value): #URL或JSON中的ID轉為與guild資料表相同的整數型別
+    value = str(value)
+    return int(value) if value.isdigit() else None
+
+class GuildConfigCache: #guild資料表很小且很少變動 整張表載入記憶體 寫入時失效並以TTL作為保險
+    def __init__(self, database:Database, ttl:float = 300):
+        self.db = database
+        self.ttl = ttl
+        self._rows = []
+        self._by_guild = {}
+        self._by_roles = {}
+        self._etags = {}
+        self._loaded_at = None
+        self._version = 0
+        self._lock = asyncio.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.reloads = 0
+        self.invalidations = 0
+
+    def invalidate(self):
+        self._version += 1
+        self._loaded_at = None
+        self.invalidations += 1
+
+    def _fresh(self) -> bool:
+        return self._loaded_at is not None and time.monotonic() - self._loaded_at < self.ttl
+
+    async def _ensure_loaded(self):
+        if self._fresh():
+            self.hits += 1
+            return
+        self.misses += 1
+        async with self._lock:
+            if self._fresh():
+                return
+            version = self._version
+            rows = await self.db.fetchall("SELECT guild_id, unauth_role_id, auth_role_id, reauth_day FROM guild")
+            by_guild = {}
+            by_roles = {}
+            for row in rows:
+                by_guild.setdefault(row[0], []).append(row)
+                by_roles.setdefault((row[1], row[2]), row)
+            etags = {
+                guild_id: '"g-' + hashlib.sha256(repr(guild_rows).encode()).hexdigest()[:20] + '"'
+                for guild_id, guild_rows in by_guild.items()
+            }
+            self._rows, self._by_guild, self._by_roles, self._etags = rows, by_guild, by_roles, etags
+            self.reloads += 1
+            if version == self._version: #載入期間有寫入時不標記為最新 下次查詢會重新載入
+                self._loaded_at = time.monotonic()
+
+    async def all(self) -> list:
+        await self._ensure_loaded()
+        return self._rows
+
+    async def by_guild(self, guild_id) -> list:
+        await self._ensure_loaded()
+        return self._by_guild.get(to_snowflake(guild_id), [])
+
+    async def etag(self, guild_id) -> str: #由該伺服器的設定內容產生的強ETag
+        await self._ensure_loaded()
+        return self._etags.get(to_snowflake(guild_id), '"g-empty"')
+
+    async def by_roles(self, unauth_role_id, auth_role_id):
+        await self._ensure_loaded()
+        return self._by_roles.get((to_snowflake(unauth_role_id), to_snowflake(auth_role_id)))
+
+    def stats(self) -> dict:
+        return {
+            "guilds": len(self._by_guild),
+            "rows": len(self._rows),
+            "hits": self.hits,
+            "misses": self.misses,
+            "reloads": self.reloads,
+            "invalidations": self.invalidations
+        }
+
+guild_cache = GuildConfigCache(db)
+
+#==================Discord 速率限制排程==================
+class RateLimitBucket:
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        self.limit = None
+        self.remaining = None
+        self.reset_at = 0.0
+        self.queued = 0
+
+class DiscordRateLimiter: #依照Discord回傳的X-RateLimit標頭 為每個bucket排隊並主動延遲請求
+    MAJOR_PARAMETERS = ("guilds", "channels", "webhooks")
+
+    def __init__(self, global_rate:int = 50, max_buckets:int = 5000):
+        self.global_rate = global_rate
+        self.max_buckets = max_buckets
+        self._buckets = {} #bucket鍵 -> RateLimitBucket
+        self._route_buckets = {} #路由 -> Discord回傳的bucket hash
+        self._global_reset_at = 0.0
+        self._global_window = collections.deque()
+        self.waits = 0
+        self.wait_seconds_total = 0.0
+        self.max_wait_seconds = 0.0
+        self.rate_limited = 0
+        self.global_rate_limited = 0
+
+    def route(self, method:str, path:str, headers:dict = None): #回傳(路由, 主要參數)
+        path = yarl.URL(path).path if path.startswith("http") else path.split("?")[0]
+        parts = path.strip("/").split("/")
+        if parts and parts[0] == "api":
+            parts = parts[1:]
+        template = []
+        major = ""
+        for index, part in enumerate(parts):
+            if part.isdigit():
+                if not major and index > 0 and parts[index - 1] in self.MAJOR_PARAMETERS:
+                    major = part
+                template.append(":id")
+            elif index > 1 and parts[index - 2] == "webhooks":
+                template.append(":token") #webhook token
+            else:
+                template.append(part)
+        authorization = (headers or {}).get("Authorization", "")
+        if authorization.startswith("Bearer "): #使用者token的速率限制以token為單位
+            major = "bearer:" + hashlib.sha256(authorization.encode()).hexdigest()[:16]
+        return f"{method.upper()} /{'/'.join(template)}", major
+
+    def _bucket_key(self, route:str, major:str) -> str:
+        return f"{self._route_buckets.get(route, route)}:{major}"
+
+    def _bucket(self, route:str, major:str) -> RateLimitBucket:
+        key = self._bucket_key(route, major)
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            if len(self._buckets) >= self.max_buckets:
+                self._prune()
+            bucket = self._buckets[key] = RateLimitBucket()
+        return bucket
+
+    def _prune(self):
+        now = time.monotonic()
+        for key, bucket in list(self._buckets.items()):
+            if bucket.queued == 0 and bucket.reset_at <= now and not bucket.lock.locked():
+                del self._buckets[key]
+
+    async def _wait_global(self, bot_request:bool):
+        while True:
+            now = time.monotonic()
+            wait = self._global_reset_at - now
+            if bot_request:
+                while self._global_window and now - self._global_window[0] >= 1:
+                    self._global_window.popleft()
+                if len(self._global_window) >= self.global_rate:
+                    wait = max(wait, 1 - (now - self._global_window[0]))
+            if wait <= 0:
+                break
+            await asyncio.sleep(wait)
+        if bot_request:
+            self._global_window.append(time.monotonic())
+
+    async def acquire(self, route:str, major:str, bot_request:bool = True): #等待直到該bucket可以發送請求
+        bucket = self._bucket(route, major)
+        bucket.queued += 1
+        start = time.monotonic()
+        try:
+            async with bucket.lock:
+                while True:
+                    now = time.monotonic()
+                    if bucket.remaining == 0 and bucket.reset_at > now:
+                        await asyncio.sleep(bucket.reset_at - now)
+                        continue
+                    if bucket.reset_at <= now and bucket.limit is not None:
+                        bucket.remaining = bucket.limit
+                    break
+                if bucket.remaining:
+                    bucket.remaining -= 1
+                await self._wait_global(bot_request)
+        finally:
+            bucket.queued -= 1
+        waited = time.monotonic() - start
+        if waited > 0.001:
+            self.waits += 1
+            self.wait_seconds_total += waited
+            self.max_wait_seconds = max(self.max_wait_seconds, waited)
+        return waited
+
+    def update(self, route:str, major:str, status:int, headers) -> float: #依回應標頭更新bucket 若為429則回傳需等待的秒數
+        bucket_hash = headers.get("X-RateLimit-Bucket")
+        if bucket_hash and self._route_buckets.get(route) != bucket_hash:
+            old_key = self._bucket_key(route, major)
+            self._route_buckets[route] = bucket_hash
+            new_key = self._bucket_key(route, major)
+            if new_key not in self._buckets and old_key in self._buckets:
+                self._buckets[new_key] = self._buckets[old_key]
+        bucket = self._bucket(route, major)
+        now = time.monotonic()
+        if "X-RateLimit-Limit" in headers:
+            bucket.limit = int(headers["X-RateLimit-Limit"])
+        if "X-RateLimit-Remaining" in headers:
+            bucket.remaining = int(headers["X-RateLimit-Remaining"])
+        if "X-RateLimit-Reset-After" in headers:
+            bucket.reset_at = now + float(headers["X-RateLimit-Reset-After"])
+        if status != 429:
+            return 0.0
+        self.rate_limited += 1
+        retry_after = float(headers.get("Retry-After", 1))
+        if headers.get("X-RateLimit-Global") == "true" or headers.get("X-RateLimit-Scope") == "global":
+            self.global_rate_limited += 1
+            self._global_reset_at = now + retry_after
         else:
-            bot_name = "Anonymous"
-            logger(request, bot_name, WARN)
+            bucket.remaining = 0
+            bucket.reset_at = max(bucket.reset_at, now + retry_after)
+        return retry_after
+
+    def blocked(self, route:str, major:str) -> dict: #回傳目前已用盡的bucket與全域限制 {bucket鍵: 剩餘秒數} 供其他worker套用
+        now = time.monotonic()
+        blocked = {}
+        key = self._bucket_key(route, major)
+        bucket = self._buckets.get(key)
+        if bucket is not None and bucket.remaining == 0 and bucket.reset_at > now:
+            blocked[key] = bucket.reset_at - now
+        if self._global_reset_at > now:
+            blocked["global"] = self._global_reset_at - now
+        return blocked
+
+    def apply_blocks(self, blocks:dict): #套用其他worker發布的限制 {bucket鍵: 剩餘秒數}
+        now = time.monotonic()
+        for key, seconds in blocks.items():
+            if key == "global":
+                self._global_reset_at = max(self._global_reset_at, now + seconds)
+                continue
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                if len(self._buckets) >= self.max_buckets:
+                    self._prune()
+                bucket = self._buckets[key] = RateLimitBucket()
+            if bucket.reset_at < now + seconds:
+                bucket.remaining = 0
+                bucket.reset_at = now + seconds
+
+    def stats(self) -> dict:
+        now = time.monotonic()
+        buckets = {
+            key: {
+                "queued": bucket.queued,
+                "remaining": bucket.remaining,
+                "reset_after": round(max(bucket.reset_at - now, 0), 3)
+            }
+            for key, bucket in self._buckets.items() if bucket.queued or bucket.reset_at > now
+        }
+        return {
+            "queued": sum(bucket.queued for bucket in self._buckets.values()),
+            "waits": self.waits,
+            "wait_seconds_total": round(self.wait_seconds_total, 3),
+            "max_wait_seconds": round(self.max_wait_seconds, 3),
+            "rate_limited": self.rate_limited,
+            "global_rate_limited": self.global_rate_limited,
+            "buckets": buckets
+        }
+
+#==================Discord HTTP 連線池==================
+class DiscordHTTP: #應用程式共用的Discord API連線 保持keep-alive以重用TCP/TLS連線
+    def __init__(self, base_url:str, limit:int = 100, limit_per_host:int = 50, timeout:float = 15, keepalive_timeout:float = 30, max_retries:int = 5, global_rate:int = DISCORD_GLOBAL_RATE):
+        self.base_url = base_url.rstrip("/")
+        self.max_retries = max_retries
+        self.rate_limiter = DiscordRateLimiter(global_rate=global_rate)
+        self.shared_leases:LeaseStore = None #多worker模式下將用盡的bucket發布給其他worker
+        self._published = {}
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.timeout = timeout
+        self.keepalive_timeout = keepalive_timeout
+        self.session:ClientSession = None
+
+    async def start(self):
+        if self.session is not None and not self.session.closed:
+            return
+        connector = TCPConnector(
+            limit=self.limit,
+            limit_per_host=self.limit_per_host,
+            ttl_dns_cache=300,
+            keepalive_timeout=self.keepalive_timeout
+        )
+        self.session = ClientSession(connector=connector, timeout=ClientTimeout(total=self.timeout))
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    def _url(self, path:str) -> str:
+        return path if path.startswith("http") else self.base_url + path
+
+    async def request(self, method:str, path:str, **kwargs): #回傳已讀取完內容的回應 可直接使用status/headers/json()
+        headers = kwargs.get("headers") or {}
+        route, major = self.rate_limiter.route(method, path, headers)
+        bot_request = headers.get("Authorization", "").startswith("Bot ")
+        for attempt in range(self.max_retries + 1):
+            started = time.perf_counter()
+            await self.rate_limiter.acquire(route, major, bot_request)
+            async with self.session.request(method, self._url(path), **kwargs) as response:
+                await response.read()
+            metrics.observe("oauth_discord_request_duration_seconds", (route,), time.perf_counter() - started)
+            metrics.inc("oauth_discord_responses_total", (route, str(response.status)))
+            retry_after = self.rate_limiter.update(route, major, response.status, response.headers)
+            if self.shared_leases is not None:
+                await self._publish_blocks(route, major)
+            if response.status != 429 or attempt == self.max_retries:
+                return response
+            logging.warning(f"Discord rate limited {route}, retrying after {retry_after} s")
+
+    async def _publish_blocks(self, route:str, major:str):
+        now = time.time()
+        for key, seconds in self.rate_limiter.blocked(route, major).items():
+            until = now + seconds
+            if abs(self._published.get(key, 0) - until) < 0.05: #同一次限制已發布過
+                continue
+            self._published[key] = until
+            try:
+                await self.shared_leases.block(f"ratelimit:{key}", until)
+            except Exception as e:
+                logging.warning(f"Failed to publish rate limit for {key}: {e!r}")
+        if len(self._published) > 1000:
+            self._published = {key: until for key, until in self._published.items() if until > now}
+
+#多worker時平均分配全域每秒請求數 各bucket的剩餘次數則由Discord回應標頭與共用的限制同步
+discord_http = DiscordHTTP(
+    DISCORD_API_BASE, limit=DISCORD_HTTP_LIMIT, limit_per_host=DISCORD_HTTP_LIMIT_PER_HOST, timeout=DISCORD_HTTP_TIMEOUT,
+    global_rate=max(1, DISCORD_GLOBAL_RATE // OAUTH_WORKERS)
+)
+
+class AuthorizationRevoked(Exception):
+    pass
+
+class TokenRefreshBusy(Exception): #其他worker持有刷新租約太久 暫時無法取得新的token
+    pass
+
+class UserNotFound(Exception): #資料庫中沒有該使用者的授權資料
+    pass
+
+#==================API金鑰快取==================
+BotLimits = collections.namedtuple("BotLimits", ["rate_limit", "burst", "max_concurrency"]) #None表示使用預設值
+
+class BotKeyRegistry: #將bot.db的金鑰載入記憶體 依TTL或檔案修改時間自動重新載入
+    def __init__(self, database:str, ttl:float = 30.0):
+        self.database = database
+        self.ttl = ttl
+        self._index = {} #sha256(金鑰) -> (機器人名稱, 金鑰, BotLimits)
+        self._lock = threading.Lock()
+        self._mtime = None
+        self._checked_at = 0.0
+        self.hits = 0
+        self.misses = 0
+        self.reloads = 0
+
+    @staticmethod
+    def _digest(api_key:str) -> str:
+        return hashlib.sha256(api_key.encode()).hexdigest()
+
+    def _columns(self, conn) -> list:
+        return [column[1] for column in conn.execute("PRAGMA table_info(bot)").fetchall()]
+
+    def _ensure_limit_columns(self, conn) -> list: #舊的bot資料表沒有限制欄位時補上
+        columns = self._columns(conn)
+        for name, column_type in (("rate_limit", "REAL"), ("burst", "INTEGER"), ("max_concurrency", "INTEGER")):
+            if name not in columns:
+                try:
+                    conn.execute(f"ALTER TABLE bot ADD COLUMN {name} {column_type}")
+                except sqlite3.OperationalError: #其他worker已先新增
+                    pass
+                columns.append(name)
+        return columns
+
+    def reload(self):
+        with sqlite3.connect(self.database) as conn:
+            columns = self._ensure_limit_columns(conn)
+            rows = conn.execute("SELECT * FROM bot").fetchall()
+        positions = [columns.index(name) for name in BotLimits._fields]
+        index = {}
+        for row in rows:
+            if row[2]:
+                index[self._digest(row[2])] = (row[0], row[2], BotLimits(*(row[position] for position in positions)))
+        with self._lock:
+            self._index = index
+            self._mtime = self._current_mtime()
+            self._checked_at = time.monotonic()
+            self.reloads += 1
+
+    def _current_mtime(self):
+        try:
+            return os.stat(self.database).st_mtime_ns
+        except OSError:
+            return None
+
+    def _stale(self) -> bool: #每ttl秒最多檢查一次bot.db的修改時間
+        now = time.monotonic()
+        if now - self._checked_at < self.ttl:
             return False
+        self._checked_at = now
+        return self._current_mtime() != self._mtime
+
+    def _refresh_if_stale(self):
+        if self._stale():
+            self.reload()
+
+    async def resolve(self, provided_key:str): #與lookup相同 但重新載入在執行緒中進行 不阻塞事件迴圈
+        if provided_key and self._stale():
+            await asyncio.get_running_loop().run_in_executor(executor, self.reload)
+        return self.lookup(provided_key)
+
+    def lookup(self, provided_key:str): #回傳(機器人名稱, 金鑰, BotLimits) 找不到則回傳None
+        if not provided_key:
+            self.misses += 1
+            return None
+        self._refresh_if_stale()
+        entry = self._index.get(self._digest(provided_key))
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry
+
+    def stats(self) -> dict:
+        return {
+            "keys": len(self._index),
+            "hits": self.hits,
+            "misses": self.misses,
+            "reloads": self.reloads
+        }
+
+key_registry = BotKeyRegistry(AUTH_BOTS_DATABASE)
+
+#==================請求准入控制==================
+class TokenBucket:
+    def __init__(self, rate:float, burst:float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated_at = time.monotonic()
+
+    def take(self, cost:float) -> float: #成功時回傳0 額度不足時回傳需等待的秒數
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+        cost = min(cost, self.burst)
+        if self.tokens >= cost:
+            self.tokens -= cost
+            return 0.0
+        return (cost - self.tokens) / self.rate
+
+class AdmissionController: #依API金鑰的token bucket額度與每個路由的同時請求上限決定是否受理 事件迴圈延遲過高時先拒絕低優先度路由
+    ROUTE_COSTS = {"/all_user": 10, "/users/batch": 5, "/guilds/batch": 5, "/reverify/{guild_id}": 5}
+    ROUTE_PRIORITY = { #0最先被拒絕 未列出的路由為1 2永不拒絕
+        "/all_user": 0, "/users/batch": 0, "/guilds/batch": 0, "/reverify/{guild_id}": 0, "/delete_user_status/{job_id}": 0, "/users/changes": 0,
+        "/": 2, "/callback": 2, "/close": 2, "/web_auth_error": 2
+    }
+
+    def __init__(self, registry:BotKeyRegistry, shed_lag:float = 0.25, workers:int = 1, lag_interval:float = 0.1):
+        self.registry = registry
+        self.shed_lag = shed_lag
+        self.workers = workers #多worker時每個worker只分配到1/workers的額度
+        self.lag_interval = lag_interval
+        self.lag = 0.0 #事件迴圈延遲的指數移動平均(秒)
+        self._buckets = {} #金鑰 -> TokenBucket
+        self._in_flight = collections.Counter() #(金鑰, 路由) -> 進行中的請求數
+        self._task:asyncio.Task = None
+        self.rejected = collections.Counter() #(機器人名稱, 路由, 原因) -> 次數
+
+    async def start(self):
+        self._task = asyncio.create_task(self._monitor_lag())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _monitor_lag(self):
+        while True:
+            started = time.monotonic()
+            await asyncio.sleep(self.lag_interval)
+            delay = max(time.monotonic() - started - self.lag_interval, 0)
+            self.lag = self.lag * 0.8 + delay * 0.2 #平滑處理 只在持續延遲時才拒絕
+
+    def shed_level(self) -> int: #回傳目前拒絕的最高優先度 -1表示不拒絕
+        if self.lag >= self.shed_lag * 2:
+            return 1
+        if self.lag >= self.shed_lag:
+            return 0
+        return -1
+
+    def _bucket(self, api_key:str, limits:BotLimits) -> TokenBucket: #rate或burst為0時不限制 回傳None
+        rate = limits.rate_limit if limits.rate_limit is not None else ADMISSION_DEFAULT_RATE
+        burst = limits.burst if limits.burst is not None else ADMISSION_DEFAULT_BURST
+        if rate <= 0 or burst <= 0:
+            self._buckets.pop(api_key, None)
+            return None
+        rate, burst = rate / self.workers, max(burst / self.workers, 1)
+        bucket = self._buckets.get(api_key)
+        if bucket is None:
+            bucket = self._buckets[api_key] = TokenBucket(rate, burst)
+        else: #bot資料表更新後套用新的限制
+            bucket.rate, bucket.burst = rate, burst
+        return bucket
+
+    def _reject(self, request:web.Request, route:str, reason:str, status:int, retry_after:float, message:str):
+        self.rejected[(request.get('bot_name', '-'), route or "unmatched", reason)] += 1
+        return web.json_response(
+            {"error": message, "retry_after": round(retry_after, 3)}, status=status, headers={"Retry-After": str(max(1, int(retry_after + 0.999)))}
+        )
+
+    @web.middleware
+    async def middleware(self, request:web.Request, handler):
+        resource = request.match_info.route.resource
+        route = resource.canonical if resource is not None else None
+        entry = request['api_key_entry'] = await self.registry.resolve(request.headers.get('X-API-KEY')) #check_api_key沿用 不重複查詢
+        if entry is not None:
+            request['bot_name'] = entry[0]
+        if self.ROUTE_PRIORITY.get(route, 1) <= self.shed_level():
+            return self._reject(request, route, "shed", 503, 1.0, "Server is overloaded, please retry later")
+        if entry is None or route is None: #金鑰無效時由各端點回傳403
+            return await handler(request)
+        _, api_key, limits = entry
+        bucket = self._bucket(api_key, limits)
+        cost = self.ROUTE_COSTS.get(route, 1) * (2 if request.query.get('ensure') == 'True' else 1)
+        if bucket is not None:
+            wait = bucket.take(cost)
+            if wait > 0:
+                return self._reject(request, route, "quota", 429, wait, "API key quota exceeded")
+        key = (api_key, route)
+        max_concurrency = limits.max_concurrency if limits.max_concurrency is not None else ADMISSION_DEFAULT_CONCURRENCY
+        if max_concurrency > 0 and self._in_flight[key] >= max_concurrency:
+            return self._reject(request, route, "concurrency", 429, 1.0, "Too many concurrent requests for this route")
+        self._in_flight[key] += 1
+        try:
+            return await handler(request)
+        finally:
+            self._in_flight[key] -= 1
+            if self._in_flight[key] <= 0:
+                del self._in_flight[key]
+
+    def stats(self) -> dict:
+        return {
+            "event_loop_lag": round(self.lag, 4),
+            "shed_level": self.shed_level(),
+            "in_flight": sum(self._in_flight.values()),
+            "rejected": sum(self.rejected.values())
+        }
+
+admission = AdmissionController(key_registry, shed_lag=ADMISSION_SHED_LAG, workers=OAUTH_WORKERS)
+
+def check_api_key(request): #檢查API_KEY是否符合
+    provided_key = request.headers.get('X-API-KEY')
+    bot = request['api_key_entry'] if 'api_key_entry' in request else key_registry.lookup(provided_key) #准入中介層已查詢過時沿用結果
+    if bot:
+        bot_name, api_key, _ = bot
+        request['bot_name'] = bot_name
+        return hmac.compare_digest(provided_key, api_key)
+    else:
+        request['bot_name'] = "Anonymous"
+        return False
 
 async def index(request):
     return web.HTTPFound(
@@ -79,7 +1192,7 @@ async def index(request):
 
 async def callback(request):
     #guild_id = request.match_info['guild_id']
-    logger(request, bot_name="Oauth Callback")
+    request['bot_name'] = "Oauth Callback"
     code = request.query.get('code')
     data = {
         'client_id': CLIENT_ID,
@@ -92,32 +1205,25 @@ async def callback(request):
     headers = {
         'Content-Type': 'application/x-www-form-urlencoded'
     }
-    async with ClientSession() as session:
-        async with session.post('https://discord.com/api/oauth2/token', data=data, headers=headers) as response:
-            try:
-                response.raise_for_status()
+    try:
+        response = await discord_http.request('POST', '/oauth2/token', data=data, headers=headers)
+        response.raise_for_status()
 
-                token_info = await response.json()
-                token = token_info['access_token']
-                async with session.get('https://discord.com/api/users/@me', headers={
-                    'Authorization': f"Bearer {token}"
-                }) as response:
-                    response.raise_for_status()
-                    user = await response.json()
-            except Exception as e:
-                logger(request = request, bot_name = "Oauth Callback", level = WARN)
-                raise web.HTTPFound('/web_auth_error')
-    loop = asyncio.get_event_loop()
-    loop.run_in_executor(executor, add_user_task, user, token_info)
+        token_info = await response.json()
+        token = token_info['access_token']
+        response = await discord_http.request('GET', '/users/@me', headers={
+            'Authorization': f"Bearer {token}"
+        })
+        response.raise_for_status()
+        user = await response.json()
+    except Exception as e:
+        logging.warning(f"OAuth callback failed: {e!r}")
+        raise web.HTTPFound('/web_auth_error')
+    token_verifier.record(user['id'], token)
+    await auth_job_queue.enqueue(user, token_info)
     raise web.HTTPFound('/close')
 
-def add_user_task(user, token_info):
-    save_user_to_db(user, token_info)
-    AddUserToServer(user_id=user['id'])
-    send_webhook_msg(user=user)
-    change_user_nickname(user=user)
-
-def send_webhook_msg(user:dict):
+async def send_webhook_msg(user:dict):
     user_id = user['id']
     email = user['email']
     user_name = user['username']
@@ -131,19 +1237,16 @@ def send_webhook_msg(user:dict):
     embed.add_embed_field(name="使用者ID", value=user_id)
     embed.add_embed_field(name="電子郵件", value=email)
 
-    with sqlite3.connect(DATABASE) as conn:
-        cursor = conn.cursor()
-        user_authing_guild = cursor.execute('SELECT * FROM is_authing WHERE user_id = ?',(user_id,)).fetchone()
-        user_authing_guild_id = user_authing_guild[1] if user_authing_guild[1] != '' else None
-        user_authing_guild_name = user_authing_guild[2] if user_authing_guild[2] != '' else None
+    user_authing_guild = await db.fetchone('SELECT * FROM is_authing WHERE user_id = ?',(user_id,))
+    user_authing_guild_id = user_authing_guild[1] if user_authing_guild and user_authing_guild[1] != '' else None
+    user_authing_guild_name = user_authing_guild[2] if user_authing_guild and user_authing_guild[2] != '' else None
 
     embed.add_embed_field(name="授權的伺服器", value=user_authing_guild_name)
     embed.add_embed_field(name="授權的伺服器ID", value=user_authing_guild_id)
     embed.add_embed_field(name="頭像",value=user_avatar, inline=False)
     embed.add_embed_field(name="橫幅", value=user_banner)
     embed.set_thumbnail("https://cdn.discordapp.com/avatars/{}/{}.png?size=480&quot".format(user_id, user['avatar']))
-    webhook.add_embed(embed)
-    webhook.execute()
+    audit_log.emit(embed)
 
 async def close(request):
     return web.Response(text='''
@@ -172,43 +1275,51 @@ async def web_auth_error(request):
         '''
         , content_type='text/html')
 
+def etag_matches(request, etag:str) -> bool: #If-None-Match比對(弱比較)
+    header = request.headers.get('If-None-Match')
+    if not header:
+        return False
+    candidates = [candidate.strip().removeprefix('W/') for candidate in header.split(',')]
+    return '*' in candidates or etag in candidates
+
 async def get_user(request):
     user_id = request.match_info['user_id']
     ensure = bool(request.query.get('ensure', 'False') == 'True')
     if not check_api_key(request):
         return web.json_response({"error": "Invalid API key"}, status=403)
+    try:
+        max_age = min(float(request.query.get('max_age', ENSURE_MAX_AGE)), ENSURE_MAX_AGE_LIMIT)
+    except ValueError:
+        return web.json_response({"error": "max_age must be a number"}, status=400)
     
-    with sqlite3.connect(DATABASE) as conn:
-        cursor = conn.cursor()
-        user = cursor.execute("SELECT * FROM users WHERE id = ?", (user_id,)).fetchone()
-        if user: 
-            try:
-                if ensure:
-                    access_token = user[3]
-                    expires_at = user[5]
-                    if datetime.datetime.now() >= datetime.datetime.strptime(expires_at,"%Y-%m-%d %H:%M:%S.%f"):
-                        refresh_token_if_expired(user_id)
-                    async with ClientSession() as session:
-                        async with session.get('https://discord.com/api/users/@me', headers={
-                            'Authorization': f"Bearer {access_token}"
-                        }) as response:
-                            response.raise_for_status()
-                else:
-                    refresh_token_if_expired(user_id)
-            except Exception as e:
-                await delete_user(request)
-                return web.json_response({"message": "Found user authorization data, but the user has manually revoked authorization."}, status=403)
-
-            return web.json_response({
-                'id': user[0],
-                'username': user[1],
-                'discriminator': user[2],
-                'access_token': user[3],
-                'refresh_token': user[4],
-                'expires_at': user[5]
-            })
-        else:
+    user = await db.fetchone("SELECT * FROM users WHERE id = ?", (user_id,))
+    if user: 
+        try:
+            if ensure:
+                user = await token_verifier.verify(user, max_age)
+            else:
+                user = await refresh_token_if_expired(user_id, user_data=user)
+                if user is None: #刷新期間已被其他請求刪除
+                    raise UserNotFound(user_id)
+        except UserNotFound:
             return web.json_response({"error": "User not found"}, status=410)
+        except AuthorizationRevoked: #只有Discord明確回覆授權已失效時才刪除
+            await delete_user(request)
+            return web.json_response({"message": "Found user authorization data, but the user has manually revoked authorization."}, status=403)
+        except TokenRefreshBusy:
+            return web.json_response({"error": "Token refresh is in progress, please retry later"}, status=503, headers={"Retry-After": "5"})
+        except ClientResponseError as e: #Discord暫時無法使用或限速 保留使用者資料
+            status = 503 if e.status == 429 or e.status >= 500 else 502
+            return web.json_response({"error": f"Discord API returned {e.status}, authorization could not be verified"}, status=status, headers={"Retry-After": "5"})
+        except (ClientError, asyncio.TimeoutError):
+            return web.json_response({"error": "Discord API is unreachable, authorization could not be verified"}, status=503, headers={"Retry-After": "5"})
+
+        etag = f'"u{user[0]}-{user[6]}"'
+        if etag_matches(request, etag):
+            return web.Response(status=304, headers={'ETag': etag})
+        return web.json_response(user_to_dict(user), headers={'ETag': etag})
+    else:
+        return web.json_response({"error": "User not found"}, status=410)
         
 async def authing(request):
     if not check_api_key(request):
@@ -218,20 +1329,91 @@ async def authing(request):
     guild_id = request.query.get('guildid')
     guild_name = request.query.get('guildname')
 
-    with sqlite3.connect(DATABASE) as conn:
-        cursor = conn.cursor()
-        cursor.execute("INSERT OR REPLACE INTO is_authing (user_id, guild_id, guild_name) VALUES (?, ?, ?)",(user_id, guild_id, guild_name))
-        conn.commit()
+    await db.execute("INSERT OR REPLACE INTO is_authing (user_id, guild_id, guild_name) VALUES (?, ?, ?)",(user_id, guild_id, guild_name))
     return web.json_response(status=200)
 
+def user_to_dict(user) -> dict:
+    return {
+        'id': user[0],
+        'username': user[1],
+        'discriminator': user[2],
+        'access_token': user[3],
+        'refresh_token': user[4],
+        'expires_at': format_expires_at(user[5])
+    }
+
+async def iter_user_chunks(after:str = "", chunk_size:int = 500, limit:int = None): #以id作為keyset分批讀取 每次只在記憶體保留一批
+    while limit is None or limit > 0:
+        size = chunk_size if limit is None else min(chunk_size, limit)
+        rows = await db.fetchall("SELECT * FROM users WHERE id > ? ORDER BY id LIMIT ?", (after, size))
+        if rows:
+            yield rows
+        if len(rows) < size:
+            return
+        after = rows[-1][0]
+        if limit is not None:
+            limit -= len(rows)
+
+async def get_user_changes(request): #回傳cursor之後新增/更新/刪除的使用者
+    if not check_api_key(request):
+        return web.json_response({"error": "Invalid API key"}, status=403)
+    consumer = request.query.get('consumer') or None
+    since = request.query.get('since')
+    try:
+        limit = min(max(int(request.query.get('limit', 500)), 1), 1000)
+        if since not in (None, "latest"):
+            since = int(since)
+    except ValueError:
+        return web.json_response({"error": "since and limit must be integers"}, status=400)
+    try:
+        changes, next_cursor, has_more = await change_feed.read(since, limit, consumer)
+    except ChangeCursorExpired as e:
+        return web.json_response({"error": "Cursor expired, resync with /all_user", "next": e.head}, status=410)
+    return web.json_response({"changes": changes, "next": next_cursor, "has_more": has_more})
+
 async def get_all_user(request):
     if not check_api_key(request):
         return web.json_response({"error": "Invalid API key"}, status=403)
 
-    with sqlite3.connect(DATABASE) as conn:
-        cursor = conn.cursor()
-        users = cursor.execute("SELECT * FROM users").fetchall()
-        return web.json_response(users, status=200)
+    after = request.query.get('after', '')
+    try:
+        limit = int(request.query['limit']) if 'limit' in request.query else None
+    except ValueError:
+        return web.json_response({"error": "limit must be an integer"}, status=400)
+
+    #使用者數量與最大updated_at不變時內容必定相同 查詢參數不同則為不同的表示
+    count, last_updated = await db.fetchone("SELECT COUNT(*), MAX(updated_at) FROM users")
+    query_hash = hashlib.sha256(request.query_string.encode()).hexdigest()[:12]
+    etag = f'"all-{count}-{last_updated or 0}-{query_hash}"'
+    if etag_matches(request, etag):
+        return web.Response(status=304, headers={'ETag': etag})
+
+    if request.query.get('format') == 'ndjson': #逐行串流 每行一個使用者JSON
+        response = web.StreamResponse(headers={'Content-Type': 'application/x-ndjson', 'ETag': etag})
+        await response.prepare(request)
+        async for users in iter_user_chunks(after, ALL_USER_CHUNK_SIZE, limit):
+            await response.write("".join(json.dumps(user_to_dict(user)) + "\n" for user in users).encode())
+        await response.write_eof()
+        return response
+
+    if limit is not None: #分頁模式 next為下一頁的after參數
+        limit = max(1, min(limit, ALL_USER_MAX_PAGE_SIZE))
+        users = await db.fetchall("SELECT * FROM users WHERE id > ? ORDER BY id LIMIT ?", (after, limit))
+        return web.json_response({
+            "users": [user_to_dict(user) for user in users],
+            "next": users[-1][0] if len(users) == limit else None
+        }, headers={'ETag': etag})
+
+    #未指定參數時維持舊版的陣列格式 但改為分批串流輸出
+    response = web.StreamResponse(headers={'Content-Type': 'application/json', 'ETag': etag})
+    await response.prepare(request)
+    separator = "["
+    async for users in iter_user_chunks(after, ALL_USER_CHUNK_SIZE):
+        await response.write((separator + ",".join(json.dumps([*user[:5], format_expires_at(user[5])]) for user in users)).encode())
+        separator = ","
+    await response.write(b"[]" if separator == "[" else b"]")
+    await response.write_eof()
+    return response
 
 async def delete_user(request):
 #根據指定的使用者ID刪除使用者
@@ -241,27 +1423,222 @@ async def delete_user(request):
     user_id = request.match_info['user_id']
     if not check_api_key(request):
         return web.json_response({"error": "Invalid API key"}, status=403)
-    await execute_user_deletion(user_id)
-    return web.json_response({"message": f"User {user_id} deleted successfully"})
+    if request.query.get('background', 'False') == 'True': #於背景執行 以狀態端點查詢結果
+        job_id = await deletion_jobs.start(user_id)
+        return web.json_response({
+            "message": f"User {user_id} deletion started",
+            "job_id": job_id,
+            "status_url": f"/delete_user_status/{job_id}"
+        }, status=202)
+    results = await execute_user_deletion(user_id)
+    return web.json_response({
+        "message": f"User {user_id} deleted successfully",
+        "summary": summarize_deletion(results),
+        "results": results
+    })
 
-async def execute_user_deletion(user_id):
-    with sqlite3.connect(DATABASE) as conn:
-        cursor = conn.cursor()
-        guilds = cursor.execute("SELECT * FROM guild").fetchall()
-        headers = {
-            'Authorization': f"Bot {BOT_TOKEN}"
-        }
-        for guild in guilds:
-            guild_id = guild[0]
-            unauth_role_id = guild[1]
-            auth_role_id = guild[2]
-            async with ClientSession() as session:
-                #await session.delete(f"https://discord.com/api/guilds/{guild_id}/members/{user_id}", headers=headers)
-                await session.delete(f"https://discord.com/api/guilds/{guild_id}/members/{user_id}/roles/{auth_role_id}", headers=headers)
-                if guild_id != unauth_role_id: #判斷是否為everyone身分組
-                    await session.put(f"https://discord.com/api/guilds/{guild_id}/members/{user_id}/roles/{unauth_role_id}", headers=headers)
-        cursor.execute("DELETE FROM users WHERE id = ?", (user_id,))
-        conn.commit()
+async def delete_user_status(request):
+    job_id = request.match_info['job_id']
+    if not check_api_key(request):
+        return web.json_response({"error": "Invalid API key"}, status=403)
+    job = await deletion_jobs.get(job_id)
+    if job is None:
+        return web.json_response({"error": "Deletion job not found"}, status=404)
+    return web.json_response(job)
+
+async def execute_user_deletion(user_id) -> list: #同時對所有伺服器撤回身分組 回傳每個伺服器的結果
+    guilds = await guild_cache.all()
+    semaphore = asyncio.Semaphore(DELETION_CONCURRENCY)
+    results = await asyncio.gather(*[reset_guild_roles(user_id, guild, semaphore) for guild in guilds])
+    def remove_user(conn):
+        if conn.execute("DELETE FROM users WHERE id = ?", (user_id,)).rowcount:
+            change_feed.record(conn, user_id, "delete")
+    await db.transaction(remove_user)
+    token_verifier.forget(user_id)
+    return list(results)
+
+async def reset_guild_roles(user_id, guild, semaphore:asyncio.Semaphore) -> dict:
+    guild_id = guild[0]
+    unauth_role_id = guild[1]
+    auth_role_id = guild[2]
+    headers = {
+        'Authorization': f"Bot {BOT_TOKEN}"
+    }
+    result = {"guild_id": guild_id, "auth_role_removed": None, "unauth_role_added": None}
+    async with semaphore:
+        try:
+            #await discord_http.request('DELETE', f"/guilds/{guild_id}/members/{user_id}", headers=headers)
+            response = await discord_http.request('DELETE', f"/guilds/{guild_id}/members/{user_id}/roles/{auth_role_id}", headers=headers)
+            result["auth_role_removed"] = response.status
+            if guild_id != unauth_role_id: #判斷是否為everyone身分組
+                response = await discord_http.request('PUT', f"/guilds/{guild_id}/members/{user_id}/roles/{unauth_role_id}", headers=headers)
+                result["unauth_role_added"] = response.status
+        except Exception as e:
+            result["error"] = repr(e)
+    result["ok"] = "error" not in result and all(status is None or status < 400 for status in (result["auth_role_removed"], result["unauth_role_added"]))
+    return result
+
+def summarize_deletion(results:list) -> dict:
+    succeeded = sum(1 for result in results if result["ok"])
+    return {"guilds": len(results), "succeeded": succeeded, "failed": len(results) - succeeded}
+
+class DeletionJobs: #背景刪除工作的狀態存於deletion_jobs資料表 任一worker都能查詢 只保留最近的max_jobs筆
+    def __init__(self, database:Database, lease_store:LeaseStore, max_jobs:int = 1000):
+        self.db = database
+        self.leases = lease_store
+        self.max_jobs = max_jobs
+        self._tasks = set()
+
+    async def start(self, user_id) -> str:
+        job_id = os.urandom(8).hex()
+        def insert(conn):
+            conn.execute(
+                "INSERT INTO deletion_jobs (job_id, user_id, status, started_at, owner) VALUES (?, ?, 'running', ?, ?)",
+                (job_id, str(user_id), time.time(), self.leases.owner)
+            )
+            conn.execute(
+                "DELETE FROM deletion_jobs WHERE job_id IN (SELECT job_id FROM deletion_jobs ORDER BY started_at DESC LIMIT -1 OFFSET ?)", (self.max_jobs,)
+            )
+        await self.db.transaction(insert)
+        self._spawn(job_id, user_id)
+        return job_id
+
+    def _spawn(self, job_id:str, user_id):
+        task = asyncio.create_task(self._run(job_id, user_id))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def requeue_orphaned(self): #由leader接手已停止的worker留下的running工作 刪除可重複執行
+        def claim(conn):
+            rows = conn.execute(
+                "SELECT job_id, user_id FROM deletion_jobs WHERE status = 'running' AND "
+                "(owner IS NULL OR owner NOT IN (SELECT owner FROM leases WHERE name >= 'worker:' AND name < 'worker;' AND expires_at > ?))",
+                (time.time(),)
+            ).fetchall()
+            conn.executemany("UPDATE deletion_jobs SET owner = ? WHERE job_id = ?", [(self.leases.owner, job_id) for job_id, _ in rows])
+            return rows
+        rows = await self.db.transaction(claim)
+        if rows:
+            logging.info(f"Resuming {len(rows)} unfinished background deletions")
+        for job_id, user_id in rows:
+            self._spawn(job_id, user_id)
+
+    async def stop(self, timeout:float = 30): #等待進行中的刪除完成 逾時則取消 未完成的工作由leader重新執行
+        if not self._tasks:
+            return
+        done, pending = await asyncio.wait(set(self._tasks), timeout=timeout)
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+        if pending:
+            logging.warning(f"Stopped with {len(pending)} background deletions unfinished, they will be resumed")
+
+    async def _run(self, job_id:str, user_id):
+        try:
+            results = await execute_user_deletion(user_id)
+            status, result = "done", {"summary": summarize_deletion(results), "results": results}
+        except Exception as e:
+            logging.exception(f"Background deletion of user {user_id} failed: {e}")
+            status, result = "failed", {"error": repr(e)}
+        await self.db.execute(
+            "UPDATE deletion_jobs SET status = ?, finished_at = ?, result = ? WHERE job_id = ?", (status, time.time(), json.dumps(result), job_id)
+        )
+
+    async def get(self, job_id:str):
+        row = await self.db.fetchone("SELECT job_id, user_id, status, started_at, finished_at, result FROM deletion_jobs WHERE job_id = ?", (job_id,))
+        if row is None:
+            return None
+        job = {"job_id": row[0], "user_id": row[1], "status": row[2], "started_at": row[3]}
+        if row[4] is not None:
+            job["finished_at"] = row[4]
+        job.update(json.loads(row[5]) if row[5] else {})
+        return job
+
+deletion_jobs = DeletionJobs(db, leases)
+
+#==================使用者變更紀錄==================
+class ChangeCursorExpired(Exception):
+    def __init__(self, head:int):
+        super().__init__("Change cursor is no longer available")
+        self.head = head
+
+class UserChangeFeed: #user_changes每個使用者只保留最新一筆 所有consumer都讀過的紀錄於壓縮時刪除
+    FLOOR = "user_changes_floor" #存於shared_versions 小於此值的cursor已無法接續
+
+    def __init__(self, db:Database, consumer_ttl:float = 7 * 86400, retention:float = 30 * 86400):
+        self.db = db
+        self.consumer_ttl = consumer_ttl
+        self.retention = retention
+        self.compacted = 0
+
+    @staticmethod
+    def record(conn:sqlite3.Connection, user_id, op:str): #於寫入users的同一交易中呼叫 op為insert/update/delete
+        conn.execute("DELETE FROM user_changes WHERE user_id = ?", (str(user_id),)) #舊紀錄已被取代 讀取時一律回傳目前的資料
+        conn.execute("INSERT INTO user_changes (user_id, op, changed_at) VALUES (?, ?, ?)", (str(user_id), op, time.time()))
+
+    def _floor(self, conn:sqlite3.Connection) -> int:
+        row = conn.execute("SELECT version FROM shared_versions WHERE name = ?", (self.FLOOR,)).fetchone()
+        return row[0] if row else 0
+
+    async def read(self, since = None, limit:int = 500, consumer:str = None) -> tuple: #回傳(變更列表, 下一個cursor, 是否還有資料) since為None時接續consumer上次確認的位置
+        def run(conn):
+            head = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'user_changes'").fetchone()
+            head = head[0] if head else 0
+            cursor = since
+            if cursor is None and consumer:
+                row = conn.execute("SELECT cursor FROM change_consumers WHERE name = ?", (consumer,)).fetchone()
+                cursor = row[0] if row else None
+            if cursor is None:
+                cursor = 0
+            elif cursor == "latest":
+                cursor = head
+            if cursor < self._floor(conn) or cursor > head:
+                raise ChangeCursorExpired(head)
+            if consumer: #帶著since讀取代表since之前的變更已處理完畢 回傳的變更在下次請求確認前不視為已送達 壓縮也以此為準
+                conn.execute(
+                    "INSERT INTO change_consumers (name, cursor, updated_at) VALUES (?, ?, ?) ON CONFLICT(name) DO UPDATE SET cursor = excluded.cursor, updated_at = excluded.updated_at",
+                    (consumer, cursor, time.time())
+                )
+            rows = conn.execute(
+                "SELECT c.seq, c.op, c.user_id, u.* FROM user_changes c LEFT JOIN users u ON u.id = c.user_id WHERE c.seq > ? ORDER BY c.seq LIMIT ?",
+                (cursor, limit + 1)
+            ).fetchall()
+            has_more = len(rows) > limit
+            rows = rows[:limit]
+            next_cursor = rows[-1][0] if rows else head
+            return rows, next_cursor, has_more
+        rows, next_cursor, has_more = await self.db.transaction(run)
+        changes = [{
+            "seq": row[0],
+            "op": row[1],
+            "user_id": row[2],
+            "user": user_to_dict(row[3:]) if row[1] != "delete" and row[3] is not None else None
+        } for row in rows]
+        return changes, next_cursor, has_more
+
+    async def compact(self): #刪除所有consumer都已讀過或超過保留期限的紀錄
+        def run(conn):
+            now = time.time()
+            conn.execute("DELETE FROM change_consumers WHERE updated_at < ?", (now - self.consumer_ttl,))
+            candidates = [
+                conn.execute("SELECT MIN(cursor) FROM change_consumers").fetchone()[0],
+                conn.execute("SELECT MAX(seq) FROM user_changes WHERE changed_at < ?", (now - self.retention,)).fetchone()[0]
+            ]
+            floor = max((candidate for candidate in candidates if candidate is not None), default=None) #沒有consumer時只依保留期限刪除
+            if floor is None or floor <= self._floor(conn):
+                return 0
+            deleted = conn.execute("DELETE FROM user_changes WHERE seq <= ?", (floor,)).rowcount
+            conn.execute(
+                "INSERT INTO shared_versions (name, version) VALUES (?, ?) ON CONFLICT(name) DO UPDATE SET version = excluded.version", (self.FLOOR, floor)
+            )
+            return deleted
+        self.compacted += await self.db.transaction(run)
+
+    async def stats(self) -> dict:
+        row = await self.db.fetchone("SELECT COUNT(*), (SELECT COUNT(*) FROM change_consumers) FROM user_changes")
+        return {"entries": row[0], "consumers": row[1], "compacted": self.compacted}
+
+change_feed = UserChangeFeed(db, consumer_ttl=CHANGE_CONSUMER_TTL, retention=CHANGE_RETENTION)
 
 async def add_guild(request):
 #新增認證伺服器未驗證/已驗證設定資料
@@ -269,16 +1646,18 @@ async def add_guild(request):
         return web.json_response({"error": "Invalid API key"}, status=403)
 
     data = await request.json()
-    with sqlite3.connect(DATABASE) as conn:
-        cursor = conn.cursor()
-        if cursor.execute(f"SELECT * FROM guild WHERE guild_id = ? AND unauth_role_id = ? AND auth_role_id = ?",
-                            (data['guild_id'], data['unauth_role'], data['auth_role'],)).fetchone() is not None:
-            cursor.execute(f"DELETE FROM guild WHERE guild_id = {data['guild_id']}")
-            conn.commit()
+    def write_guild(conn):
+        if conn.execute("SELECT * FROM guild WHERE guild_id = ? AND unauth_role_id = ? AND auth_role_id = ?",
+                        (data['guild_id'], data['unauth_role'], data['auth_role'],)).fetchone() is not None:
+            conn.execute("DELETE FROM guild WHERE guild_id = ?", (data['guild_id'],))
 
-        cursor.execute("INSERT OR REPLACE INTO guild (guild_id, unauth_role_id, auth_role_id, reauth_day) VALUES (?, ?, ?, ?)",
-                    (data['guild_id'], data['unauth_role'], data['auth_role'], data['reauth_day']))
-        conn.commit()
+        conn.execute("INSERT OR REPLACE INTO guild (guild_id, unauth_role_id, auth_role_id, reauth_day) VALUES (?, ?, ?, ?)",
+                     (data['guild_id'], data['unauth_role'], data['auth_role'], data['reauth_day']))
+    try:
+        await db.transaction(write_guild)
+    finally:
+        guild_cache.invalidate()
+        await coordinator.notify("guild")
 
     return web.json_response({"message": "Guild data added successfully!"}, status=200)
 
@@ -287,188 +1666,349 @@ async def delete_guild_data(request):
         return web.json_response({"error": "Invalid API key"}, status=403)
 
     data = await request.json()
-    with sqlite3.connect(DATABASE) as conn:
-        cursor = conn.cursor()
-
-        if cursor.execute(f"SELECT * FROM guild WHERE guild_id = ? AND unauth_role_id = ? AND auth_role_id = ?",
-                            (data['guild_id'], data['unauth_role'], data['auth_role'],)).fetchone() is None:
-            return web.json_response({"ERROR": "Role data not exists."}, status=403)
-
-        cursor.execute("DELETE FROM guild WHERE guild_id = ? AND unauth_role_id = ? AND auth_role_id = ?",
-                    (data['guild_id'], data['unauth_role'], data['auth_role']))
-        conn.commit()
+    deleted = await db.execute("DELETE FROM guild WHERE guild_id = ? AND unauth_role_id = ? AND auth_role_id = ?",
+                               (data['guild_id'], data['unauth_role'], data['auth_role']))
+    guild_cache.invalidate()
+    await coordinator.notify("guild")
+    if deleted == 0:
+        return web.json_response({"ERROR": "Role data not exists."}, status=403)
 
     return web.json_response({"message": "Guild data delete successfully!"})
 
 async def add_user_to_server(request):
     user_id = request.match_info['user_id']
     if not check_api_key(request):
-        return web.json_response({"ERROR": "Invalid API key"}), 403
-    response = await AddUserToServer(user_id=user_id)
-    return web.json_response({"status": response.text}), response.status_code
+        return web.json_response({"ERROR": "Invalid API key"}, status=403)
+    try:
+        response = await AddUserToServer(user_id=user_id)
+    except UserNotFound:
+        return web.json_response({"error": "User not found"}, status=404)
+    except AuthorizationRevoked as e:
+        return web.json_response({"error": str(e)}, status=403)
+    except TokenRefreshBusy:
+        return web.json_response({"error": "Token refresh is in progress, please retry later"}, status=503, headers={"Retry-After": "5"})
+    except ClientResponseError as e:
+        if e.status == 403: #機器人缺少權限或身分組順序低於要設定的身分組
+            return web.json_response({"error": "Discord refused the request, check the bot's permissions and role order", "discord_status": e.status}, status=403)
+        if e.status == 404: #伺服器或身分組已不存在
+            return web.json_response({"error": "Discord guild, member or role not found", "discord_status": e.status}, status=404)
+        status = 503 if e.status == 429 or e.status >= 500 else 502
+        return web.json_response({"error": f"Discord API returned {e.status}", "discord_status": e.status}, status=status, headers={"Retry-After": "5"})
+    except (ClientError, asyncio.TimeoutError):
+        return web.json_response({"error": "Discord API is unreachable"}, status=503, headers={"Retry-After": "5"})
+    return web.json_response({"status": response.status, "message": await response.text()})
 
 async def get_guild_auth_role_data(request): #獲取伺服器登記之未授權/已授權身分組資料
     guild_id = request.match_info['guild_id']
     if not check_api_key(request):
-        return web.json_response({"ERROR": "Invalid API key"}), 403
+        return web.json_response({"ERROR": "Invalid API key"}, status=403)
     
-    with sqlite3.connect(DATABASE) as conn:
-        cursor = conn.cursor()
-        data_list = cursor.execute("SELECT * FROM guild WHERE guild_id = ?", (guild_id,)).fetchall()
-        output = []
-        for data in data_list:
-            temp_list = {
-                "guild_id": data[0],
-                "unauth_role_id": data[1],
-                "auth_role_id": data[2],
-                "reauth_day": data[3]
-            }
-            output.append(temp_list)
-    return web.json_response(output)
+    etag = await guild_cache.etag(guild_id)
+    if etag_matches(request, etag):
+        return web.Response(status=304, headers={'ETag': etag})
+    data_list = await guild_cache.by_guild(guild_id)
+    output = [guild_row_to_dict(data) for data in data_list]
+    return web.json_response(output, headers={'ETag': etag})
+
+def guild_row_to_dict(data) -> dict:
+    return {
+        "guild_id": data[0],
+        "unauth_role_id": data[1],
+        "auth_role_id": data[2],
+        "reauth_day": data[3]
+    }
+
+async def read_batch_ids(request, field:str): #讀取批次請求的ID列表 格式錯誤時回傳錯誤回應
+    try:
+        data = await request.json()
+        ids = list(dict.fromkeys(str(item) for item in data[field]))
+    except (ValueError, KeyError, TypeError):
+        return None, web.json_response({"error": f"Request body must be a JSON object with a '{field}' list"}, status=400)
+    if len(ids) > BATCH_MAX_IDS:
+        return None, web.json_response({"error": f"At most {BATCH_MAX_IDS} ids per request"}, status=413)
+    return ids, None
+
+def refresh_error_message(error) -> str: #刷新Token暫時失敗的原因 供批次查詢回報
+    if isinstance(error, TokenRefreshBusy):
+        return "Token refresh is in progress, please retry later"
+    if isinstance(error, ClientResponseError):
+        return f"Discord API returned {error.status}, authorization could not be verified"
+    return "Discord API is unreachable, authorization could not be verified"
+
+async def get_users_batch(request): #一次查詢多個使用者 回傳以使用者ID為鍵的資料 找不到或授權已失效時為null 暫時無法刷新的使用者列於errors
+    if not check_api_key(request):
+        return web.json_response({"error": "Invalid API key"}, status=403)
+    user_ids, error = await read_batch_ids(request, 'ids')
+    if error is not None:
+        return error
+
+    output = dict.fromkeys(user_ids)
+    if user_ids:
+        placeholders = ",".join("?" * len(user_ids))
+        rows = await db.fetchall(f"SELECT * FROM users WHERE id IN ({placeholders})", tuple(user_ids))
+        refreshed = await asyncio.gather(*[refresh_token_if_expired(row[0], user_data=row) for row in rows], return_exceptions=True)
+        errors = {}
+        revoked = []
+        for row, user in zip(rows, refreshed):
+            if isinstance(user, AuthorizationRevoked): #與/user相同 只有Discord明確回覆授權已失效時才刪除
+                revoked.append(row[0])
+            elif isinstance(user, (TokenRefreshBusy, ClientError, asyncio.TimeoutError)): #保留使用者資料 由呼叫端稍後重試
+                del output[row[0]]
+                errors[row[0]] = refresh_error_message(user)
+            elif isinstance(user, BaseException):
+                raise user
+            elif user:
+                output[row[0]] = user_to_dict(user)
+        for user_id, result in zip(revoked, await asyncio.gather(*[execute_user_deletion(user_id) for user_id in revoked], return_exceptions=True)):
+            if isinstance(result, BaseException):
+                logging.warning(f"Failed to delete revoked user {user_id}: {result!r}")
+        if errors:
+            return web.json_response({"users": output, "errors": errors}, headers={"Retry-After": "5"})
+    return web.json_response({"users": output})
+
+async def get_guilds_batch(request): #一次查詢多個伺服器的未授權/已授權身分組資料
+    if not check_api_key(request):
+        return web.json_response({"error": "Invalid API key"}, status=403)
+    guild_ids, error = await read_batch_ids(request, 'guild_ids')
+    if error is not None:
+        return error
+
+    output = {}
+    for guild_id in guild_ids:
+        output[guild_id] = [guild_row_to_dict(row) for row in await guild_cache.by_guild(guild_id)]
+    return web.json_response({"guilds": output})
 
 async def get_auth_role_data(request):
     role_data = request.match_info['role_data']
     if not check_api_key(request):
-        return web.json_response({"ERROR": "Invalid API key"}), 403
+        return web.json_response({"ERROR": "Invalid API key"}, status=403)
     
     unauth_role_id, auth_role_id = role_data.split("+")
-    with sqlite3.connect(DATABASE) as conn:
-        cursor = conn.cursor()
-        data = cursor.execute("SELECT * FROM guild WHERE unauth_role_id = ? AND auth_role_id = ?", (unauth_role_id, auth_role_id)).fetchone()
+    data = await guild_cache.by_roles(unauth_role_id, auth_role_id)
     return web.json_response(data)
 
-def save_user_to_db(user, token_info): #儲存使用者授權資料
-    with sqlite3.connect(DATABASE) as conn:
-        cursor = conn.cursor()
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS users (
-                id TEXT PRIMARY KEY,
-                username TEXT,
-                discriminator TEXT,
-                access_token TEXT,
-                refresh_token TEXT,
-                expires_at TIMESTAMP
-            )
-        """)
-        # 計算 access_token 的過期時間
-        expires_in = token_info.get('expires_in', 0)
-        expires_at = datetime.datetime.now() + datetime.timedelta(seconds=expires_in)
-        
-        cursor.execute(
-            "INSERT OR REPLACE INTO users (id, username, discriminator, access_token, refresh_token, expires_at) VALUES (?, ?, ?, ?, ?, ?)",
-            (user['id'], user['username'], user['discriminator'], token_info['access_token'], token_info['refresh_token'], expires_at)
+async def save_user_to_db(user, token_info): #儲存使用者授權資料
+    # 計算 access_token 的過期時間
+    expires_in = token_info.get('expires_in', 0)
+    expires_at = int(time.time()) + expires_in
+    
+    def write_user(conn):
+        exists = conn.execute("SELECT 1 FROM users WHERE id = ?", (user['id'],)).fetchone() is not None
+        conn.execute(
+            "INSERT OR REPLACE INTO users (id, username, discriminator, access_token, refresh_token, expires_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (user['id'], user['username'], user['discriminator'], token_info['access_token'], token_info['refresh_token'], expires_at, row_version())
         )
-        conn.commit()
+        change_feed.record(conn, user['id'], "update" if exists else "insert")
+    await db.transaction(write_user)
 
-def refresh_token_if_expired(user_id): #將過期的access_token刷新
-    with sqlite3.connect(DATABASE) as conn:
-        cursor = conn.cursor()
-        user_data = cursor.execute("SELECT * FROM users WHERE id = ?", (user_id,)).fetchone()
-        if not user_data:
-            return
-        
-        expires_at = user_data[5]
-        # 檢查 access_token 是否已過期
-        if datetime.datetime.now() >= datetime.datetime.strptime(expires_at,"%Y-%m-%d %H:%M:%S.%f"):
-            data = {
-                'client_id': CLIENT_ID,
-                'client_secret': CLIENT_SECRET,
-                'grant_type': 'refresh_token',
-                'refresh_token': user_data[4]
-            }
-            headers = {
-                'Content-Type': 'application/x-www-form-urlencoded'
-            }
-            response = requests.post('https://discord.com/api/oauth2/token', data=data, headers=headers)
-            try:
-                response.raise_for_status()
-            except requests.exceptions.HTTPError as e:
-                if e.response.status_code == 400:
-                    embed = ZeitfreiEmbedMsg(title="使用者主動移除了授權", description=f"- 帳號: <@{user_id}>")
-                    webhook.add_embed(embed)
-                    webhook.execute()
-                    raise "Authorization data error: The user has manually revoked authorization "
-                raise e
-            new_token_info = response.json()
-
-            # 更新資料庫中的 tokens 並計算新的過期時間
-            expires_in = new_token_info.get('expires_in', 0)
-            expires_at = datetime.datetime.now() + datetime.timedelta(seconds=expires_in)
-            
-            cursor.execute(
-                "UPDATE users SET access_token=?, refresh_token=?, expires_at=? WHERE id=?",
-                (new_token_info['access_token'], new_token_info['refresh_token'], expires_at, user_id)
-            )
-            conn.commit()
+refresh_in_flight = {} #user_id -> 進行中的刷新Task 同一使用者的並行請求共用同一次刷新
+token_refresh_stats = collections.Counter()
+
+async def refresh_token_if_expired(user_id, margin:float = 0, user_data = None): #將過期(或將於margin秒內過期)的access_token刷新 回傳最新的使用者資料
+    if user_data is None:
+        user_data = await db.fetchone("SELECT * FROM users WHERE id = ?", (user_id,))
+    if not user_data:
+        return
+
+    # 檢查 access_token 是否已過期
+    if time.time() + margin < user_data[5]:
+        return user_data
+
+    task = refresh_in_flight.get(user_id)
+    if task is None:
+        task = asyncio.ensure_future(refresh_user_token_exclusive(user_id, margin))
+        refresh_in_flight[user_id] = task
+        task.add_done_callback(lambda finished: finish_refresh(user_id, finished))
+    else:
+        token_refresh_stats["coalesced"] += 1
+    return await asyncio.shield(task) #呼叫端被取消時不影響其他等待者
 
-def AddUserToServer(user_id:int): #根據使用者ID將使用者加入Zeitfrei主伺服器中
+def finish_refresh(user_id, task:asyncio.Task):
+    if refresh_in_flight.get(user_id) is task:
+        del refresh_in_flight[user_id]
+    if not task.cancelled() and task.exception() is not None: #避免所有等待者都取消時出現未取得例外的警告
+        token_refresh_stats["revoked" if isinstance(task.exception(), AuthorizationRevoked) else "failed"] += 1
+
+class TokenVerifier: #記住每個使用者最後一次向Discord確認access_token有效的時間 max_age內的ensure檢查直接使用記憶體中的結果
+    def __init__(self, max_entries:int = 100000):
+        self.max_entries = max_entries
+        self._verified = collections.OrderedDict() #user_id -> (access_token, 確認時間monotonic) 依最近使用排序
+        self._in_flight = {} #user_id -> 進行中的確認Task 同一使用者的並行ensure檢查共用同一次請求
+        self.stats = collections.Counter()
+
+    def record(self, user_id, access_token:str):
+        user_id = str(user_id)
+        self._verified[user_id] = (access_token, time.monotonic())
+        self._verified.move_to_end(user_id)
+        while len(self._verified) > self.max_entries:
+            self._verified.popitem(last=False)
+
+    def forget(self, user_id):
+        self._verified.pop(str(user_id), None)
+
+    def is_fresh(self, user_id, access_token:str, max_age:float) -> bool:
+        entry = self._verified.get(str(user_id))
+        return entry is not None and entry[0] == access_token and time.monotonic() - entry[1] <= max_age #token刷新後必須重新確認
+
+    async def verify(self, user_data, max_age:float = 0): #回傳最新的使用者資料 授權已失效時拋出例外
+        user_id = str(user_data[0])
+        if max_age > 0 and time.time() < user_data[5] and self.is_fresh(user_id, user_data[3], max_age):
+            self.stats["hit"] += 1
+            self._verified.move_to_end(user_id)
+            return user_data
+        task = self._in_flight.get(user_id)
+        if task is None:
+            task = asyncio.ensure_future(self._check(user_id, user_data))
+            self._in_flight[user_id] = task
+            task.add_done_callback(lambda finished: self._finish(user_id, finished))
+        else:
+            self.stats["coalesced"] += 1
+        return await asyncio.shield(task) #呼叫端被取消時不影響其他等待者
+
+    async def _check(self, user_id:str, user_data):
+        if time.time() >= user_data[5]:
+            user_data = await refresh_token_if_expired(user_id, user_data=user_data)
+            if user_data is None: #刷新期間已被其他請求刪除
+                raise UserNotFound(user_id)
+        response = await discord_http.request('GET', '/users/@me', headers={
+            'Authorization': f"Bearer {user_data[3]}"
+        })
+        if response.status == 401:
+            raise AuthorizationRevoked("Access token was rejected by Discord")
+        response.raise_for_status()
+        self.record(user_id, user_data[3])
+        return user_data
+
+    def _finish(self, user_id:str, task:asyncio.Task):
+        if self._in_flight.get(user_id) is task:
+            del self._in_flight[user_id]
+        if task.cancelled() or task.exception() is not None:
+            self.forget(user_id)
+            self.stats["failed"] += 1
+        else:
+            self.stats["verified"] += 1
+
+token_verifier = TokenVerifier()
+
+async def refresh_user_token_exclusive(user_id, margin:float = 0, timeout:float = LEASE_TTL + 5): #跨worker的single-flight 取得租約後才向Discord刷新
+    name = f"refresh:{user_id}"
+    deadline = time.monotonic() + timeout
+    while not await leases.acquire(name):
+        if time.monotonic() >= deadline: #持有者太慢或已停止續約 改讀資料庫中目前的token
+            user_data = await db.fetchone("SELECT * FROM users WHERE id = ?", (user_id,))
+            if not user_data or time.time() + margin < user_data[5]:
+                return user_data
+            raise TokenRefreshBusy(f"Refresh lease for user {user_id} is held by another worker")
+        await asyncio.sleep(0.2) #其他worker正在刷新 完成後refresh_user_token會讀到新的token而不再刷新
     try:
-        refresh_token_if_expired(user_id)
-    except Exception as e:
-        return web.json_response({"error": e}, status=403)
+        return await refresh_user_token(user_id, margin)
+    finally:
+        await leases.release(name)
 
-    with sqlite3.connect(DATABASE) as conn:
-        cursor = conn.cursor()
-        user_data = cursor.execute("SELECT * FROM users WHERE id = ?", (user_id,)).fetchone()
-        guild_data = cursor.execute("SELECT * FROM guild WHERE guild_id = ?", (308120017201922048,)).fetchall()
+async def token_error(response) -> str: #OAuth錯誤回應中的error欄位
+    try:
+        return (await response.json(content_type=None)).get('error')
+    except (ValueError, AttributeError):
+        return None
 
-    headers = {
-        'Authorization': f"Bot {BOT_TOKEN}",
-        'Content-Type': 'application/json'
-    }
+async def refresh_user_token(user_id, margin:float = 0):
+    user_data = await db.fetchone("SELECT * FROM users WHERE id = ?", (user_id,))
+    if not user_data or time.time() + margin < user_data[5]: #已被其他請求刷新
+        return user_data
 
     data = {
-        'access_token': user_data[3]
+        'client_id': CLIENT_ID,
+        'client_secret': CLIENT_SECRET,
+        'grant_type': 'refresh_token',
+        'refresh_token': user_data[4]
     }
+    headers = {
+        'Content-Type': 'application/x-www-form-urlencoded'
+    }
+    response = await discord_http.request('POST', '/oauth2/token', data=data, headers=headers)
+    if response.status in (400, 401) and await token_error(response) == 'invalid_grant': #其他400(例如invalid_client)是設定問題 不代表使用者撤銷授權
+        embed = ZeitfreiEmbedMsg(title="使用者主動移除了授權", description=f"- 帳號: <@{user_id}>")
+        audit_log.emit(embed)
+        raise AuthorizationRevoked("Authorization data error: The user has manually revoked authorization")
+    response.raise_for_status()
+    new_token_info = await response.json()
 
-    response = requests.put(f"https://discord.com/api/guilds/308120017201922048/members/{user_id}", headers=headers, json=data)
-    if response.status_code == 201:
-        print(f"{user_data[1]}已加入伺服器") #408967202948120578
-
-    unauth_role_data = []
-    auth_role_data = []
-    for row in guild_data:
-        if row[1] not in unauth_role_data:
-            unauth_role_data.append(row[1])
-        if row[2] not in auth_role_data:
-            auth_role_data.append(row[2])
+    # 更新資料庫中的 tokens 並計算新的過期時間
+    expires_in = new_token_info.get('expires_in', 0)
+    expires_at = int(time.time()) + expires_in
+    
+    def write_token(conn):
+        if conn.execute(
+            "UPDATE users SET access_token=?, refresh_token=?, expires_at=?, updated_at=? WHERE id=?",
+            (new_token_info['access_token'], new_token_info['refresh_token'], expires_at, row_version(), user_id)
+        ).rowcount:
+            change_feed.record(conn, user_id, "update")
+    await db.transaction(write_token)
+    token_refresh_stats["refreshed"] += 1
+    return await db.fetchone("SELECT * FROM users WHERE id = ?", (user_id,))
 
-    for role_id in unauth_role_data:
-        while True:
-            response = requests.delete(
-                f"https://discord.com/api/guilds/308120017201922048/members/{user_id}/roles/{role_id}",
-                headers=headers)
-            if response.status_code == 429:
-                retry_after = int(response.headers.get("Retry-After", 1))
-                print(f"Rate limited, retrying after {retry_after} ms...")
-                time.sleep(retry_after * 0.001)
-            else:
-                break
+async def AddUserToServer(user_id:int): #根據使用者ID將使用者加入Zeitfrei主伺服器中
+    await refresh_token_if_expired(user_id)
+    return await reconcile_member(user_id)
 
-    for role_id in auth_role_data:
-        while True:
-            response = requests.put(
-                f"https://discord.com/api/guilds/308120017201922048/members/{user_id}/roles/{role_id}",
-                headers=headers)
-
-            if response.status_code == 429:
-                retry_after = int(response.headers.get("Retry-After", 1))
-                print(f"Rate limited, retrying after {retry_after} ms...")
-                time.sleep(retry_after * 0.001)
-            else:
-                break
+def member_nickname(username:str) -> str:
+    return ("〡" + username)[:32] #Discord暱稱上限32字
 
-    return response
+async def target_member_roles(guild_id) -> tuple: #依guild資料表計算(要移除的身分組, 要擁有的身分組)
+    remove_roles = set()
+    add_roles = set()
+    for _, unauth_role_id, auth_role_id, _ in await guild_cache.by_guild(guild_id):
+        remove_roles.add(str(unauth_role_id))
+        if str(auth_role_id) != str(guild_id): #everyone身分組不需要加入
+            add_roles.add(str(auth_role_id))
+    return remove_roles - add_roles, add_roles
 
-def change_user_nickname(user):
+async def reconcile_member(user_id, nickname:str = None): #新成員在加入請求中一併設定身分組與暱稱 既有成員只以一次PATCH送出差異
+    user_data = await db.fetchone("SELECT * FROM users WHERE id = ?", (user_id,))
+    if user_data is None:
+        raise UserNotFound(user_id)
     headers = {
         'Authorization': f"Bot {BOT_TOKEN}",
         'Content-Type': 'application/json'
     }
-    nickname_data = {
-        "nick": "〡" + user['username']
+    remove_roles, add_roles = await target_member_roles(MAIN_GUILD_ID)
+    data = {
+        'access_token': user_data[3],
+        'roles': sorted(add_roles)
     }
-    requests.patch(f"https://discord.com/api/guilds/308120017201922048/members/{user['id']}",headers=headers,json=nickname_data)
+    if nickname is not None:
+        data['nick'] = nickname
+    member_path = f"/guilds/{MAIN_GUILD_ID}/members/{user_id}"
+    response = await discord_http.request('PUT', member_path, headers=headers, json=data)
+    response.raise_for_status()
+    if response.status == 201:
+        print(f"{user_data[1]}已加入伺服器") #408967202948120578
+    else: #已是成員 加入請求中的roles與nick不會套用 改為比對目前狀態
+        response = await discord_http.request('GET', member_path, headers=headers)
+        response.raise_for_status()
+        member = await response.json()
+        current_roles = set(member.get('roles', []))
+        changes = {}
+        target_roles = (current_roles - remove_roles) | add_roles
+        if target_roles != current_roles:
+            changes['roles'] = sorted(target_roles)
+        if nickname is not None and member.get('nick') != nickname:
+            changes['nick'] = nickname
+        if changes:
+            response = await discord_http.request('PATCH', member_path, headers=headers, json=changes)
+            response.raise_for_status()
+    return response
+
+async def record_authorization(user_id): #OAuth callback後更新主伺服器與/authing登記的伺服器的驗證時間 reauth_day由此起算
+    guild_ids = {int(MAIN_GUILD_ID)}
+    authing = await db.fetchone("SELECT guild_id FROM is_authing WHERE user_id = ?", (str(user_id),))
+    if authing and str(authing[0]).isdigit() and await guild_cache.by_guild(int(authing[0])): #只記錄已登記身分組設定的伺服器
+        guild_ids.add(int(authing[0]))
+    now = int(time.time())
+    def write_authorizations(conn):
+        conn.executemany("INSERT OR REPLACE INTO guild_auth (guild_id, user_id, authorized_at) VALUES (?, ?, ?)",
+                         [(guild_id, str(user_id), now) for guild_id in guild_ids])
+    await db.transaction(write_authorizations)
 
 #==================Zeitfrei專用 Webhook Embed 訊息==================
 class ZeitfreiEmbedMsg(DiscordEmbed):
@@ -477,18 +2017,1114 @@ class ZeitfreiEmbedMsg(DiscordEmbed):
         self.set_footer(text=f"ZeiFrei × Qlipoth bot ∣ 社群安全系統",icon_url="https://cdn.discordapp.com/attachments/1050082973891956799/1052222704582922301/BirthUploadPic.png")
         self.set_timestamp()
 
-async def run_app():
-    runner = web.AppRunner(app)
+#==================非同步稽核紀錄==================
+class AuditLog: #將Webhook訊息放入有限佇列 由背景worker每次最多合併10個embed送出 不阻塞請求
+    MAX_EMBEDS = 10
+
+    def __init__(self, webhook_url:str, queue_size:int = 1000, spill_path:str = "audit_spill.jsonl", max_attempts:int = 3,
+                 max_spill_bytes:int = 10 * 1024 * 1024, max_spill_age:float = 7 * 86400, replay_backoff:float = 30, max_replay_backoff:float = 3600):
+        self.webhook_url = webhook_url
+        self.queue_size = queue_size
+        self.spill_path = spill_path
+        self.max_attempts = max_attempts
+        self.max_spill_bytes = max_spill_bytes #磁碟上的事件超過此大小時捨棄新事件
+        self.max_spill_age = max_spill_age #重新送出時捨棄寫入超過此秒數的事件
+        self.replay_backoff = replay_backoff
+        self.max_replay_backoff = max_replay_backoff
+        self._send_failures = 0 #連續送出失敗的批次數 webhook恢復前不重新送出磁碟上的事件
+        self._replay_after = 0.0
+        self.queue:asyncio.Queue = None
+        self._task:asyncio.Task = None
+        self._spill_lock = threading.Lock()
+        self.emitted = 0
+        self.sent = 0
+        self.batches = 0
+        self.spilled = 0
+        self.dropped = 0
+        self.failed_batches = 0
+
+    @staticmethod
+    def _to_dict(embed) -> dict:
+        data = embed.__dict__ if isinstance(embed, DiscordEmbed) else embed
+        return {key: value for key, value in data.items() if value is not None}
+
+    def emit(self, embed): #不會等待 佇列已滿時寫入磁碟 無法寫入時捨棄
+        self.emitted += 1
+        if not self.webhook_url:
+            self.dropped += 1
+            return
+        data = self._to_dict(embed)
+        if self.queue is not None:
+            try:
+                self.queue.put_nowait(data)
+                return
+            except asyncio.QueueFull:
+                pass
+        self._spill_async([data])
+
+    def _spill_async(self, embeds:list):
+        try:
+            asyncio.get_running_loop().run_in_executor(executor, self._spill, embeds)
+        except RuntimeError:
+            self._spill(embeds)
+
+    def _spill(self, embeds:list):
+        try:
+            with self._spill_lock:
+                if os.path.exists(self.spill_path) and os.path.getsize(self.spill_path) >= self.max_spill_bytes:
+                    raise OSError(f"spill file exceeds {self.max_spill_bytes} bytes")
+                spilled_at = time.time()
+                with open(self.spill_path, "a", encoding="utf-8") as file:
+                    for embed in embeds:
+                        file.write(json.dumps({**embed, "_spilled_at": embed.get("_spilled_at", spilled_at)}, ensure_ascii=False) + "\n")
+            self.spilled += len(embeds)
+        except OSError as e:
+            self.dropped += len(embeds)
+            logging.warning(f"Dropped {len(embeds)} audit events: {e!r}")
+
+    def _take_spilled(self) -> list: #回傳仍在保留期限內的事件 保留_spilled_at 再次寫入磁碟時沿用原本的時間
+        with self._spill_lock:
+            if not os.path.exists(self.spill_path):
+                return []
+            with open(self.spill_path, encoding="utf-8") as file:
+                embeds = [json.loads(line) for line in file if line.strip()]
+            os.remove(self.spill_path)
+        cutoff = time.time() - self.max_spill_age
+        fresh = [embed for embed in embeds if embed.get("_spilled_at", cutoff) >= cutoff]
+        if len(fresh) < len(embeds):
+            self.dropped += len(embeds) - len(fresh)
+            logging.warning(f"Dropped {len(embeds) - len(fresh)} audit events older than {self.max_spill_age:g} s")
+        return fresh
+
+    async def start(self):
+        self.queue = asyncio.Queue(maxsize=self.queue_size)
+        self._task = asyncio.create_task(self._worker())
+
+    async def replay_spilled(self): #由leader重新送出先前寫入磁碟的事件 webhook連續失敗時指數延後
+        if not self.webhook_url or time.monotonic() < self._replay_after:
+            return
+        spilled = await asyncio.get_running_loop().run_in_executor(executor, self._take_spilled)
+        for index, embed in enumerate(spilled): #重新送出上次未送出的事件
+            try:
+                self.queue.put_nowait(embed)
+            except asyncio.QueueFull:
+                self._spill_async(spilled[index:])
+                break
+
+    async def stop(self, timeout:float = 10):
+        if self._task is None:
+            return
+        try:
+            await asyncio.wait_for(self.queue.join(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+        remaining = []
+        while not self.queue.empty():
+            remaining.append(self.queue.get_nowait())
+        if remaining:
+            self._spill(remaining)
+
+    async def _worker(self):
+        while True:
+            embeds = [await self.queue.get()]
+            while len(embeds) < self.MAX_EMBEDS and not self.queue.empty():
+                embeds.append(self.queue.get_nowait())
+            try:
+                await self._send(embeds)
+            finally:
+                for _ in embeds:
+                    self.queue.task_done()
+
+    async def _send(self, embeds:list):
+        for attempt in range(1, self.max_attempts + 1):
+            try:
+                #webhook的速率限制由discord_http依bucket處理
+                payload = [{key: value for key, value in embed.items() if key != "_spilled_at"} for embed in embeds]
+                response = await discord_http.request('POST', self.webhook_url, json={"embeds": payload})
+                response.raise_for_status()
+                self.sent += len(embeds)
+                self.batches += 1
+                self._send_failures = 0
+                self._replay_after = 0.0
+                return
+            except Exception as e:
+                if attempt == self.max_attempts:
+                    logging.warning(f"Failed to send {len(embeds)} audit events, spilling to disk: {e!r}")
+                    self.failed_batches += 1
+                    self._send_failures += 1
+                    self._replay_after = time.monotonic() + min(self.replay_backoff * 2 ** (self._send_failures - 1), self.max_replay_backoff)
+                    await asyncio.get_running_loop().run_in_executor(executor, self._spill, embeds)
+                    return
+                await asyncio.sleep(2 ** attempt)
+
+    def stats(self) -> dict:
+        return {
+            "queued": self.queue.qsize() if self.queue is not None else 0,
+            "emitted": self.emitted,
+            "sent": self.sent,
+            "batches": self.batches,
+            "spilled": self.spilled,
+            "dropped": self.dropped,
+            "failed_batches": self.failed_batches
+        }
+
+audit_log = AuditLog(LOG_WEBHOOK_URL, queue_size=int(os.getenv("AUDIT_QUEUE_SIZE", 1000)))
+
+#==================授權後處理流程==================
+class StageStats:
+    def __init__(self):
+        self.runs = 0
+        self.failures = 0
+        self.retries = 0
+        self.seconds_total = 0.0
+        self.max_seconds = 0.0
+
+class PostAuthPipeline: #以有限數量的worker依序執行授權後的各個階段 並於失敗時指數退避重試
+    def __init__(self, stages:list, workers:int = 8, queue_size:int = 1000, max_attempts:int = 4, backoff:float = 1.0, stage_aliases:dict = None):
+        self.stages = stages #[(階段名稱, async func(job))]
+        self.stage_names = [name for name, _ in stages]
+        self.stage_aliases = stage_aliases or {} #已合併或更名的舊階段名稱 -> 目前的階段名稱
+        self.on_stage_done = None #async func(job) 每個階段完成後呼叫 job["stage"]為下一個階段
+        self.on_job_done = None #async func(job, succeeded)
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.queue:asyncio.Queue = None
+        self.queue_size = queue_size
+        self._tasks = []
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.job_seconds_total = 0.0
+        self.stage_stats = {name: StageStats() for name, _ in stages}
+        self.failed_jobs = collections.deque(maxlen=100)
+
+    async def start(self):
+        self.queue = asyncio.Queue(maxsize=self.queue_size)
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self, timeout:float = 30):
+        if self.queue is not None:
+            try:
+                await asyncio.wait_for(self.queue.join(), timeout)
+            except asyncio.TimeoutError:
+                logging.warning(f"Post-auth pipeline stopped with {self.queue.qsize()} queued jobs")
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def submit(self, job:dict): #佇列已滿時會等待 形成背壓
+        job.setdefault("submitted_at", time.monotonic())
+        await self.queue.put(job)
+        self.submitted += 1
+
+    async def _worker(self):
+        while True:
+            job = await self.queue.get()
+            try:
+                await self.run(job)
+            finally:
+                self.queue.task_done()
+
+    async def run(self, job:dict) -> bool: #job["stage"]存在時從該階段繼續執行 無論成功與否都會呼叫on_job_done
+        try:
+            succeeded = await self._run_stages(job)
+        except Exception as e: #階段以外的錯誤(例如工作內容不完整)也要結束工作 避免停留在running
+            job["last_error"] = f"{job.get('stage')}: {e!r}"
+            logging.exception(f"Post-auth job failed unexpectedly: {e}")
+            succeeded = False
+        if succeeded:
+            self.completed += 1
+            self.job_seconds_total += time.monotonic() - job.get("submitted_at", time.monotonic())
+        else:
+            self.failed += 1
+        await self._notify(self.on_job_done, job, succeeded)
+        return succeeded
+
+    async def _run_stages(self, job:dict) -> bool:
+        stage = self.stage_aliases.get(job.get("stage"), job.get("stage"))
+        start_index = self.stage_names.index(stage) if stage in self.stage_names else 0
+        for index in range(start_index, len(self.stages)):
+            name, func = self.stages[index]
+            if not await self._run_stage(name, func, job):
+                return False
+            job["stage"] = self.stage_names[index + 1] if index + 1 < len(self.stages) else None
+            await self._notify(self.on_stage_done, job)
+        return True
+
+    async def _notify(self, hook, *args):
+        if hook is None:
+            return
+        try:
+            await hook(*args)
+        except Exception as e:
+            logging.exception(f"Post-auth pipeline hook failed: {e}")
+
+    async def _run_stage(self, name:str, func, job:dict) -> bool:
+        stats = self.stage_stats[name]
+        for attempt in range(1, self.max_attempts + 1):
+            start = time.monotonic()
+            error = None
+            try:
+                await func(job)
+            except Exception as e:
+                error = e
+            elapsed = time.monotonic() - start
+            stats.runs += 1
+            stats.seconds_total += elapsed
+            stats.max_seconds = max(stats.max_seconds, elapsed)
+            if error is None:
+                return True
+            if isinstance(error, AuthorizationRevoked) or attempt == self.max_attempts: #使用者已撤銷授權時重試無意義
+                break
+            stats.retries += 1
+            await asyncio.sleep(self.backoff * 2 ** (attempt - 1) + random.uniform(0, self.backoff))
+        stats.failures += 1
+        user_id = job["user"]["id"]
+        job["last_error"] = f"{name}: {error!r}"
+        self.failed_jobs.append({"user_id": user_id, "stage": name, "error": repr(error), "failed_at": time.time()})
+        logging.error(f"Post-auth stage {name} failed for user {user_id}: {error!r}")
+        return False
+
+    def stats(self) -> dict:
+        return {
+            "queued": self.queue.qsize() if self.queue is not None else 0,
+            "submitted": self.submitted,
+            "completed": self.completed,
+            "failed": self.failed,
+            "avg_job_seconds": round(self.job_seconds_total / self.completed, 3) if self.completed else 0.0,
+            "stages": {name: dict(stats.__dict__) for name, stats in self.stage_stats.items()},
+            "recent_failures": list(self.failed_jobs)[-10:]
+        }
+
+async def persist_stage(job:dict):
+    await save_user_to_db(job["user"], job["token_info"])
+    await record_authorization(job["user"]["id"])
+
+async def member_sync_stage(job:dict):
+    await reconcile_member(job["user"]["id"], nickname=member_nickname(job["user"]["username"]))
+
+async def audit_log_stage(job:dict):
+    await send_webhook_msg(job["user"])
+
+post_auth_pipeline = PostAuthPipeline(
+    stages=[
+        ("persist", persist_stage),
+        ("member_sync", member_sync_stage),
+        ("audit_log", audit_log_stage)
+    ],
+    stage_aliases={"guild_join": "member_sync", "role_sync": "member_sync", "nickname": "member_sync"},
+    workers=int(os.getenv("POST_AUTH_WORKERS", 8)),
+    queue_size=int(os.getenv("POST_AUTH_QUEUE_SIZE", 1000))
+)
+
+#==================持久化工作佇列==================
+class AuthJobQueue: #將callback的授權後工作寫入auth_jobs資料表 重新啟動後仍可繼續執行
+    def __init__(self, database:Database, pipeline:PostAuthPipeline, batch_size:int = 50, poll_interval:float = 5.0, max_attempts:int = 5):
+        self.db = database
+        self.pipeline = pipeline
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.max_attempts = max_attempts #超過次數仍未完成(例如每次都讓worker中止)的工作改為failed
+        self._wakeup:asyncio.Event = None
+        self._task:asyncio.Task = None
+        self._in_flight = set()
+        self.enqueued = 0
+        self.completed = 0
+        self.failed = 0
+        self._completed_times = collections.deque(maxlen=10000)
+        pipeline.on_stage_done = self._stage_done
+        pipeline.on_job_done = self._job_done
+
+    async def start(self):
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self._drain_loop())
+
+    async def requeue_orphaned(self): #由leader將已停止的worker留下的running工作改回pending
+        resumed = await self.db.execute(
+            "UPDATE auth_jobs SET status = 'pending', owner = NULL WHERE status = 'running' AND "
+            "(owner IS NULL OR owner NOT IN (SELECT owner FROM leases WHERE name >= 'worker:' AND name < 'worker;' AND expires_at > ?))",
+            (time.time(),)
+        )
+        if resumed:
+            logging.info(f"Resuming {resumed} unfinished post-auth jobs")
+            self._wakeup.set()
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def enqueue(self, user:dict, token_info:dict):
+        now = time.time()
+        await self.db.execute(
+            "INSERT INTO auth_jobs (user_id, payload, status, created_at, updated_at) VALUES (?, ?, 'pending', ?, ?)",
+            (user['id'], json.dumps({"user": user, "token_info": token_info}), now, now)
+        )
+        self.enqueued += 1
+        self._wakeup.set()
+
+    async def _claim_batch(self) -> list:
+        limit = max(self.batch_size - len(self._in_flight), 0)
+        if limit == 0:
+            return []
+        owner = leases.owner
+        def claim(conn):
+            rows = conn.execute(
+                "SELECT id, payload, stage, attempts FROM auth_jobs WHERE status = 'pending' ORDER BY id LIMIT ?", (limit,)
+            ).fetchall()
+            now = time.time()
+            claimed = []
+            gave_up = 0
+            for row in rows: #其他worker可能已先取得同一筆工作
+                if row[3] >= self.max_attempts:
+                    gave_up += conn.execute(
+                        "UPDATE auth_jobs SET status = 'failed', last_error = COALESCE(last_error || '; ', '') || ?, updated_at = ? WHERE id = ? AND status = 'pending'",
+                        (f"gave up after {row[3]} attempts", now, row[0])
+                    ).rowcount
+                elif conn.execute(
+                    "UPDATE auth_jobs SET status = 'running', owner = ?, attempts = attempts + 1, updated_at = ? WHERE id = ? AND status = 'pending'",
+                    (owner, now, row[0])
+                ).rowcount == 1:
+                    claimed.append(row)
+            return claimed, gave_up
+        claimed, gave_up = await self.db.transaction(claim)
+        if gave_up:
+            self.failed += gave_up
+            logging.error(f"Gave up on {gave_up} post-auth jobs after {self.max_attempts} attempts")
+        return claimed
+
+    async def _drain_loop(self):
+        while True:
+            try:
+                rows = await self._claim_batch()
+            except Exception as e:
+                logging.exception(f"Failed to claim post-auth jobs: {e}")
+                rows = []
+            for job_id, payload, stage, attempts in rows:
+                self._in_flight.add(job_id)
+                try:
+                    job = json.loads(payload)
+                    job.update({"job_id": job_id, "stage": stage, "attempts": attempts + 1})
+                    await self.pipeline.submit(job)
+                except Exception as e: #無法交給pipeline的工作直接標記失敗 不留在running
+                    logging.exception(f"Failed to submit post-auth job {job_id}: {e}")
+                    await self._job_done({"job_id": job_id, "last_error": f"submit: {e!r}"}, False)
+            if len(rows) < self.batch_size:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+
+    async def _stage_done(self, job:dict):
+        if "job_id" in job:
+            await self.db.execute("UPDATE auth_jobs SET stage = ?, updated_at = ? WHERE id = ?", (job["stage"], time.time(), job["job_id"]))
+
+    async def _job_done(self, job:dict, succeeded:bool):
+        if "job_id" not in job:
+            return
+        try:
+            if succeeded:
+                await self.db.execute("DELETE FROM auth_jobs WHERE id = ?", (job["job_id"],))
+                self.completed += 1
+                self._completed_times.append(time.monotonic())
+            else:
+                #失敗的工作保留於資料表中供查驗 將status改回pending即可重新執行
+                await self.db.execute(
+                    "UPDATE auth_jobs SET status = 'failed', last_error = ?, updated_at = ? WHERE id = ?",
+                    (job.get("last_error"), time.time(), job["job_id"])
+                )
+                self.failed += 1
+        finally:
+            self._in_flight.discard(job["job_id"])
+            self._wakeup.set()
+
+    async def stats(self) -> dict:
+        now = time.monotonic()
+        backlog, pending, oldest = await self.db.fetchone(
+            "SELECT COUNT(*), COALESCE(SUM(status = 'pending'), 0), MIN(created_at) FROM auth_jobs WHERE status != 'failed'"
+        )
+        failed_jobs = (await self.db.fetchone("SELECT COUNT(*) FROM auth_jobs WHERE status = 'failed'"))[0]
+        return {
+            "enqueued": self.enqueued,
+            "completed": self.completed,
+            "failed": self.failed,
+            "in_flight": len(self._in_flight),
+            "backlog": backlog,
+            "pending": pending,
+            "backlog_age_seconds": round(time.time() - oldest, 3) if oldest else 0.0,
+            "failed_jobs": failed_jobs,
+            "completed_per_minute": sum(1 for completed_at in self._completed_times if now - completed_at <= 60)
+        }
+
+auth_job_queue = AuthJobQueue(db, post_auth_pipeline, batch_size=int(os.getenv("AUTH_JOB_BATCH_SIZE", 50)), max_attempts=int(os.getenv("AUTH_JOB_MAX_ATTEMPTS", 5)))
+
+#==================背景刷新Token==================
+class TokenRefresher: #在access_token到期前主動刷新 讓讀取請求不需等待Discord
+    def __init__(self, database:Database, lead_time:float = 3600, interval:float = 60, concurrency:int = 4, jitter:float = 300, batch_size:int = 500, max_backoff:float = 6 * 3600):
+        self.db = database
+        self.lead_time = lead_time
+        self.interval = interval
+        self.jitter = jitter
+        self.batch_size = batch_size
+        self.max_backoff = max_backoff #連續失敗的使用者最多延後多久再試
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._scheduled = set()
+        self._tasks = set()
+        self._loop_task:asyncio.Task = None
+        self.refreshed = 0
+        self.revoked = 0
+        self.failed = 0
+
+    async def start(self):
+        self._loop_task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        tasks = [self._loop_task, *self._tasks] if self._loop_task else list(self._tasks)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._loop_task = None
+
+    async def _loop(self):
+        while True:
+            try:
+                await self.run_once()
+            except Exception as e:
+                logging.exception(f"Token refresher scan failed: {e}")
+            await asyncio.sleep(self.interval)
+
+    async def run_once(self): #以expires_at索引找出即將到期的使用者並排程刷新 退避中的使用者不佔用批次名額
+        now = time.time()
+        await self.db.execute("DELETE FROM token_refresh_failures WHERE user_id NOT IN (SELECT id FROM users)")
+        rows = await self.db.fetchall(
+            "SELECT u.id, u.expires_at FROM users u LEFT JOIN token_refresh_failures f ON f.user_id = u.id "
+            "WHERE u.expires_at <= ? AND (f.next_attempt_at IS NULL OR f.next_attempt_at <= ?) ORDER BY u.expires_at LIMIT ?",
+            (int(now + self.lead_time), now, self.batch_size)
+        )
+        for user_id, expires_at in rows:
+            if user_id in self._scheduled:
+                continue
+            remaining = expires_at - now
+            delay = random.uniform(0, min(self.jitter, max(remaining / 2, 0))) #分散刷新時間 避免同時打到Discord
+            self._scheduled.add(user_id)
+            task = asyncio.create_task(self._refresh(user_id, delay))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _refresh(self, user_id:str, delay:float):
+        try:
+            await asyncio.sleep(delay)
+            async with self._semaphore:
+                await refresh_token_if_expired(user_id, margin=self.lead_time)
+            self.refreshed += 1
+            await self.db.execute("DELETE FROM token_refresh_failures WHERE user_id = ?", (user_id,))
+        except AuthorizationRevoked:
+            self.revoked += 1
+            try:
+                await execute_user_deletion(user_id)
+            except Exception as e:
+                await self._record_failure(user_id, f"deletion after revocation failed: {e!r}")
+        except Exception as e:
+            await self._record_failure(user_id, f"{e!r}")
+        finally:
+            self._scheduled.discard(user_id)
+
+    async def _record_failure(self, user_id:str, reason:str): #依連續失敗次數指數延後下次嘗試
+        self.failed += 1
+        try:
+            def write_failure(conn):
+                row = conn.execute("SELECT failures FROM token_refresh_failures WHERE user_id = ?", (user_id,)).fetchone()
+                failures = (row[0] if row else 0) + 1
+                backoff = min(self.interval * 2 ** failures, self.max_backoff)
+                conn.execute(
+                    "INSERT OR REPLACE INTO token_refresh_failures (user_id, failures, next_attempt_at, last_error) VALUES (?, ?, ?, ?)",
+                    (user_id, failures, time.time() + backoff, reason)
+                )
+                return failures, backoff
+            failures, backoff = await self.db.transaction(write_failure)
+            logging.warning(f"Background token refresh failed for user {user_id} ({failures} in a row), retrying in {backoff:g} s: {reason}")
+        except Exception as e:
+            logging.exception(f"Failed to record token refresh failure for user {user_id}: {e}")
+
+    def stats(self) -> dict:
+        return {
+            "scheduled": len(self._scheduled),
+            "refreshed": self.refreshed,
+            "revoked": self.revoked,
+            "failed": self.failed
+        }
+
+token_refresher = TokenRefresher(
+    db,
+    lead_time=float(os.getenv("TOKEN_REFRESH_LEAD_SECONDS", 3600)),
+    concurrency=int(os.getenv("TOKEN_REFRESH_CONCURRENCY", 4))
+)
+
+#==================重新驗證(reauth_day)==================
+class ReverificationEngine: #找出驗證時間超過reauth_day的使用者 撤回已驗證身分組並恢復未驗證身分組
+    def __init__(self, database:Database, batch_size:int = 100, concurrency:int = 5, interval:float = 0):
+        self.db = database
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+        self.interval = interval #大於0時定期自動檢查所有伺服器
+        self._tasks = {} #guild_id -> 執行中的Task
+        self._leader_owned = set() #由resume或定期檢查啟動的guild_id 卸任leader時只停止這些
+        self._scheduler:asyncio.Task = None
+
+    async def start(self): #由leader繼續未完成的批次並執行定期檢查
+        await self.resume()
+        if self.interval > 0:
+            self._scheduler = asyncio.create_task(self._schedule_loop())
+
+    async def resume(self): #繼續沒有任何worker在執行的running批次
+        for run_id, guild_id in await self.db.fetchall("SELECT id, guild_id FROM reverify_runs WHERE status = 'running'"):
+            if guild_id not in self._tasks and await leases.acquire(f"reverify:{guild_id}"):
+                self._spawn(run_id, guild_id, leader_owned=True)
+
+    async def stop(self): #卸任leader時呼叫 手動開始的批次繼續在此worker執行
+        await self._cancel([self._tasks[guild_id] for guild_id in self._leader_owned if guild_id in self._tasks])
+
+    async def close(self): #關閉時停止所有批次 狀態維持running 由下一個leader繼續
+        await self._cancel(list(self._tasks.values()))
+
+    async def _cancel(self, tasks:list):
+        if self._scheduler is not None:
+            tasks.append(self._scheduler)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._scheduler = None
+
+    async def is_running(self, guild_id) -> bool:
+        return guild_id in self._tasks or await leases.held(f"reverify:{guild_id}")
+
+    async def _schedule_loop(self):
+        while True:
+            for guild_id in {row[0] for row in await guild_cache.all() if row[3] > 0}:
+                try:
+                    await self.start_run(guild_id, leader_owned=True)
+                except Exception as e:
+                    logging.exception(f"Failed to start reverification for guild {guild_id}: {e}")
+            await asyncio.sleep(self.interval)
+
+    async def _rules(self, guild_id) -> list: #[(unauth_role_id, auth_role_id, 截止時間)]
+        now = int(time.time())
+        rows = await guild_cache.by_guild(guild_id)
+        return [(unauth_role_id, auth_role_id, now - int(reauth_day * 86400)) for _, unauth_role_id, auth_role_id, reauth_day in rows if reauth_day > 0]
+
+    async def start_run(self, guild_id, leader_owned:bool = False): #回傳run_id 已有執行中的批次或沒有需要處理的使用者時回傳None
+        if guild_id in self._tasks or not await leases.acquire(f"reverify:{guild_id}"):
+            return None
+        rules = await self._rules(guild_id)
+        cutoff = max(rule[2] for rule in rules) if rules else 0
+        total = (await self.db.fetchone(
+            "SELECT COUNT(*) FROM guild_auth WHERE guild_id = ? AND authorized_at < ?", (guild_id, cutoff)
+        ))[0] if rules else 0
+        if total == 0:
+            await leases.release(f"reverify:{guild_id}")
+            return None
+        now = int(time.time())
+        def create_run(conn):
+            cursor = conn.execute(
+                "INSERT INTO reverify_runs (guild_id, status, started_at, total, updated_at) VALUES (?, 'running', ?, ?, ?)",
+                (guild_id, now, total, now)
+            )
+            return cursor.lastrowid
+        run_id = await self.db.transaction(create_run)
+        self._spawn(run_id, guild_id, leader_owned)
+        return run_id
+
+    def _spawn(self, run_id:int, guild_id, leader_owned:bool = False):
+        task = asyncio.create_task(self._run(run_id, guild_id))
+        self._tasks[guild_id] = task
+        if leader_owned:
+            self._leader_owned.add(guild_id)
+        task.add_done_callback(lambda finished: self._forget(guild_id, finished))
+
+    def _forget(self, guild_id, task:asyncio.Task):
+        if self._tasks.get(guild_id) is task:
+            del self._tasks[guild_id]
+            self._leader_owned.discard(guild_id)
+
+    async def _run(self, run_id:int, guild_id):
+        semaphore = asyncio.Semaphore(self.concurrency)
+        try:
+            last_user_id = (await self.db.fetchone("SELECT last_user_id FROM reverify_runs WHERE id = ?", (run_id,)))[0]
+            while True:
+                rules = await self._rules(guild_id)
+                if not rules:
+                    break
+                cutoff = max(rule[2] for rule in rules)
+                #以主鍵(guild_id, user_id)做keyset分頁 中斷後可從last_user_id繼續
+                batch = await self.db.fetchall(
+                    "SELECT user_id, authorized_at FROM guild_auth WHERE guild_id = ? AND user_id > ? AND authorized_at < ? ORDER BY user_id LIMIT ?",
+                    (guild_id, last_user_id, cutoff, self.batch_size)
+                )
+                if not batch:
+                    break
+                applied = await self._applied(guild_id, [user_id for user_id, _ in batch])
+                results = await asyncio.gather(*[
+                    self._apply(guild_id, user_id, authorized_at, rules, applied.get(user_id, set()), semaphore) for user_id, authorized_at in batch
+                ])
+                last_user_id = batch[-1][0]
+                failed = results.count(False)
+                await self.db.execute(
+                    "UPDATE reverify_runs SET last_user_id = ?, processed = processed + ?, failed = failed + ?, updated_at = ? WHERE id = ?",
+                    (last_user_id, len(batch), failed, int(time.time()), run_id)
+                )
+            await self.db.execute("UPDATE reverify_runs SET status = 'done', updated_at = ? WHERE id = ?", (int(time.time()), run_id))
+        except asyncio.CancelledError: #保持running狀態 下次啟動時繼續
+            raise
+        except Exception as e:
+            logging.exception(f"Reverification run {run_id} for guild {guild_id} failed: {e}")
+            await self.db.execute("UPDATE reverify_runs SET status = 'failed', updated_at = ? WHERE id = ?", (int(time.time()), run_id))
+        finally:
+            await leases.release(f"reverify:{guild_id}")
+
+    async def _applied(self, guild_id, user_ids:list) -> dict: #{user_id: {(unauth_role_id, auth_role_id)}} 只計入本次驗證時間之後套用的規則
+        placeholders = ",".join("?" * len(user_ids))
+        rows = await self.db.fetchall(
+            "SELECT a.user_id, a.unauth_role_id, a.auth_role_id FROM reverify_applied a JOIN guild_auth g "
+            "ON g.guild_id = a.guild_id AND g.user_id = a.user_id AND g.authorized_at = a.authorized_at "
+            f"WHERE a.guild_id = ? AND a.user_id IN ({placeholders})",
+            (guild_id, *user_ids)
+        )
+        applied = {}
+        for user_id, unauth_role_id, auth_role_id in rows:
+            applied.setdefault(user_id, set()).add((unauth_role_id, auth_role_id))
+        return applied
+
+    @staticmethod
+    def due_rules(rules:list, authorized_at:int, applied:set = ()) -> list: #已過期且尚未套用的規則
+        return [rule for rule in rules if authorized_at < rule[2] and (rule[0], rule[1]) not in applied]
+
+    @staticmethod
+    def plan(rules:list, authorized_at:int) -> tuple: #回傳(要移除的身分組, 要加入的身分組)
+        remove_roles = []
+        add_roles = []
+        for unauth_role_id, auth_role_id, cutoff in rules:
+            if authorized_at >= cutoff:
+                continue
+            if auth_role_id not in remove_roles:
+                remove_roles.append(auth_role_id)
+            if unauth_role_id not in add_roles:
+                add_roles.append(unauth_role_id)
+        return remove_roles, add_roles
+
+    async def _apply(self, guild_id, user_id, authorized_at:int, rules:list, applied:set, semaphore:asyncio.Semaphore) -> bool:
+        due = self.due_rules(rules, authorized_at, applied)
+        if not due:
+            return True
+        remove_roles, add_roles = self.plan(due, authorized_at)
+        headers = {
+            'Authorization': f"Bot {BOT_TOKEN}"
+        }
+        async with semaphore:
+            try:
+                for role_id in remove_roles:
+                    response = await discord_http.request('DELETE', f"/guilds/{guild_id}/members/{user_id}/roles/{role_id}", headers=headers)
+                    if response.status != 404: #成員已離開伺服器時略過
+                        response.raise_for_status()
+                for role_id in add_roles:
+                    if role_id == guild_id: #everyone身分組不需要加入
+                        continue
+                    response = await discord_http.request('PUT', f"/guilds/{guild_id}/members/{user_id}/roles/{role_id}", headers=headers)
+                    if response.status != 404:
+                        response.raise_for_status()
+            except Exception as e:
+                logging.warning(f"Reverification failed for user {user_id} in guild {guild_id}: {e!r}")
+                return False
+        finished = all(authorized_at < cutoff for _, _, cutoff in rules) #所有規則都已過期 之後不需再檢查此使用者
+        def record(conn):
+            if finished: #期間重新授權時authorized_at已更新 保留新的紀錄
+                conn.execute("DELETE FROM guild_auth WHERE guild_id = ? AND user_id = ? AND authorized_at = ?", (guild_id, user_id, authorized_at))
+                conn.execute("DELETE FROM reverify_applied WHERE guild_id = ? AND user_id = ?", (guild_id, user_id))
+            else:
+                conn.executemany(
+                    "INSERT OR REPLACE INTO reverify_applied (guild_id, user_id, unauth_role_id, auth_role_id, authorized_at) VALUES (?, ?, ?, ?, ?)",
+                    [(guild_id, user_id, unauth_role_id, auth_role_id, authorized_at) for unauth_role_id, auth_role_id, _ in due]
+                )
+        await self.db.transaction(record)
+        return True
+
+    async def status(self, guild_id):
+        row = await self.db.fetchone(
+            "SELECT id, status, started_at, total, processed, failed, updated_at FROM reverify_runs WHERE guild_id = ? ORDER BY id DESC LIMIT 1",
+            (guild_id,)
+        )
+        if row is None:
+            return None
+        run_id, status, started_at, total, processed, failed, updated_at = row
+        return {
+            "run_id": run_id,
+            "guild_id": guild_id,
+            "status": status,
+            "started_at": started_at,
+            "updated_at": updated_at,
+            "total": total,
+            "processed": processed,
+            "failed": failed,
+            "progress": round(processed / total, 4) if total else 1.0
+        }
+
+reverification_engine = ReverificationEngine(
+    db,
+    concurrency=int(os.getenv("REVERIFY_CONCURRENCY", 5)),
+    interval=float(os.getenv("REVERIFY_INTERVAL", 0))
+)
+
+async def start_reverification(request): #手動開始指定伺服器的重新驗證
+    if not check_api_key(request):
+        return web.json_response({"error": "Invalid API key"}, status=403)
+    try:
+        guild_id = int(request.match_info['guild_id'])
+    except ValueError:
+        return web.json_response({"error": "guild_id must be an integer"}, status=400)
+    if await reverification_engine.is_running(guild_id):
+        return web.json_response({"error": "Reverification is already running for this guild"}, status=409)
+    run_id = await reverification_engine.start_run(guild_id)
+    if run_id is None:
+        return web.json_response({"message": "No users need to reverify"})
+    return web.json_response({"message": "Reverification started", "run_id": run_id}, status=202)
+
+async def get_reverification_status(request):
+    if not check_api_key(request):
+        return web.json_response({"error": "Invalid API key"}, status=403)
+    try:
+        guild_id = int(request.match_info['guild_id'])
+    except ValueError:
+        return web.json_response({"error": "guild_id must be an integer"}, status=400)
+    status = await reverification_engine.status(guild_id)
+    if status is None:
+        return web.json_response({"error": "No reverification run found"}, status=404)
+    return web.json_response(status)
+
+#==================多worker協調==================
+class WorkerCoordinator: #各worker定期續約自己的租約 持有leader租約的worker負責背景工作 多worker時同步快取失效與速率限制
+    def __init__(self, lease_store:LeaseStore, leader_services:list, leader_tasks:list, heartbeat:float = 10, sync_interval:float = 0.5, shared:bool = False):
+        self.leases = lease_store
+        self.leader_services = leader_services #只在leader上執行的服務 需有start()/stop()
+        self.leader_tasks = leader_tasks #leader每次心跳時執行的async func()
+        self.heartbeat = heartbeat
+        self.sync_interval = sync_interval
+        self.shared = shared
+        self.is_leader = False
+        self.leader_changes = 0
+        self._watchers = {} #名稱 -> [callback()]
+        self._versions = {}
+        self._tasks = []
+
+    def watch(self, name:str, callback): #其他worker呼叫notify(name)時執行callback
+        self._watchers.setdefault(name, []).append(callback)
+
+    async def notify(self, name:str):
+        if self.shared:
+            await self.leases.db.execute(
+                "INSERT INTO shared_versions (name, version) VALUES (?, 1) ON CONFLICT(name) DO UPDATE SET version = version + 1", (name,)
+            )
+
+    async def start(self):
+        await self.leases.acquire(f"worker:{self.leases.owner}")
+        await self._beat()
+        self._tasks.append(asyncio.create_task(self._heartbeat_loop()))
+        if self.shared:
+            discord_http.shared_leases = self.leases
+            self._versions = dict(await self.leases.db.fetchall("SELECT name, version FROM shared_versions"))
+            self._tasks.append(asyncio.create_task(self._sync_loop()))
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        if self.is_leader:
+            await self._step_down()
+
+    async def _beat(self):
+        await self.leases.renew_all()
+        if await self.leases.acquire("leader"):
+            if not self.is_leader:
+                self.is_leader = True
+                self.leader_changes += 1
+                logging.info(f"Worker {self.leases.owner} is now the leader")
+                for service in self.leader_services:
+                    await service.start()
+            for task in self.leader_tasks:
+                try:
+                    await task()
+                except Exception as e:
+                    logging.exception(f"Leader task {task.__qualname__} failed: {e}")
+        elif self.is_leader:
+            logging.warning(f"Worker {self.leases.owner} lost the leader lease")
+            await self._step_down()
+
+    async def _step_down(self):
+        self.is_leader = False
+        for service in reversed(self.leader_services):
+            await service.stop()
+        await self.leases.release("leader")
+
+    async def _heartbeat_loop(self):
+        while True:
+            await asyncio.sleep(self.heartbeat)
+            try:
+                await self._beat()
+            except Exception as e:
+                logging.exception(f"Worker heartbeat failed: {e}")
+
+    async def _sync_loop(self):
+        while True:
+            await asyncio.sleep(self.sync_interval)
+            try:
+                await self._sync()
+            except Exception as e:
+                logging.exception(f"Worker state sync failed: {e}")
+
+    async def _sync(self):
+        versions = dict(await self.leases.db.fetchall("SELECT name, version FROM shared_versions"))
+        for name, version in versions.items():
+            if self._versions.get(name) != version:
+                for callback in self._watchers.get(name, []):
+                    callback()
+        self._versions = versions
+        now = time.time()
+        blocks = await self.leases.active("ratelimit:")
+        discord_http.rate_limiter.apply_blocks({key: until - now for key, until in blocks.items()})
+
+    def stats(self) -> dict:
+        return {
+            "owner": self.leases.owner,
+            "leader": self.is_leader,
+            "leader_changes": self.leader_changes
+        }
+
+coordinator = WorkerCoordinator(
+    leases,
+    leader_services=[token_refresher, reverification_engine],
+    leader_tasks=[auth_job_queue.requeue_orphaned, deletion_jobs.requeue_orphaned, reverification_engine.resume, audit_log.replay_spilled, leases.prune, change_feed.compact],
+    shared=OAUTH_WORKERS > 1
+)
+coordinator.watch("guild", guild_cache.invalidate)
+
+#==================監控指標輸出==================
+@metrics.collector
+async def collect_service_metrics():
+    pipeline = post_auth_pipeline.stats()
+    jobs = await auth_job_queue.stats()
+    limiter = discord_http.rate_limiter.stats()
+    audit = audit_log.stats()
+    changes = await change_feed.stats()
+    return [
+        ("oauth_worker_info", "gauge", "Worker identity and whether it holds the leader lease", [({"worker": str(WORKER_ID), "leader": str(coordinator.is_leader).lower()}, 1)]),
+        ("oauth_db_pending_queries", "gauge", "Queries waiting for or running in the database pool", [({}, db.pending)]),
+        ("oauth_db_pool_waiting_queries", "gauge", "Queries waiting for a free database pool thread", [({}, db.waiting)]),
+        ("oauth_post_auth_queue_depth", "gauge", "Jobs waiting in the post-auth pipeline", [({}, pipeline["queued"])]),
+        ("oauth_post_auth_in_flight", "gauge", "Claimed auth jobs not yet finished by this worker", [({}, jobs["in_flight"])]),
+        ("oauth_post_auth_jobs_total", "counter", "Post-auth pipeline jobs by outcome", [({"outcome": outcome}, pipeline[outcome]) for outcome in ("submitted", "completed", "failed")]),
+        ("oauth_auth_job_backlog", "gauge", "Unfinished rows in auth_jobs", [({}, jobs["backlog"])]),
+        ("oauth_auth_job_pending", "gauge", "Rows in auth_jobs waiting to be claimed", [({}, jobs["pending"])]),
+        ("oauth_auth_job_backlog_age_seconds", "gauge", "Age of the oldest unfinished auth job", [({}, jobs["backlog_age_seconds"])]),
+        ("oauth_discord_rate_limited_total", "counter", "Discord 429 responses by scope", [({"scope": "bucket"}, limiter["rate_limited"] - limiter["global_rate_limited"]), ({"scope": "global"}, limiter["global_rate_limited"])]),
+        ("oauth_discord_rate_limit_queued", "gauge", "Discord requests waiting on a rate limit bucket", [({}, limiter["queued"])]),
+        ("oauth_discord_rate_limit_wait_seconds_total", "counter", "Time spent waiting on Discord rate limits", [({}, limiter["wait_seconds_total"])]),
+        ("oauth_token_refresh_total", "counter", "Token refresh outcomes", [({"outcome": outcome}, count) for outcome, count in token_refresh_stats.items()]),
+        ("oauth_token_refresher_scheduled", "gauge", "Tokens scheduled for proactive refresh", [({}, token_refresher.stats()["scheduled"])]),
+        ("oauth_audit_log_queue_depth", "gauge", "Audit events waiting to be sent", [({}, audit["queued"])]),
+        ("oauth_audit_log_events_total", "counter", "Audit events by outcome", [({"outcome": outcome}, audit[outcome]) for outcome in ("emitted", "sent", "spilled", "dropped")]),
+        ("oauth_cache_hits_total", "counter", "In-memory cache hits", [({"cache": "guild"}, guild_cache.hits), ({"cache": "api_key"}, key_registry.hits)]),
+        ("oauth_cache_misses_total", "counter", "In-memory cache misses", [({"cache": "guild"}, guild_cache.misses), ({"cache": "api_key"}, key_registry.misses)]),
+        ("oauth_ensure_checks_total", "counter", "ensure=True checks by outcome", [({"outcome": outcome}, token_verifier.stats[outcome]) for outcome in ("hit", "coalesced", "verified", "failed")]),
+        ("oauth_user_changes_entries", "gauge", "Entries retained in the user change log", [({}, changes["entries"])]),
+        ("oauth_user_change_consumers", "gauge", "Registered change feed consumers", [({}, changes["consumers"])]),
+        ("oauth_event_loop_lag_seconds", "gauge", "Smoothed event loop lag used for load shedding", [({}, admission.lag)]),
+        ("oauth_admission_rejected_total", "counter", "Requests rejected by admission control", [({"bot": bot, "route": route, "reason": reason}, count) for (bot, route, reason), count in admission.rejected.items()])
+    ]
+
+async def get_metrics(request):
+    if not check_api_key(request):
+        return web.json_response({"error": "Invalid API key"}, status=403)
+    return web.Response(body=(await metrics.render()).encode(), headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+
+async def run_app(reuse_port:bool = False):
+    await discord_http.start()
+    await audit_log.start()
+    await post_auth_pipeline.start()
+    await admission.start()
+    #存取紀錄由access_log_middleware寫入 關閉時最多等待WORKER_DRAIN_TIMEOUT秒讓進行中的請求完成
+    runner = web.AppRunner(app, access_log=None, shutdown_timeout=WORKER_DRAIN_TIMEOUT)
     await runner.setup()
-    site = web.TCPSite(runner, 'localhost', 2094)
+    await asyncio.get_running_loop().run_in_executor(executor, key_registry.reload)
+    db.migrate()
+    db.verify_schema()
+    await auth_job_queue.start()
+    await coordinator.start()
+    site = web.TCPSite(runner, OAUTH_HOST, OAUTH_PORT, reuse_port=reuse_port or None)
     await site.start()
-    asyncio.create_task(logger_updater())
+    return runner
 
-if __name__ == "__main__":
+async def shutdown_app(runner:web.AppRunner):
+    await runner.cleanup()
+    await admission.stop()
+    #先停止工作 期間心跳持續續約worker租約 避免其他worker在工作結束前將其重新排入
+    await reverification_engine.close()
+    await deletion_jobs.stop(WORKER_DRAIN_TIMEOUT)
+    await auth_job_queue.stop()
+    await post_auth_pipeline.stop()
+    await audit_log.stop()
+    await coordinator.stop()
+    await leases.release_all()
+    await discord_http.close()
+    db.close()
+
+async def serve(ready = None): #收到SIGINT/SIGTERM後停止接受連線 等待進行中的請求完成再關閉
+    runner = await run_app(reuse_port=OAUTH_WORKERS > 1)
+    if ready is not None:
+        ready.set()
+    stopping = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, stopping.set)
+    await stopping.wait()
+    await shutdown_app(runner)
+
+def create_app() -> web.Application:
+    global app
     app = web.Application()
     app.secret_key = os.urandom(20)
     app['SESSION_COOKIE_NAME'] = 'discord-login-session'
     set_route()
-    loop = asyncio.get_event_loop()
-    loop.run_until_complete(run_app())
-    loop.run_forever()
\ No newline at end of file
+    return app
+
+#==================多行程模式==================
+WORKER_ID = 0
+
+def worker_main(worker_id:int, log_queue, ready):
+    global WORKER_ID
+    WORKER_ID = worker_id
+    setup_logging(log_queue, writer=False)
+    create_app()
+    asyncio.run(serve(ready))
+
+class Supervisor: #啟動多個worker行程以SO_REUSEPORT共用連接埠 只有supervisor寫入紀錄檔 SIGHUP逐一替換worker
+    def __init__(self, workers:int, start_timeout:float = 60, restart_limit:int = 5, backoff:float = 1, max_backoff:float = 60, stable_after:float = 60):
+        self.workers = workers
+        self.start_timeout = start_timeout
+        self.restart_limit = restart_limit
+        self.backoff = backoff #第n次連續崩潰後等待backoff * 2^(n-1)秒再重新啟動
+        self.max_backoff = max_backoff
+        self.stable_after = stable_after #執行超過此秒數才崩潰時重新計算連續崩潰次數
+        self.context = multiprocessing.get_context("spawn")
+        self.log_queue = self.context.Queue()
+        self.processes = {} #worker編號 -> Process
+        self._ready = {} #worker編號 -> 就緒Event 需保留參照直到worker讀取
+        self._started_at = {} #worker編號 -> 啟動時間
+        self._failures = collections.Counter() #worker編號 -> 連續崩潰次數
+        self._restart_at = {} #worker編號 -> 預定重新啟動的時間
+        self._stopping = False
+        self._reloading = False
+
+    def _spawn(self, worker_id:int):
+        ready = self.context.Event()
+        process = self.context.Process(target=worker_main, args=(worker_id, self.log_queue, ready), name=f"oauth-worker-{worker_id}")
+        process.start()
+        self._ready[worker_id] = ready
+        self._started_at[worker_id] = time.monotonic()
+        return process, ready
+
+    def _supervise(self, now:float): #以指數退避重新啟動崩潰的worker 連續崩潰超過restart_limit次後放棄
+        for worker_id, process in list(self.processes.items()):
+            if process.is_alive():
+                continue
+            restart_at = self._restart_at.get(worker_id)
+            if restart_at is None:
+                if now - self._started_at.get(worker_id, now) >= self.stable_after:
+                    self._failures[worker_id] = 0
+                self._failures[worker_id] += 1
+                failures = self._failures[worker_id]
+                if failures > self.restart_limit:
+                    logging.critical(f"Worker {worker_id} crashed {failures} times in a row, not restarting it")
+                    del self.processes[worker_id]
+                    continue
+                delay = min(self.backoff * 2 ** (failures - 1), self.max_backoff)
+                logging.error(f"Worker {worker_id} exited with code {process.exitcode}, restarting it in {delay:g} s")
+                self._restart_at[worker_id] = now + delay
+            elif now >= restart_at:
+                del self._restart_at[worker_id]
+                self.processes[worker_id] = self._spawn(worker_id)[0]
+
+    def _stop_worker(self, process):
+        process.terminate() #SIGTERM 由worker自行等待進行中的請求完成
+        process.join(WORKER_DRAIN_TIMEOUT + 15)
+        if process.is_alive():
+            logging.warning(f"Worker {process.name} did not stop in time, killing it")
+            process.kill()
+            process.join()
+
+    def reload(self): #新worker就緒後才停止舊worker 期間兩者同時接受連線 不會中斷服務
+        for worker_id, old in list(self.processes.items()):
+            process, ready = self._spawn(worker_id)
+            if not ready.wait(self.start_timeout):
+                logging.error(f"Worker {worker_id} did not start during reload, keeping the old worker")
+                self._stop_worker(process)
+                continue
+            self.processes[worker_id] = process
+            self._failures.pop(worker_id, None)
+            self._stop_worker(old)
+        logging.info("Reload finished")
+
+    def _on_stop(self, signum, frame):
+        self._stopping = True
+
+    def _on_reload(self, signum, frame):
+        self._reloading = True
+
+    def run(self):
+        global log_listener
+        log_listener = setup_logging(self.log_queue)
+        db.migrate() #worker啟動前先完成遷移 避免多個worker同時遷移
+        db.verify_schema()
+        db.close()
+        signal.signal(signal.SIGINT, self._on_stop)
+        signal.signal(signal.SIGTERM, self._on_stop)
+        signal.signal(signal.SIGHUP, self._on_reload)
+        for worker_id in range(self.workers):
+            self.processes[worker_id] = self._spawn(worker_id)[0]
+        logging.info(f"Started {self.workers} workers on {OAUTH_HOST}:{OAUTH_PORT}")
+        try:
+            while not self._stopping:
+                if self._reloading:
+                    self._reloading = False
+                    self.reload()
+                self._supervise(time.monotonic())
+                if not self.processes:
+                    logging.critical("All workers failed, stopping")
+                    return 1
+                time.sleep(0.5)
+            return 0
+        finally:
+            for process in self.processes.values():
+                process.terminate()
+            for process in self.processes.values():
+                process.join(WORKER_DRAIN_TIMEOUT + 15)
+                if process.is_alive():
+                    process.kill()
+            self._ready.clear()
+            log_listener.stop()
+
+if __name__ == "__main__":
+    if OAUTH_WORKERS > 1:
+        raise SystemExit(Supervisor(OAUTH_WORKERS, restart_limit=WORKER_RESTART_LIMIT).run())
+    else:
+        log_listener = setup_logging()
+        create_app()
+        try:
+            asyncio.run(serve())
+        finally:
+            log_listener.stop()
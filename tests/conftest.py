@@ -0,0 +1,37 @@
+import asyncio, os, sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import oauthServer
+
+
+@pytest.fixture
+def server():
+    return oauthServer
+
+
+@pytest.fixture
+def database(tmp_path, monkeypatch):
+    db = oauthServer.Database(str(tmp_path / "users.db"))
+    db.migrate()
+    monkeypatch.setattr(oauthServer, "db", db) #模組內的函式(save_user_to_db等)改用測試資料庫
+    yield db
+    db.close()
+
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+
+@pytest.fixture
+def api_key(server, tmp_path, monkeypatch):
+    import sqlite3
+    path = str(tmp_path / "bot.db")
+    with sqlite3.connect(path) as conn:
+        conn.execute("CREATE TABLE bot (botName TEXT, owner TEXT, botKey TEXT)")
+        conn.execute("INSERT INTO bot VALUES ('test', 'test', 'test-key')")
+    monkeypatch.setattr(server.key_registry, "database", path)
+    server.key_registry.reload()
+    return "test-key"
@@ -0,0 +1,47 @@
+import time
+
+import pytest
+from aiohttp.test_utils import TestClient, TestServer
+
+from conftest import run
+from test_get_user import FakeResponse, discord
+
+
+@pytest.fixture
+def member_path(server, monkeypatch):
+    async def target_member_roles(guild_id):
+        return set(), {"2"}
+    monkeypatch.setattr(server, "target_member_roles", target_member_roles)
+    return f"/guilds/{server.MAIN_GUILD_ID}/members/42"
+
+
+def add_user(server, database, api_key, insert=True):
+    async def scenario():
+        if insert:
+            await database.execute(
+                "INSERT INTO users (id, username, discriminator, access_token, refresh_token, expires_at, updated_at) VALUES ('42', 'a', '0', 'access', 'refresh', ?, 1)",
+                (int(time.time()) + 3600,)
+            )
+        async with TestClient(TestServer(server.create_app())) as client:
+            response = await client.post("/add_user_to_server/42", headers={"X-API-KEY": api_key})
+            return response.status, await response.json()
+    return run(scenario())
+
+
+def test_unknown_user_is_404(server, database, api_key, discord, member_path):
+    assert add_user(server, database, api_key, insert=False) == (404, {"error": "User not found"})
+
+
+@pytest.mark.parametrize("discord_status, expected", [(403, 403), (404, 404), (400, 502), (503, 503)])
+def test_discord_errors_are_mapped(server, database, api_key, discord, member_path, discord_status, expected):
+    discord[("PUT", member_path)] = FakeResponse(discord_status)
+    status, body = add_user(server, database, api_key)
+    assert status == expected and body["discord_status"] == discord_status
+
+
+def test_new_member_is_added(server, database, api_key, discord, member_path):
+    class Created(FakeResponse):
+        async def text(self):
+            return ""
+    discord[("PUT", member_path)] = Created(201)
+    assert add_user(server, database, api_key) == (200, {"status": 201, "message": ""})
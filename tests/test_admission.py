@@ -0,0 +1,63 @@
+import sqlite3
+
+import aiohttp
+import pytest
+from aiohttp.test_utils import TestServer
+
+from conftest import run
+
+
+def set_limits(server, api_key, rate, burst):
+    with sqlite3.connect(server.key_registry.database) as conn:
+        conn.execute("UPDATE bot SET rate_limit = ?, burst = ? WHERE botKey = ?", (rate, burst, api_key))
+    server.key_registry.reload()
+
+
+@pytest.fixture
+def admission(server, monkeypatch):
+    controller = server.AdmissionController(server.key_registry)
+    monkeypatch.setattr(server, "admission", controller)
+    return controller
+
+
+async def get_statuses(server, api_key, count, path="/authing"):
+    test_server = TestServer(server.create_app())
+    await test_server.start_server()
+    try:
+        async with aiohttp.ClientSession(headers={"X-API-KEY": api_key}) as session:
+            statuses = []
+            for _ in range(count):
+                async with session.get(test_server.make_url(path)) as response:
+                    statuses.append(response.status)
+            return statuses
+    finally:
+        await test_server.close()
+
+
+def test_token_bucket_refills_over_time(server, monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(server.time, "monotonic", lambda: now[0])
+    bucket = server.TokenBucket(rate=2, burst=4)
+    assert [bucket.take(1) for _ in range(4)] == [0.0] * 4
+    assert bucket.take(1) == pytest.approx(0.5)
+    now[0] += 1
+    assert bucket.take(2) == 0.0
+    assert bucket.take(10) == pytest.approx(2.0) #超過burst的成本以burst計算 避免永遠無法受理
+
+
+def test_api_key_is_resolved_once_per_request(server, database, api_key, admission):
+    hits = server.key_registry.hits
+    assert run(get_statuses(server, api_key, 3)) == [200] * 3
+    assert server.key_registry.hits - hits == 3
+
+
+def test_zero_burst_means_unlimited(server, database, api_key, admission):
+    set_limits(server, api_key, 1, 0)
+    assert run(get_statuses(server, api_key, 5)) == [200] * 5
+    assert not admission._buckets
+
+
+def test_exhausted_quota_is_rejected_with_retry_after(server, database, api_key, admission):
+    set_limits(server, api_key, 0.01, 2)
+    assert run(get_statuses(server, api_key, 3)) == [200, 200, 429]
+    assert sum(admission.rejected.values()) == 1
@@ -0,0 +1,59 @@
+import json
+import time
+
+import pytest
+from aiohttp import ClientError
+
+from conftest import run
+
+
+@pytest.fixture
+def webhook(server, monkeypatch):
+    posted = []
+    failing = [False]
+    class Response:
+        def raise_for_status(self):
+            pass
+    async def request(method, url, **kwargs):
+        if failing[0]:
+            raise ClientError("webhook unavailable")
+        posted.append(kwargs["json"]["embeds"])
+        return Response()
+    monkeypatch.setattr(server.discord_http, "request", request)
+    return posted, failing
+
+
+@pytest.fixture
+def audit(server, tmp_path):
+    return server.AuditLog("https://discord.test/webhook", spill_path=str(tmp_path / "spill.jsonl"), max_attempts=1, max_spill_bytes=200, max_spill_age=60)
+
+
+def test_spill_file_is_capped(server, audit):
+    audit._spill([{"title": "x" * 250}])
+    audit._spill([{"title": "over the cap"}])
+    assert audit.spilled == 1 and audit.dropped == 1
+
+
+def test_expired_spilled_events_are_dropped(server, audit):
+    with open(audit.spill_path, "w", encoding="utf-8") as file:
+        file.write(json.dumps({"title": "old", "_spilled_at": time.time() - 120}) + "\n")
+        file.write(json.dumps({"title": "new", "_spilled_at": time.time()}) + "\n")
+    assert [embed["title"] for embed in audit._take_spilled()] == ["new"]
+    assert audit.dropped == 1
+
+
+def test_replay_backs_off_while_webhook_fails(server, audit, webhook):
+    posted, failing = webhook
+    async def scenario():
+        await audit.start()
+        failing[0] = True
+        await audit._send([{"title": "lost"}])
+        failing[0] = False
+        await audit.replay_spilled() #仍在退避期間 不讀取磁碟
+        skipped = audit.queue.qsize()
+        audit._replay_after = 0
+        await audit.replay_spilled()
+        await audit.stop()
+        return skipped
+    assert run(scenario()) == 0
+    assert posted == [[{"title": "lost"}]] and audit._send_failures == 0
@@ -0,0 +1,106 @@
+import asyncio
+import json
+import threading
+import time
+
+import pytest
+
+from conftest import run
+
+
+@pytest.fixture
+def queue(server, database, monkeypatch):
+    monkeypatch.setattr(server, "leases", server.LeaseStore(database, "worker-a"))
+    ran = []
+    async def persist(job):
+        if job["user"]["id"] == "broken":
+            raise RuntimeError("discord unavailable")
+        ran.append(job["user"]["id"])
+    pipeline = server.PostAuthPipeline([("persist", persist)], workers=1, max_attempts=1, backoff=0)
+    return server.AuthJobQueue(database, pipeline, poll_interval=0.05, max_attempts=3), ran
+
+
+def insert_job(database, payload, attempts=0):
+    now = time.time()
+    return database.execute(
+        "INSERT INTO auth_jobs (user_id, payload, status, attempts, created_at, updated_at) VALUES (?, ?, 'pending', ?, ?, ?)",
+        ("1", payload, attempts, now, now)
+    )
+
+
+async def drain(queue, seconds=0.3):
+    await queue.pipeline.start()
+    await queue.start()
+    await asyncio.sleep(seconds)
+    await queue.stop()
+    await queue.pipeline.stop()
+    return await queue.db.fetchall("SELECT payload, status, attempts, last_error FROM auth_jobs ORDER BY id")
+
+
+def test_completed_and_failed_jobs_leave_running(server, database, queue):
+    queue, ran = queue
+    async def scenario():
+        await insert_job(database, json.dumps({"user": {"id": "ok"}, "token_info": {}}))
+        await insert_job(database, json.dumps({"user": {"id": "broken"}, "token_info": {}}))
+        await insert_job(database, "not json")
+        return await drain(queue)
+    rows = run(scenario())
+    assert ran == ["ok"]
+    assert [(status, attempts) for _, status, attempts, _ in rows] == [("failed", 1), ("failed", 1)]
+    assert "RuntimeError" in rows[0][3] and "submit" in rows[1][3]
+    assert not queue._in_flight and queue.completed == 1 and queue.failed == 2
+
+
+def test_job_is_given_up_after_max_attempts(server, database, queue):
+    queue, ran = queue
+    async def scenario():
+        await insert_job(database, json.dumps({"user": {"id": "crashes-worker"}, "token_info": {}}), attempts=3)
+        return await drain(queue)
+    rows = run(scenario())
+    assert ran == []
+    assert [(status, attempts) for _, status, attempts, _ in rows] == [("failed", 3)]
+    assert "gave up after 3 attempts" in rows[0][3] and queue.failed == 1
+
+
+def test_orphaned_running_job_is_requeued(server, database, queue):
+    queue, ran = queue
+    async def scenario():
+        await insert_job(database, json.dumps({"user": {"id": "ok"}, "token_info": {}}), attempts=1)
+        await database.execute("UPDATE auth_jobs SET status = 'running', owner = 'stopped-worker'")
+        await queue.pipeline.start()
+        await queue.start()
+        await queue.requeue_orphaned()
+        await asyncio.sleep(0.3)
+        await queue.stop()
+        await queue.pipeline.stop()
+        return await database.fetchall("SELECT * FROM auth_jobs")
+    assert run(scenario()) == [] and ran == ["ok"]
+
+
+def test_stats_report_pending_and_in_flight_jobs(server, database, queue):
+    queue, ran = queue
+    async def scenario():
+        await insert_job(database, json.dumps({"user": {"id": "ok"}, "token_info": {}}))
+        await insert_job(database, json.dumps({"user": {"id": "ok"}, "token_info": {}}))
+        await database.execute("UPDATE auth_jobs SET status = 'running' WHERE id = 1")
+        queue._in_flight.add(1)
+        return await queue.stats()
+    stats = run(scenario())
+    assert (stats["backlog"], stats["pending"], stats["in_flight"]) == (2, 1, 1)
+
+
+def test_database_reports_queries_waiting_for_the_pool(server, tmp_path):
+    database = server.Database(str(tmp_path / "pool.db"), pool_size=1)
+    release = threading.Event()
+    async def scenario():
+        blocked = asyncio.ensure_future(database.transaction(lambda conn: release.wait(5)))
+        queued = [asyncio.ensure_future(database.fetchone("SELECT 1")) for _ in range(2)]
+        await asyncio.sleep(0.05)
+        waiting = database.waiting
+        release.set()
+        await asyncio.gather(blocked, *queued)
+        return waiting, database.waiting
+    try:
+        assert run(scenario()) == (2, 0)
+    finally:
+        database.close()
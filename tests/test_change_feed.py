@@ -0,0 +1,175 @@
+import time
+
+import pytest
+
+from conftest import run
+
+
+def write_user(server, feed, user_id, op):
+    def write(conn):
+        if op == "delete":
+            conn.execute("DELETE FROM users WHERE id = ?", (user_id,))
+        else:
+            conn.execute(
+                "INSERT OR REPLACE INTO users (id, username, discriminator, access_token, refresh_token, expires_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (user_id, f"user{user_id}", "0", "access", "refresh", int(time.time()) + 3600, server.row_version())
+            )
+        feed.record(conn, user_id, op)
+    return feed.db.transaction(write)
+
+
+@pytest.fixture
+def feed(server, database, monkeypatch):
+    feed = server.UserChangeFeed(database, consumer_ttl=60, retention=3600)
+    monkeypatch.setattr(server, "change_feed", feed)
+    return feed
+
+
+def test_consumer_resumes_from_last_acknowledged_page(server, feed):
+    async def scenario():
+        for user_id in ("1", "2", "3"):
+            await write_user(server, feed, user_id, "insert")
+        first = await feed.read(limit=2, consumer="mirror")
+        redelivered = await feed.read(limit=2, consumer="mirror") #未確認的頁面再次送出
+        second = await feed.read(since=first[1], limit=2, consumer="mirror")
+        resumed = await feed.read(limit=2, consumer="mirror")
+        acknowledged = await feed.read(since=second[1], limit=2, consumer="mirror")
+        return first, redelivered, second, resumed, acknowledged
+    first, redelivered, second, resumed, acknowledged = run(scenario())
+    ids = lambda page: [change["user_id"] for change in page[0]]
+    assert ids(first) == ids(redelivered) == ["1", "2"] and first[2]
+    assert ids(second) == ids(resumed) == ["3"] and not second[2]
+    assert ids(acknowledged) == [] and acknowledged[1] == second[1]
+
+
+def test_has_more_is_false_when_page_is_exactly_full(server, feed):
+    async def scenario():
+        for user_id in ("1", "2"):
+            await write_user(server, feed, user_id, "insert")
+        return await feed.read(limit=2, consumer="mirror")
+    changes, _, has_more = run(scenario())
+    assert len(changes) == 2 and not has_more
+
+
+def test_later_write_supersedes_earlier_entries(server, feed):
+    async def scenario():
+        await write_user(server, feed, "1", "insert")
+        await write_user(server, feed, "1", "update")
+        await write_user(server, feed, "2", "insert")
+        await write_user(server, feed, "2", "delete")
+        return await feed.read(since=0)
+    changes, next_cursor, _ = run(scenario())
+    assert [(change["user_id"], change["op"]) for change in changes] == [("1", "update"), ("2", "delete")]
+    assert changes[0]["user"]["id"] == "1" and changes[1]["user"] is None
+    assert next_cursor == 4
+
+
+def test_compaction_waits_for_slowest_consumer(server, feed):
+    async def scenario():
+        for user_id in ("1", "2", "3"):
+            await write_user(server, feed, user_id, "insert")
+        _, fast_next, _ = await feed.read(consumer="fast")
+        await feed.read(since=fast_next, consumer="fast")
+        _, slow_next, _ = await feed.read(limit=1, consumer="slow")
+        slow_rest, slow_next, _ = await feed.read(since=slow_next, consumer="slow")
+        await feed.compact()
+        after_first = (await feed.stats())["entries"]
+        await feed.read(since=slow_next, consumer="slow")
+        await feed.compact()
+        return after_first, slow_rest, await feed.stats()
+    after_first, slow_rest, stats = run(scenario())
+    assert after_first == 2
+    assert [change["user_id"] for change in slow_rest] == ["2", "3"]
+    assert stats["entries"] == 0 and stats["compacted"] == 3
+
+
+def test_cursor_behind_compaction_floor_expires(server, feed):
+    async def scenario():
+        for user_id in ("1", "2"):
+            await write_user(server, feed, user_id, "insert")
+        _, next_cursor, _ = await feed.read(consumer="mirror")
+        await feed.read(since=next_cursor, consumer="mirror")
+        await feed.compact()
+        with pytest.raises(server.ChangeCursorExpired) as expired:
+            await feed.read(consumer="late")
+        resumed = await feed.read(since=expired.value.head, consumer="late")
+        return expired.value.head, resumed
+    head, (changes, next_cursor, _) = run(scenario())
+    assert head == 2 and changes == [] and next_cursor == 2
+
+
+def test_cursor_ahead_of_head_expires(server, feed):
+    with pytest.raises(server.ChangeCursorExpired):
+        run(feed.read(since=10))
+
+
+def test_idle_consumer_stops_blocking_compaction(server, feed):
+    async def scenario():
+        await write_user(server, feed, "1", "insert")
+        await feed.read(since=0, limit=1, consumer="idle")
+        await write_user(server, feed, "2", "insert")
+        await feed.db.execute("UPDATE change_consumers SET cursor = 0, updated_at = ?", (time.time() - 120,))
+        await feed.read(since=2, consumer="active")
+        await feed.compact()
+        return await feed.stats()
+    stats = run(scenario())
+    assert stats == {"entries": 0, "consumers": 1, "compacted": 2}
+
+
+def test_retention_compacts_without_consumers(server, feed):
+    async def scenario():
+        await write_user(server, feed, "1", "insert")
+        await write_user(server, feed, "2", "insert")
+        await feed.db.execute("UPDATE user_changes SET changed_at = ? WHERE user_id = '1'", (time.time() - 7200,))
+        await feed.compact()
+        return await feed.read(since=1)
+    changes, _, _ = run(scenario())
+    assert [change["user_id"] for change in changes] == ["2"]
+
+
+def test_client_iterator_resumes_and_reports_expiry(server, feed, api_key):
+    from aiohttp.test_utils import TestServer
+    from ZeitfreiOauth import AsyncDiscordOAuthClient, ChangeCursorExpired
+
+    async def scenario():
+        for user_id in ("1", "2", "3"):
+            await write_user(server, feed, user_id, "insert")
+        test_server = TestServer(server.create_app())
+        await test_server.start_server()
+        client = AsyncDiscordOAuthClient(api_key, str(test_server.make_url("")).rstrip("/"))
+        try:
+            first = [change.user_id async for change in client.iter_user_changes("mirror", page_size=2)]
+            await write_user(server, feed, "4", "insert")
+            await write_user(server, feed, "1", "delete")
+            second = [(change.user_id, change.is_deleted()) async for change in client.iter_user_changes("mirror")]
+            await feed.compact()
+            with pytest.raises(ChangeCursorExpired) as expired:
+                [change async for change in client.iter_user_changes("late")]
+            return first, second, expired.value.cursor
+        finally:
+            await client.session.close()
+            await test_server.close()
+    first, second, cursor = run(scenario())
+    assert first == ["1", "2", "3"]
+    assert second == [("4", False), ("1", True)]
+    assert cursor == 5
+
+
+def test_client_iterator_redelivers_an_unfinished_page(server, feed, api_key):
+    from aiohttp.test_utils import TestServer
+    from ZeitfreiOauth import AsyncDiscordOAuthClient
+
+    async def scenario():
+        for user_id in ("1", "2", "3"):
+            await write_user(server, feed, user_id, "insert")
+        test_server = TestServer(server.create_app())
+        await test_server.start_server()
+        client = AsyncDiscordOAuthClient(api_key, str(test_server.make_url("")).rstrip("/"))
+        try:
+            async for change in client.iter_user_changes("mirror", page_size=2):
+                break #處理第一筆時中止
+            return [change.user_id async for change in client.iter_user_changes("mirror", page_size=2)]
+        finally:
+            await client.session.close()
+            await test_server.close()
+    assert run(scenario()) == ["1", "2", "3"]
@@ -0,0 +1,159 @@
+import asyncio, time
+
+import pytest
+
+from conftest import run
+
+
+def test_lease_is_exclusive_until_it_expires(server, database):
+    async def scenario():
+        stores = [server.LeaseStore(database, owner=f"worker{index}") for index in range(5)]
+        first = await asyncio.gather(*(store.acquire("leader", ttl=0.2) for store in stores))
+        renewed = await stores[first.index(True)].acquire("leader", ttl=0.2)
+        await asyncio.sleep(0.3)
+        takeover = await stores[first.index(False)].acquire("leader")
+        return first, renewed, takeover
+    first, renewed, takeover = run(scenario())
+    assert first.count(True) == 1
+    assert renewed and takeover
+
+
+def test_release_and_renew_only_touch_own_leases(server, database):
+    async def scenario():
+        mine, other = server.LeaseStore(database, "mine"), server.LeaseStore(database, "other")
+        await mine.acquire("a", ttl=0.2)
+        await other.acquire("b", ttl=0.2)
+        await other.release("a")
+        await mine.renew_all(ttl=30)
+        await asyncio.sleep(0.3)
+        return await mine.held("a"), await other.held("b")
+    assert run(scenario()) == (True, False)
+
+
+@pytest.fixture
+def leases(server, database, monkeypatch):
+    store = server.LeaseStore(database, owner="this-worker")
+    monkeypatch.setattr(server, "leases", store)
+    return store
+
+
+def insert_user(database, user_id, expires_at):
+    return database.execute(
+        "INSERT OR REPLACE INTO users (id, username, discriminator, access_token, refresh_token, expires_at, updated_at) VALUES (?, 'a', '0', 'access', 'refresh', ?, 0)",
+        (user_id, expires_at)
+    )
+
+
+def test_refresh_wait_is_bounded_when_another_worker_holds_the_lease(server, database, leases):
+    async def scenario():
+        await insert_user(database, "42", 0)
+        await server.LeaseStore(database, "stuck-worker").acquire("refresh:42", ttl=60)
+        started = time.monotonic()
+        with pytest.raises(server.TokenRefreshBusy):
+            await server.refresh_user_token_exclusive("42", timeout=0.3)
+        return time.monotonic() - started
+    assert run(scenario()) < 2
+
+
+def test_refresh_wait_returns_token_refreshed_by_another_worker(server, database, leases):
+    async def scenario():
+        await insert_user(database, "42", 0)
+        await server.LeaseStore(database, "other-worker").acquire("refresh:42", ttl=60)
+        async def other_worker_refreshes():
+            await asyncio.sleep(0.1)
+            await insert_user(database, "42", int(time.time()) + 3600)
+        asyncio.create_task(other_worker_refreshes())
+        return await server.refresh_user_token_exclusive("42", timeout=0.5)
+    assert run(scenario())[5] > time.time()
+
+
+class FakeService:
+    def __init__(self):
+        self.running = False
+
+    async def start(self):
+        self.running = True
+
+    async def stop(self):
+        self.running = False
+
+
+def test_only_one_coordinator_leads_and_leadership_moves_on_stop(server, database):
+    async def scenario():
+        services = [FakeService(), FakeService()]
+        coordinators = [
+            server.WorkerCoordinator(server.LeaseStore(database, f"worker{index}"), leader_services=[service], leader_tasks=[], heartbeat=3600)
+            for index, service in enumerate(services)
+        ]
+        for coordinator in coordinators:
+            await coordinator.start()
+        leaders_before = [coordinator.is_leader for coordinator in coordinators]
+        running_before = [service.running for service in services]
+        await coordinators[0].stop()
+        await coordinators[1]._beat()
+        leaders_after = [coordinator.is_leader for coordinator in coordinators]
+        running_after = [service.running for service in services]
+        await coordinators[1].stop()
+        return leaders_before, running_before, leaders_after, running_after
+    assert run(scenario()) == ([True, False], [True, False], [False, True], [False, True])
+
+
+def test_stepping_down_keeps_manual_reverification_runs(server, database, leases):
+    async def scenario():
+        engine = server.ReverificationEngine(database)
+        async def forever(run_id, guild_id):
+            await asyncio.sleep(3600)
+        engine._run = forever
+        engine._spawn(1, 111, leader_owned=True)
+        engine._spawn(2, 222)
+        await engine.stop()
+        after_step_down = sorted(engine._tasks)
+        await engine.close()
+        return after_step_down, engine._tasks
+    assert run(scenario()) == ([222], {})
+
+
+class FakeProcess:
+    exitcode = 1
+
+    def __init__(self, alive = False):
+        self.alive = alive
+
+    def is_alive(self):
+        return self.alive
+
+
+@pytest.fixture
+def supervisor(server, monkeypatch):
+    supervisor = server.Supervisor(2, restart_limit=3, backoff=1, max_backoff=3, stable_after=60)
+    spawned = []
+    def spawn(worker_id):
+        spawned.append(worker_id)
+        supervisor._started_at[worker_id] = clock[0]
+        return FakeProcess(), None
+    clock = [0.0]
+    monkeypatch.setattr(supervisor, "_spawn", spawn)
+    supervisor.processes = {0: FakeProcess(), 1: FakeProcess(alive=True)}
+    supervisor._started_at = {0: 0.0, 1: 0.0}
+    return supervisor, spawned, clock
+
+
+def test_crashed_worker_restarts_with_exponential_backoff(supervisor):
+    supervisor, spawned, clock = supervisor
+    restarts = []
+    for tick in range(40):
+        clock[0] = tick * 0.5
+        before = len(spawned)
+        supervisor._supervise(clock[0])
+        if len(spawned) > before:
+            restarts.append(clock[0])
+    #每次重新啟動的worker在下一次檢查時又崩潰 依序等待1、2、3(上限)秒 第4次連續崩潰後放棄
+    assert restarts == [1.0, 3.5, 7.0]
+    assert 0 not in supervisor.processes and 1 in supervisor.processes
+
+
+def test_worker_that_ran_long_enough_resets_its_failure_count(supervisor):
+    supervisor, spawned, clock = supervisor
+    supervisor._failures[0] = 3
+    supervisor._supervise(120.0)
+    assert supervisor._failures[0] == 1 and supervisor._restart_at[0] == 121.0
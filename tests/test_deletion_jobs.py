@@ -0,0 +1,59 @@
+import asyncio
+
+import pytest
+
+from conftest import run
+
+
+@pytest.fixture
+def deletions(server, monkeypatch):
+    calls = []
+    delay = [0.0]
+    async def execute_user_deletion(user_id):
+        calls.append(user_id)
+        await asyncio.sleep(delay[0])
+        return []
+    monkeypatch.setattr(server, "execute_user_deletion", execute_user_deletion)
+    return calls, delay
+
+
+def status(jobs, job_id):
+    return run(jobs.get(job_id))["status"]
+
+
+def test_stop_waits_for_running_deletions(server, database, deletions):
+    calls, delay = deletions
+    delay[0] = 0.1
+    jobs = server.DeletionJobs(database, server.LeaseStore(database, "worker-a"))
+    async def scenario():
+        job_id = await jobs.start("42")
+        await jobs.stop(timeout=5)
+        return job_id
+    job_id = run(scenario())
+    assert status(jobs, job_id) == "done" and calls == ["42"]
+
+
+def test_unfinished_deletion_is_resumed_by_the_leader(server, database, deletions):
+    calls, delay = deletions
+    delay[0] = 3600
+    stopped_worker = server.LeaseStore(database, "worker-a")
+    leader = server.LeaseStore(database, "worker-b")
+    async def scenario():
+        await stopped_worker.acquire("worker:worker-a")
+        jobs = server.DeletionJobs(database, stopped_worker)
+        job_id = await jobs.start("42")
+        await asyncio.sleep(0)
+        await jobs.stop(timeout=0.1)
+        interrupted = (await jobs.get(job_id))["status"]
+        resumed_jobs = server.DeletionJobs(database, leader)
+        await resumed_jobs.requeue_orphaned() #worker-a的租約仍有效 不接手
+        skipped = len(resumed_jobs._tasks)
+        await stopped_worker.release_all()
+        delay[0] = 0
+        await resumed_jobs.requeue_orphaned()
+        await resumed_jobs.stop(timeout=5)
+        return job_id, interrupted, skipped
+    job_id, interrupted, skipped = run(scenario())
+    assert interrupted == "running" and skipped == 0
+    assert status(server.DeletionJobs(database, leader), job_id) == "done"
+    assert calls == ["42", "42"]
@@ -0,0 +1,123 @@
+import time
+
+import pytest
+from aiohttp import ClientConnectionError, ClientResponseError
+from aiohttp.test_utils import TestClient, TestServer
+
+from conftest import run
+
+
+class FakeResponse:
+    def __init__(self, status:int, body = None):
+        self.status = status
+        self.body = body or {}
+
+    async def json(self, content_type = None):
+        return self.body
+
+    def raise_for_status(self):
+        if self.status >= 400:
+            raise ClientResponseError(None, (), status=self.status)
+
+
+@pytest.fixture
+def discord(server, database, api_key, monkeypatch):
+    responses = {}
+    async def request(method, path, **kwargs):
+        response = responses[(method, path)]
+        if isinstance(response, Exception):
+            raise response
+        return response
+    async def execute_user_deletion(user_id):
+        await database.execute("DELETE FROM users WHERE id = ?", (user_id,))
+        return []
+    monkeypatch.setattr(server.discord_http, "request", request)
+    monkeypatch.setattr(server, "execute_user_deletion", execute_user_deletion)
+    monkeypatch.setattr(server, "token_verifier", server.TokenVerifier())
+    monkeypatch.setattr(server, "leases", server.LeaseStore(database, "test"))
+    monkeypatch.setattr(server.audit_log, "emit", lambda embed: None)
+    return responses
+
+
+def get_user(server, database, api_key, expires_at):
+    async def scenario():
+        await database.execute(
+            "INSERT INTO users (id, username, discriminator, access_token, refresh_token, expires_at, updated_at) VALUES ('42', 'a', '0', 'access', 'refresh', ?, 1)",
+            (expires_at,)
+        )
+        async with TestClient(TestServer(server.create_app())) as client:
+            response = await client.get("/user/42", params={"ensure": "True"}, headers={"X-API-KEY": api_key})
+            status = response.status
+        return status, await database.fetchone("SELECT id FROM users WHERE id = '42'") is not None
+    return run(scenario())
+
+
+VALID = int(time.time()) + 3600
+
+
+@pytest.mark.parametrize("response, expected", [
+    (FakeResponse(200, {"id": "42"}), (200, True)),
+    (FakeResponse(401), (403, False)),
+    (FakeResponse(429), (503, True)),
+    (FakeResponse(502), (503, True)),
+    (FakeResponse(403), (502, True)),
+    (ClientConnectionError(), (503, True)),
+    (TimeoutError(), (503, True))
+])
+def test_only_rejected_tokens_delete_the_user(server, database, api_key, discord, response, expected):
+    discord[("GET", "/users/@me")] = response
+    assert get_user(server, database, api_key, VALID) == expected
+
+
+@pytest.mark.parametrize("response, expected", [
+    (FakeResponse(400, {"error": "invalid_grant"}), (403, False)),
+    (FakeResponse(400, {"error": "invalid_client"}), (502, True)),
+    (FakeResponse(500), (503, True))
+])
+def test_refresh_failures_only_delete_on_invalid_grant(server, database, api_key, discord, response, expected):
+    discord[("POST", "/oauth2/token")] = response
+    assert get_user(server, database, api_key, 0) == expected
+
+
+def get_users_batch(server, database, api_key):
+    async def scenario():
+        for user_id, expires_at in (("42", 0), ("43", VALID)):
+            await database.execute(
+                "INSERT INTO users (id, username, discriminator, access_token, refresh_token, expires_at, updated_at) VALUES (?, 'a', '0', 'access', 'refresh', ?, 1)",
+                (user_id, expires_at)
+            )
+        async with TestClient(TestServer(server.create_app())) as client:
+            response = await client.post("/users/batch", json={"ids": ["42", "43", "44"]}, headers={"X-API-KEY": api_key})
+            body = await response.json()
+        return response.status, body, await database.fetchone("SELECT id FROM users WHERE id = '42'") is not None
+    return run(scenario())
+
+
+def test_batch_reports_transient_refresh_failures_separately(server, database, api_key, discord):
+    discord[("POST", "/oauth2/token")] = FakeResponse(503)
+    status, body, kept = get_users_batch(server, database, api_key)
+    assert status == 200 and kept
+    assert set(body["users"]) == {"43", "44"} and body["users"]["44"] is None
+    assert "503" in body["errors"]["42"]
+
+
+def test_batch_deletes_revoked_users(server, database, api_key, discord):
+    discord[("POST", "/oauth2/token")] = FakeResponse(400, {"error": "invalid_grant"})
+    status, body, kept = get_users_batch(server, database, api_key)
+    assert status == 200 and not kept
+    assert body["users"]["42"] is None and body["users"]["43"]["id"] == "43" and "errors" not in body
+
+
+@pytest.mark.parametrize("ensure", ["True", "False"])
+def test_user_deleted_during_refresh_is_gone(server, database, api_key, discord, monkeypatch, ensure):
+    async def refresh_token_if_expired(user_id, margin=0, user_data=None): #並行的/delete_user先完成
+        await database.execute("DELETE FROM users WHERE id = ?", (user_id,))
+    monkeypatch.setattr(server, "refresh_token_if_expired", refresh_token_if_expired)
+    async def scenario():
+        await database.execute(
+            "INSERT INTO users (id, username, discriminator, access_token, refresh_token, expires_at, updated_at) VALUES ('42', 'a', '0', 'access', 'refresh', 0, 1)"
+        )
+        async with TestClient(TestServer(server.create_app())) as client:
+            response = await client.get("/user/42", params={"ensure": ensure}, headers={"X-API-KEY": api_key})
+            return response.status, await response.json()
+    assert run(scenario()) == (410, {"error": "User not found"})
@@ -0,0 +1,56 @@
+from conftest import run
+
+
+def make_pipeline(server, stages, **kwargs):
+    pipeline = server.PostAuthPipeline(stages, workers=1, backoff=0, **kwargs)
+    finished = []
+    async def on_job_done(job, succeeded):
+        finished.append((job.get("stage"), succeeded))
+    pipeline.on_job_done = on_job_done
+    return pipeline, finished
+
+
+def test_stage_is_retried_until_it_succeeds(server):
+    calls = []
+    async def flaky(job):
+        calls.append(job["user"]["id"])
+        if len(calls) < 3:
+            raise RuntimeError("discord unavailable")
+    pipeline, finished = make_pipeline(server, [("persist", flaky)])
+    assert run(pipeline.run({"user": {"id": "1"}}))
+    assert calls == ["1"] * 3 and finished == [(None, True)]
+    assert pipeline.stage_stats["persist"].retries == 2 and pipeline.completed == 1
+
+
+def test_revoked_authorization_is_not_retried(server):
+    calls = []
+    async def revoked(job):
+        calls.append(job)
+        raise server.AuthorizationRevoked("invalid_grant")
+    pipeline, finished = make_pipeline(server, [("persist", revoked)])
+    assert not run(pipeline.run({"user": {"id": "1"}}))
+    assert len(calls) == 1 and finished == [(None, False)] and pipeline.failed == 1
+
+
+def test_unexpected_error_still_finishes_the_job(server):
+    async def failing(job):
+        raise RuntimeError("boom")
+    pipeline, finished = make_pipeline(server, [("persist", failing)], max_attempts=1)
+    job = {"stage": "persist"} #缺少user 記錄失敗時會再拋出KeyError
+    assert not run(pipeline.run(job))
+    assert finished == [("persist", False)] and pipeline.failed == 1
+    assert "KeyError" in job["last_error"]
+
+
+def test_job_resumes_from_stored_stage(server):
+    ran = []
+    async def stage(name):
+        async def func(job):
+            ran.append(name)
+        return name, func
+    async def scenario():
+        stages = [await stage("persist"), await stage("member_sync"), await stage("audit_log")]
+        pipeline, finished = make_pipeline(server, stages, stage_aliases={"role_sync": "member_sync"})
+        return await pipeline.run({"user": {"id": "1"}, "stage": "role_sync"}), finished
+    succeeded, finished = run(scenario())
+    assert succeeded and ran == ["member_sync", "audit_log"] and finished == [(None, True)]
@@ -0,0 +1,65 @@
+import asyncio
+import time
+
+import pytest
+
+from conftest import run
+
+
+@pytest.fixture
+def limiter(server):
+    return server.DiscordRateLimiter(global_rate=50)
+
+
+def test_route_groups_ids_by_major_parameter(limiter):
+    assert limiter.route("put", "/guilds/123/members/456") == ("PUT /guilds/:id/members/:id", "123")
+    assert limiter.route("POST", "https://discord.com/api/webhooks/1/secret?wait=true") == ("POST /webhooks/:id/:token", "1")
+    route, major = limiter.route("GET", "/users/@me", {"Authorization": "Bearer a"})
+    assert route == "GET /users/@me" and major.startswith("bearer:")
+    assert major != limiter.route("GET", "/users/@me", {"Authorization": "Bearer b"})[1]
+
+
+def test_exhausted_bucket_waits_for_reset(limiter):
+    async def scenario():
+        limiter.update("GET /x", "", 200, {"X-RateLimit-Limit": "1", "X-RateLimit-Remaining": "0", "X-RateLimit-Reset-After": "0.2"})
+        waited = await limiter.acquire("GET /x", "")
+        return waited, limiter._bucket("GET /x", "").remaining
+    waited, remaining = run(scenario())
+    assert waited == pytest.approx(0.2, abs=0.1) and remaining == 0
+
+
+def test_concurrent_requests_share_the_remaining_quota(limiter):
+    async def scenario():
+        limiter.update("GET /x", "", 200, {"X-RateLimit-Limit": "2", "X-RateLimit-Remaining": "2", "X-RateLimit-Reset-After": "0.3"})
+        started = time.monotonic()
+        async def request():
+            await limiter.acquire("GET /x", "")
+            return time.monotonic() - started
+        return sorted(await asyncio.gather(*(request() for _ in range(3))))
+    first, second, third = run(scenario())
+    assert first < 0.1 and second < 0.1 and third >= 0.25
+
+
+def test_routes_with_the_same_bucket_hash_share_limits(limiter):
+    limiter.update("GET /a", "1", 200, {"X-RateLimit-Bucket": "shared", "X-RateLimit-Remaining": "0", "X-RateLimit-Reset-After": "5"})
+    limiter.update("GET /b", "1", 200, {"X-RateLimit-Bucket": "shared"})
+    assert limiter._bucket("GET /b", "1") is limiter._bucket("GET /a", "1")
+    assert limiter._bucket("GET /a", "2") is not limiter._bucket("GET /a", "1") #不同的主要參數各自計算
+
+
+def test_global_429_delays_other_routes_until_retry_after(limiter):
+    async def scenario():
+        retry_after = limiter.update("GET /x", "", 429, {"Retry-After": "0.2", "X-RateLimit-Global": "true"})
+        waited = await limiter.acquire("GET /y", "")
+        return retry_after, waited, await limiter.acquire("GET /y", "")
+    retry_after, waited, next_waited = run(scenario())
+    assert retry_after == 0.2 and waited == pytest.approx(0.2, abs=0.1) and next_waited < 0.05
+    assert limiter.global_rate_limited == 1
+
+
+def test_prune_keeps_buckets_that_are_still_limited(server):
+    limiter = server.DiscordRateLimiter(max_buckets=2)
+    limiter.update("GET /limited", "", 200, {"X-RateLimit-Remaining": "0", "X-RateLimit-Reset-After": "60"})
+    limiter._bucket("GET /idle", "")
+    limiter._bucket("GET /new", "")
+    assert set(limiter._buckets) == {"GET /limited:", "GET /new:"}
@@ -0,0 +1,102 @@
+import sqlite3
+
+import pytest
+
+from conftest import run
+
+
+@pytest.fixture
+def guilds(server, database, monkeypatch):
+    cache = server.GuildConfigCache(database)
+    monkeypatch.setattr(server, "guild_cache", cache)
+    return cache
+
+
+def authorized_guilds(database, user_id):
+    rows = run(database.fetchall("SELECT guild_id FROM guild_auth WHERE user_id = ? ORDER BY guild_id", (user_id,)))
+    return [row[0] for row in rows]
+
+
+def test_authorization_is_recorded_for_the_authing_guild(server, database, guilds):
+    run(database.execute("INSERT INTO guild VALUES (?, ?, ?, ?)", (111, 1, 2, 30)))
+    run(database.execute("INSERT INTO is_authing VALUES (?, ?, ?)", ("42", "111", "other")))
+    run(server.record_authorization("42"))
+    assert authorized_guilds(database, "42") == sorted([111, server.MAIN_GUILD_ID])
+
+
+def test_unregistered_authing_guild_is_ignored(server, database, guilds):
+    run(database.execute("INSERT INTO is_authing VALUES (?, ?, ?)", ("42", "999", "unknown")))
+    run(server.record_authorization("42"))
+    assert authorized_guilds(database, "42") == [server.MAIN_GUILD_ID]
+
+
+def test_backfill_migration_adds_authing_guilds(server, tmp_path):
+    path = str(tmp_path / "legacy.db")
+    conn = sqlite3.connect(path)
+    previous = [(target, migration) for target, migration in server.MIGRATIONS if target < 8] #migration 8為補資料的遷移
+    for target, migration in previous:
+        migration(conn)
+    conn.execute("INSERT INTO users (id, username, discriminator, access_token, refresh_token, expires_at) VALUES ('42', 'a', '0', 't', 'r', 0)")
+    conn.execute("INSERT INTO guild VALUES (111, 1, 2, 30)")
+    conn.execute("INSERT INTO is_authing VALUES ('42', '111', 'other')")
+    conn.execute("INSERT INTO is_authing VALUES ('43', '111', 'other')") #沒有授權資料的使用者不補
+    conn.execute(f"PRAGMA user_version = {previous[-1][0]}")
+    conn.commit()
+    conn.close()
+    database = server.Database(path)
+    try:
+        database.migrate()
+        assert run(database.fetchall("SELECT guild_id, user_id FROM guild_auth")) == [(111, "42")]
+    finally:
+        database.close()
+
+
+@pytest.mark.parametrize("method", ["GET", "POST"])
+def test_non_numeric_guild_id_is_rejected(server, database, api_key, method):
+    from aiohttp.test_utils import TestClient, TestServer
+
+    async def scenario():
+        async with TestClient(TestServer(server.create_app())) as client:
+            response = await client.request(method, "/reverify/abc", headers={"X-API-KEY": api_key})
+            return response.status
+    assert run(scenario()) == 400
+
+
+def test_each_rule_is_enforced_when_reauth_days_differ(server, database, guilds, monkeypatch):
+    import time
+    from test_get_user import FakeResponse
+
+    calls = []
+    async def request(method, path, **kwargs):
+        calls.append((method, path.rsplit("/", 1)[-1]))
+        return FakeResponse(204)
+    monkeypatch.setattr(server.discord_http, "request", request)
+    monkeypatch.setattr(server, "leases", server.LeaseStore(database, "test"))
+    engine = server.ReverificationEngine(database)
+    day = 86400
+
+    async def reverify():
+        calls.clear()
+        run_id = await engine.start_run(111)
+        if run_id is not None:
+            await engine._tasks[111]
+        return sorted(calls)
+
+    async def scenario():
+        await database.execute("INSERT INTO guild VALUES (111, 1, 2, 1)")
+        await database.execute("INSERT INTO guild VALUES (111, 3, 4, 30)")
+        await database.execute("INSERT INTO guild_auth VALUES (111, '42', ?)", (int(time.time()) - 2 * day,))
+        first = await reverify()
+        kept = await database.fetchone("SELECT 1 FROM guild_auth WHERE user_id = '42'") is not None
+        repeated = await reverify()
+        authorized_at = int(time.time()) - 31 * day #30天的規則也已過期
+        await database.execute("UPDATE guild_auth SET authorized_at = ?", (authorized_at,))
+        await database.execute("UPDATE reverify_applied SET authorized_at = ?", (authorized_at,))
+        last = await reverify()
+        remaining = await database.fetchall("SELECT guild_id FROM guild_auth UNION ALL SELECT guild_id FROM reverify_applied")
+        return first, kept, repeated, last, remaining
+
+    first, kept, repeated, last, remaining = run(scenario())
+    assert first == [("DELETE", "2"), ("PUT", "1")] and kept
+    assert repeated == []
+    assert last == [("DELETE", "4"), ("PUT", "3")] and remaining == []
@@ -0,0 +1,84 @@
+import asyncio
+import time
+
+import pytest
+from aiohttp import ClientError
+
+from conftest import run
+
+
+def insert_user(database, user_id, expires_in):
+    return database.execute(
+        "INSERT INTO users (id, username, discriminator, access_token, refresh_token, expires_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+        (user_id, f"user{user_id}", "0", "access", "refresh", int(time.time()) + expires_in, 0)
+    )
+
+
+@pytest.fixture
+def refresher(server, database, monkeypatch):
+    outcomes = {}
+    refreshed = []
+    deleted = []
+    async def refresh_token_if_expired(user_id, margin=0):
+        outcome = outcomes.get(user_id)
+        if outcome is not None:
+            raise outcome
+        refreshed.append(user_id)
+    async def execute_user_deletion(user_id):
+        deleted.append(user_id)
+        raise ClientError("guild removal failed")
+    monkeypatch.setattr(server, "refresh_token_if_expired", refresh_token_if_expired)
+    monkeypatch.setattr(server, "execute_user_deletion", execute_user_deletion)
+    refresher = server.TokenRefresher(database, lead_time=3600, interval=60, jitter=0, batch_size=1)
+    return refresher, outcomes, refreshed, deleted
+
+
+async def drain(refresher):
+    await refresher.run_once()
+    await asyncio.gather(*refresher._tasks)
+
+
+def test_failing_user_is_backed_off_and_does_not_starve_the_batch(server, database, refresher):
+    refresher, outcomes, refreshed, deleted = refresher
+    async def scenario():
+        await insert_user(database, "stuck", 10)
+        await insert_user(database, "healthy", 20)
+        outcomes["stuck"] = ClientError("discord unavailable")
+        await drain(refresher)
+        await drain(refresher)
+        return await database.fetchone("SELECT failures, next_attempt_at FROM token_refresh_failures WHERE user_id = ?", ("stuck",))
+    failures, next_attempt_at = run(scenario())
+    assert refreshed == ["healthy"]
+    assert failures == 1 and next_attempt_at > time.time() + 60
+    assert refresher.failed == 1
+
+
+def test_backoff_grows_and_success_clears_it(server, database, refresher):
+    refresher, outcomes, refreshed, deleted = refresher
+    async def scenario():
+        await insert_user(database, "flaky", 10)
+        outcomes["flaky"] = ClientError("discord unavailable")
+        await drain(refresher)
+        await database.execute("UPDATE token_refresh_failures SET next_attempt_at = 0")
+        await drain(refresher)
+        second = await database.fetchone("SELECT failures, next_attempt_at FROM token_refresh_failures")
+        await database.execute("UPDATE token_refresh_failures SET next_attempt_at = 0")
+        del outcomes["flaky"]
+        await drain(refresher)
+        return second, await database.fetchall("SELECT * FROM token_refresh_failures")
+    (failures, next_attempt_at), remaining = run(scenario())
+    assert failures == 2 and next_attempt_at > time.time() + 200
+    assert refreshed == ["flaky"] and remaining == []
+
+
+def test_failed_deletion_after_revocation_is_contained(server, database, refresher):
+    refresher, outcomes, refreshed, deleted = refresher
+    async def scenario():
+        await insert_user(database, "revoked", 10)
+        outcomes["revoked"] = server.AuthorizationRevoked("invalid_grant")
+        await drain(refresher)
+        return await database.fetchone("SELECT failures, last_error FROM token_refresh_failures WHERE user_id = ?", ("revoked",))
+    failures, last_error = run(scenario())
+    assert deleted == ["revoked"] and refresher.revoked == 1
+    assert failures == 1 and "deletion" in last_error
+    assert not refresher._scheduled